@@ -5,6 +5,7 @@
 #############################
 
 from lab_utils import logo as show_logo
+from lab_utils import query_scenes, get_cache_dir
 from reset import reset_burstS1_data_dir
 import os
 import re
@@ -12,6 +13,18 @@ import argparse
 import subprocess
 import shutil
 import sys
+import sqlite3
+import hashlib
+import xml.etree.ElementTree as ET
+from joblib import Parallel, delayed
+
+## number of concurrent burst2safe processes
+BURST2SAFE_JOBS = 4
+## sqlite burst catalogs of the burst data directories, kept in the shared cache
+BURST_CATALOG_DIR = "burst_catalog"
+## S1_136231_IW2_20200604T022312_VV_7C85-BURST : burst id, swath, sensing time, polarization
+BURST_NAME_PATTERN = re.compile(r'^S1_(\d+)_(IW\d)_(\d{8}T\d{6})_(\w\w)_\w+-BURST$')
+
 
 def extract_date(filename):
     # extract date from sentinel1 filename
@@ -21,66 +34,261 @@ def extract_date(filename):
     return None
 
 
-def extract_safe_date_list(safe_dir):
-    safe_pattern = re.compile(r'^S1[AB]_.*?_(\d{8})T.*\.SAFE$')
-    safe_date_list = [
-        safe_pattern.search(safe_file).group(1)
-        for safe_file in os.listdir(safe_dir)
-        if safe_pattern.match(safe_file)
-    ]
-    return safe_date_list
+def get_safe_date_index(safe_dir):
+    # index the existing SAFE directories of safe_dir by date from the scene index, {date: [safe paths]}
+    safe_index = {}
+    for scene in query_scenes(safe_dir, kind="SAFE"):
+        safe_index.setdefault(scene["date"], []).append(scene["path"])
+    return safe_index
+
+
+def group_bursts_by_date(datadir, selected=None):
+    ############################################################
+    # group the burst tiffs of datadir by acquisition date
+    # <1> datadir (str)  : directory containing sentinel-1 burst GTiff and xml files
+    # <2> selected (set) : burst names to keep (default : all)
+    # <return> date_groups (dict): {date: [burst names]} sorted by date, a burst name is the
+    #          file name without extension, e.g. S1_136231_IW2_20200604T022312_VV_7C85-BURST
+    ############################################################
+    tiff_files = [f for f in os.listdir(datadir) if f.endswith('.tiff') and extract_date(f)]
+    date_groups = {}
+    for file in sorted(tiff_files, key=extract_date):
+        burst_name = file.split('-BURST')[0] + '-BURST'
+        if selected is not None and burst_name not in selected:
+            continue
+        date_groups.setdefault(extract_date(file), []).append(burst_name)
+    return date_groups
+
+
+def get_xml_text(root, name):
+    # text of the first element named name, whatever its namespace, None if missing
+    for elem in root.iter():
+        if elem.tag.split('}')[-1] == name and elem.text:
+            return elem.text.strip()
+    return None
+
+
+def parse_burst_xml(xml_file, burst_id):
+    ############################################################
+    # read the mission, relative orbit and footprint of a burst from its metadata xml
+    # the footprint is the geolocation grid of the lines of the burst (found by its burst id
+    # in the burst list), the whole grid when the burst can not be located
+    # <1> xml_file (str) : burst metadata xml (annotation, with the manifest)
+    # <2> burst_id (int) : ESA burst id of the burst name
+    # <return> dict : mission, relative_orbit, lat_min, lat_max, lon_min, lon_max (None if unknown)
+    ############################################################
+    root = ET.parse(xml_file).getroot()
+    mission = get_xml_text(root, 'missionId')
+    relative_orbit = get_xml_text(root, 'relativeOrbitNumber')
+    if relative_orbit is None:
+        absolute_orbit = get_xml_text(root, 'absoluteOrbitNumber')
+        if absolute_orbit is not None and mission in ('S1A', 'S1B'):
+            relative_orbit = (int(absolute_orbit) - (73 if mission == 'S1A' else 27)) % 175 + 1
+    points = [(float(point.findtext('line')), float(point.findtext('latitude')), float(point.findtext('longitude')))
+              for point in root.iter('geolocationGridPoint')]
+    ## lines of the burst in the swath
+    lines_per_burst = get_xml_text(root, 'linesPerBurst')
+    burst_ids = [get_xml_text(burst, 'burstId') for burst in root.iter('burst')]
+    if lines_per_burst and str(burst_id) in burst_ids:
+        lines_per_burst = int(lines_per_burst)
+        first_line = burst_ids.index(str(burst_id)) * lines_per_burst
+        margin = lines_per_burst * 0.1
+        burst_points = [point for point in points
+                        if first_line - margin <= point[0] <= first_line + lines_per_burst + margin]
+        points = burst_points or points
+    footprint = {'lat_min': None, 'lat_max': None, 'lon_min': None, 'lon_max': None}
+    if points:
+        lats = [point[1] for point in points]
+        lons = [point[2] for point in points]
+        footprint = {'lat_min': min(lats), 'lat_max': max(lats), 'lon_min': min(lons), 'lon_max': max(lons)}
+    return dict(footprint, mission=mission,
+                relative_orbit=int(relative_orbit) if relative_orbit is not None else None)
+
+
+def get_burst_catalog_file(datadir):
+    # the burst catalog of a burst data directory, kept in the shared cache (the data directory
+    # is left untouched and may be read-only)
+    key = hashlib.sha1(os.path.realpath(datadir).encode()).hexdigest()[:16]
+    return os.path.join(get_cache_dir(BURST_CATALOG_DIR), f"{key}.sqlite")
+
+
+def open_burst_catalog(catalog_file):
+    # open (create) the sqlite burst catalog
+    # table bursts      : name, files, date, burst id, swath, polarization, mission, relative orbit, footprint
+    # table burst_rtree : r*tree spatial index of the footprints (rowid of bursts)
+    conn = sqlite3.connect(catalog_file, timeout=60)
+    conn.execute("CREATE TABLE IF NOT EXISTS bursts (id INTEGER PRIMARY KEY, name TEXT UNIQUE, tiff TEXT, "
+                 "xml TEXT, xml_mtime REAL, date TEXT, burst_id INTEGER, swath TEXT, polarization TEXT, "
+                 "mission TEXT, relative_orbit INTEGER, lat_min REAL, lat_max REAL, lon_min REAL, lon_max REAL)")
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS burst_rtree USING rtree(id, lat_min, lat_max, lon_min, lon_max)")
+    return conn
 
 
-def S1_burst2safe(datadir, workdir, update_mode):
+def update_burst_catalog(datadir, catalog_file):
+    ############################################################
+    # add the bursts of datadir to the catalog, only the new bursts or the bursts whose
+    # metadata xml changed are parsed, the bursts whose tiff is gone are removed
+    # <1> datadir (str)      : directory containing sentinel-1 burst GTiff and xml files
+    # <2> catalog_file (str) : sqlite burst catalog
+    # <return> number of bursts (re)parsed
+    ############################################################
+    conn = open_burst_catalog(catalog_file)
+    known = {name: (row_id, xml_mtime) for row_id, name, xml_mtime
+             in conn.execute("SELECT id, name, xml_mtime FROM bursts")}
+    names = set()
+    n_parsed = 0
+    for file in os.listdir(datadir):
+        if not file.endswith('.tiff'):
+            continue
+        name = file[:-len('.tiff')]
+        match = BURST_NAME_PATTERN.match(name)
+        if match is None:
+            continue
+        names.add(name)
+        xml_file = os.path.join(datadir, name + '.xml')
+        xml_mtime = os.path.getmtime(xml_file) if os.path.exists(xml_file) else None
+        if name in known and known[name][1] == xml_mtime:
+            continue
+        burst_id, swath, sensing_time, polarization = match.groups()
+        info = {'mission': None, 'relative_orbit': None,
+                'lat_min': None, 'lat_max': None, 'lon_min': None, 'lon_max': None}
+        if xml_mtime is not None:
+            try:
+                info = parse_burst_xml(xml_file, int(burst_id))
+            except (ET.ParseError, TypeError, ValueError) as e:
+                print(f"WARNING: can not read the burst metadata {xml_file}: {e}")
+        if name in known:
+            conn.execute("DELETE FROM burst_rtree WHERE id = ?", (known[name][0],))
+            conn.execute("DELETE FROM bursts WHERE id = ?", (known[name][0],))
+        cursor = conn.execute(
+            "INSERT INTO bursts (name, tiff, xml, xml_mtime, date, burst_id, swath, polarization, mission, "
+            "relative_orbit, lat_min, lat_max, lon_min, lon_max) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+            (name, os.path.join(datadir, file), xml_file if xml_mtime is not None else None, xml_mtime,
+             sensing_time[:8], int(burst_id), swath, polarization.upper(), info['mission'],
+             info['relative_orbit'], info['lat_min'], info['lat_max'], info['lon_min'], info['lon_max']))
+        if info['lat_min'] is not None:
+            conn.execute("INSERT INTO burst_rtree VALUES (?,?,?,?,?)",
+                         (cursor.lastrowid, info['lat_min'], info['lat_max'], info['lon_min'], info['lon_max']))
+        n_parsed += 1
+    for name in set(known) - names:
+        conn.execute("DELETE FROM burst_rtree WHERE id = ?", (known[name][0],))
+        conn.execute("DELETE FROM bursts WHERE id = ?", (known[name][0],))
+    conn.commit()
+    conn.close()
+    return n_parsed
+
+
+def select_bursts(catalog_file, bbox, polarization=None):
+    ############################################################
+    # select the bursts of the catalog intersecting the bbox with the spatial index
+    # the bursts without footprint (no metadata xml) are always kept, and a swath with a
+    # single selected burst also keeps its along-track neighbours (burst2safe needs 2 bursts)
+    # <1> catalog_file (str) : sqlite burst catalog
+    # <2> bbox (list)        : [lat_min, lat_max, lon_min, lon_max]
+    # <3> polarization (str) : polarization to keep (default : all)
+    # <return> set of the selected burst names
+    ############################################################
+    lat_min, lat_max, lon_min, lon_max = bbox
+    conn = open_burst_catalog(catalog_file)
+    columns = "b.name, b.date, b.swath, b.polarization, b.burst_id"
+    rows = conn.execute(
+        f"SELECT {columns} FROM bursts b JOIN burst_rtree r ON b.id = r.id "
+        "WHERE r.lat_min <= ? AND r.lat_max >= ? AND r.lon_min <= ? AND r.lon_max >= ?",
+        (lat_max, lat_min, lon_max, lon_min)).fetchall()
+    unknown = conn.execute(f"SELECT {columns} FROM bursts b WHERE b.lat_min IS NULL").fetchall()
+    if unknown:
+        print(f"WARNING: {len(unknown)} bursts have no footprint, keep them")
+    rows = [row for row in rows + unknown if polarization is None or row[3] == polarization.upper()]
+    swath_bursts = {}
+    for name, date, swath, pol, burst_id in rows:
+        swath_bursts.setdefault((date, swath, pol), []).append(burst_id)
+    for (date, swath, pol), burst_ids in swath_bursts.items():
+        if len(burst_ids) == 1:
+            rows += conn.execute(
+                f"SELECT {columns} FROM bursts b WHERE b.date = ? AND b.swath = ? AND b.polarization = ? "
+                "AND b.burst_id IN (?, ?)", (date, swath, pol, burst_ids[0] - 1, burst_ids[0] + 1)).fetchall()
+    conn.close()
+    return {row[0] for row in rows}
+
+
+def link_burst_file(src_path, dst_path):
+    # put a burst file in the SLC directory without copying : hardlink, symlink across file systems
+    if os.path.lexists(dst_path):
+        return
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        os.symlink(os.path.abspath(src_path), dst_path)
+
+
+def run_burst2safe(bursts, safe_dir, date):
+    # run burst2safe on the bursts of one date in safe_dir, the output goes to burst2safe_<date>.log
+    command = ['burst2safe'] + bursts
+    log_file = os.path.join(safe_dir, f"burst2safe_{date}.log")
+    print(f"Running command: {' '.join(command)}")
+    with open(log_file, 'w') as log:
+        result = subprocess.run(command, cwd=safe_dir, stdout=log, stderr=subprocess.STDOUT)
+    if result.returncode != 0:
+        print(f"Error running burst2safe for {date} (return code: {result.returncode}), see {log_file}")
+    return result.returncode == 0
+
+
+def S1_burst2safe(datadir, workdir, update_mode, njobs=BURST2SAFE_JOBS, bbox=None, polarization=None):
+    ############################################################
+    # assemble the bursts of datadir into one SAFE per date in workdir/SLC
+    # the burst tiff/xml files are linked into SLC (no copy) and the dates are
+    # processed by njobs concurrent burst2safe processes
+    # <1> datadir (str)     : directory containing sentinel-1 burst GTiff and xml files
+    # <2> workdir (str)     : workspace, the SAFE files are written to workdir/SLC
+    # <3> update_mode (bool): whether delete the exist SAFE of a date and run it again
+    # <4> njobs (int)       : number of concurrent burst2safe processes (default : BURST2SAFE_JOBS)
+    # <5> bbox (list)       : keep only the bursts intersecting [lat_min, lat_max, lon_min, lon_max],
+    #                         selected from the burst catalog of datadir (default : all bursts)
+    # <6> polarization (str): polarization to keep with bbox (default : all)
+    ############################################################
     # create SLC directory in workdir 
     safe_dir = os.path.join(workdir, 'SLC')
     if not os.path.exists(safe_dir):
         os.makedirs(safe_dir)
 
-    tiff_files = [f for f in os.listdir(datadir) if f.endswith('.tiff')]
-    for tiff_file in tiff_files:
-        src_path = os.path.join(datadir, tiff_file)
-        dst_path = os.path.join(safe_dir, tiff_file)
-        shutil.copy2(src_path, dst_path)
+    selected = None
+    if bbox is not None:
+        catalog_file = get_burst_catalog_file(datadir)
+        n_parsed = update_burst_catalog(datadir, catalog_file)
+        selected = select_bursts(catalog_file, bbox, polarization)
+        print(f"burst catalog {catalog_file} : {n_parsed} bursts updated, "
+              f"{len(selected)} bursts selected for the bbox {bbox}")
+    date_groups = group_bursts_by_date(datadir, selected)
+    for bursts in date_groups.values():
+        for burst_name in bursts:
+            for ext in ('.tiff', '.xml'):
+                src_path = os.path.join(datadir, burst_name + ext)
+                if os.path.exists(src_path):
+                    link_burst_file(src_path, os.path.join(safe_dir, burst_name + ext))
 
-    os.chdir(safe_dir)
-    tiff_files = [f for f in os.listdir('.') if f.endswith('.tiff')]
-    tiff_files.sort(key=extract_date)
-    date_groups = {}
-    for file in tiff_files:
-        date = extract_date(file)
-        if date:
-            burst_name = file.split('-BURST')[0] + '-BURST'
-            if date not in date_groups:
-                date_groups[date] = []
-            date_groups[date].append(burst_name)
-            
+    safe_index = get_safe_date_index(safe_dir)
+    jobs = []
     for date, bursts in date_groups.items():
-        safe_date_list = extract_safe_date_list(safe_dir)
-        if date in safe_date_list:
-            # if safe_date_list contain date corresponding SAFE file:
+        if date in safe_index:
+            # if the SAFE of the date exists:
             ## if the update_mode is True, then delete the file and run burst2safe
             ## if the update_mode is False, just pass it 
-            if update_mode:
-               print("update mode is : on, delete the exists file and update")
-               safe_file = [os.path.join(safe_dir, safe_file) for safe_file in os.listdir(safe_dir) if date in safe_file][0]
-               cmd = f"rm -rf {safe_file}"    
-               print(f"Running command : {cmd}")                         
-               os.system(cmd)
-            else:
-                pass
+            if not update_mode:
+                print(f"update mode is : off, the SAFE of {date} exists, pass it")
+                continue
+            print("update mode is : on, delete the exists file and update")
+            for safe_file in safe_index[date]:
+                print(f"remove {safe_file}")
+                shutil.rmtree(safe_file)
         if len(bursts) > 1:
-            command = ['burst2safe'] + bursts
-            try:
-                print(f"Running command: {' '.join(command)}")
-                subprocess.run(command, check=True)
-            except subprocess.CalledProcessError as e:
-                print(f"Error running command: {e}")
+            jobs.append((date, bursts))
         else:
             print(f"Skipping {date} as there is only one burst file.")
-    print(f"burst2safe is done.\n go back to directory {workdir}")
-    os.chdir(workdir)
-    
+    results = Parallel(n_jobs=max(min(njobs, len(jobs)), 1), prefer="threads")(
+        delayed(run_burst2safe)(bursts, safe_dir, date) for date, bursts in jobs
+    )
+    print(f"burst2safe is done : {sum(results)}/{len(jobs)} dates succeeded.")
+
 
 def create_parser():
     ## create argument parser
@@ -98,6 +306,13 @@ def create_parser():
                         help='whether reset the SLC directory (default : False)')
     parser.add_argument('--logo', action='store_true', default=False,
                         help='show the logo of IntfLab (default : False)')
+    parser.add_argument('--bbox', type=float, nargs=4, default=None,
+                        metavar=('LAT_MIN', 'LAT_MAX', 'LON_MIN', 'LON_MAX'),
+                        help='keep only the bursts intersecting the bbox (default : all bursts)')
+    parser.add_argument('--polarization', type=str, default=None,
+                        help='polarization to keep with --bbox (default : all)')
+    parser.add_argument('--njobs', type=int, default=BURST2SAFE_JOBS,
+                        help=f'number of concurrent burst2safe processes (default : {BURST2SAFE_JOBS})')
     return parser
 
 
@@ -116,4 +331,5 @@ if __name__ == "__main__":
     if reset:
         reset_burstS1_data_dir(data_dir)
         
-    S1_burst2safe(datadir=data_dir, workdir=work_dir, update_mode = update_mode)
\ No newline at end of file
+    S1_burst2safe(datadir=data_dir, workdir=work_dir, update_mode = update_mode, njobs=args.njobs,
+                  bbox=args.bbox, polarization=args.polarization)
\ No newline at end of file
@@ -2,7 +2,7 @@
 # copyRight Author : CAS-aircas Yisen 
 # time : 30/08/2025 Saturday
 # written in : Beijing China 
-# brief introduce : using dem.py to download Digital Elevation model, exp is .wgs84
+# brief introduce : download SRTMGL1 tiles and mosaic the Digital Elevation model, exp is .wgs84
 # sunny day in Beijing at 01/09/2025
 
 ## MudCreep : 35.83 35.90 -121.50 -121.38
@@ -11,34 +11,258 @@
 
 import os
 import sys
+import time
+import shutil
+import zipfile
+import tempfile
 import argparse
-import subprocess
+import numpy as np
+import requests
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+from joblib import Parallel, delayed
+from osgeo import gdal
 from cores.validation import S1ParameterValidator
+from lab_utils import S1_config, get_cache_dir, write_raw_sidecars
 from lab_utils import logo as show_logo 
 from reset import reset_dem_dir
 
-def download_S1_SLC_dem(lat_min, lat_max, lon_min, lon_max, dem_dir):
-    # download Digital Elevation Model using dem.py
+
+DEM_URL = S1_config['DEM_URL']
+EGM96_URL = S1_config['EGM96_URL']
+## SRTMGL1 : 1 arc-second tiles of 3601 x 3601 big-endian int16, the edge rows/cols are shared
+SRTM_SAMPLES = 3600
+SRTM_VOID = -32768
+DEM_BLOCK_ROWS = 512
+DEM_JOBS = 8
+
+
+def get_tile_name(lat, lon):
+    # SRTM tile name of the 1x1 degree tile with lower-left corner (lat, lon), e.g. N35W122
+    return f"{'N' if lat >= 0 else 'S'}{abs(lat):02d}{'E' if lon >= 0 else 'W'}{abs(lon):03d}"
+
+
+def make_temp_path(save_path):
+    # a per-process temporary file next to save_path, so processes sharing the cache never write the same file
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(save_path) + ".", suffix=".part",
+                                     dir=os.path.dirname(save_path) or ".")
+    os.close(fd)
+    return temp_path
+
+
+def fetch_url(url, save_path, session=None):
+    ############################################################
+    # fetch a http(s):// or file:// url to save_path through a per-process .part file
+    # <return> True if fetched, False if the url does not exist (e.g. ocean tiles)
+    ############################################################
+    part_path = make_temp_path(save_path)
+    parsed = urlparse(url)
+    try:
+        if parsed.scheme == "file":
+            src_path = url2pathname(parsed.path)
+            if not os.path.exists(src_path):
+                return False
+            shutil.copyfile(src_path, part_path)
+        else:
+            session = session or requests.Session()
+            with session.get(url, stream=True, timeout=666) as r:
+                if r.status_code == 404:
+                    return False
+                r.raise_for_status()
+                with open(part_path, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+        os.replace(part_path, save_path)
+        return True
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+def is_tile_missing(missing_path, dem_url):
+    # whether a <tile>.missing marker records the tile as missing on this mirror
+    if not os.path.exists(missing_path):
+        return False
+    with open(missing_path) as f:
+        return f.read().strip() == dem_url.rstrip('/')
+
+
+def fetch_srtm_tile(tile_name, cache_dir, dem_url=DEM_URL, session=None):
+    ############################################################
+    # fetch a SRTMGL1 tile into the shared tile cache, the .hgt is kept unzipped
+    # tiles missing on the mirror (ocean) are recorded as <tile>.missing holding the mirror url,
+    # a marker written for another mirror is ignored
+    # the zip and the .hgt are written through per-process temporary files
+    # <1> tile_name (str) : e.g. N35W122
+    # <2> cache_dir (str) : the shared tile cache directory
+    # <3> dem_url (str)   : the SRTMGL1 mirror, http(s):// or file:// (default : DEM_URL)
+    # <return> the cached .hgt path, None for a missing tile
+    ############################################################
+    hgt_path = os.path.join(cache_dir, f"{tile_name}.hgt")
+    missing_path = os.path.join(cache_dir, f"{tile_name}.missing")
+    if os.path.exists(hgt_path) and os.path.getsize(hgt_path) == (SRTM_SAMPLES + 1)**2 * 2:
+        os.utime(hgt_path)
+        return hgt_path
+    if is_tile_missing(missing_path, dem_url):
+        return None
+    zip_path = make_temp_path(os.path.join(cache_dir, f"{tile_name}.SRTMGL1.hgt.zip"))
+    try:
+        if not fetch_url(f"{dem_url.rstrip('/')}/{tile_name}.SRTMGL1.hgt.zip", zip_path, session):
+            print(f"tile {tile_name} not found on the mirror, fill it with 0")
+            with open(missing_path, 'w') as f:
+                f.write(dem_url.rstrip('/') + '\n')
+            return None
+        part_path = make_temp_path(hgt_path)
+        try:
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                member = [name for name in zip_ref.namelist() if name.endswith('.hgt')][0]
+                with zip_ref.open(member) as src, open(part_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+            os.replace(part_path, hgt_path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+    finally:
+        os.remove(zip_path)
+    print(f"fetched tile {tile_name}")
+    return hgt_path
+
+
+def evict_dem_cache(cache_dir, max_gb=None, max_age_days=None):
+    ############################################################
+    # evict the shared tile cache, first the tiles unused for max_age_days,
+    # then the least recently used tiles until the cache is below max_gb,
+    # the <tile>.missing markers older than max_age_days expire as well
+    # <1> cache_dir (str)      : the shared tile cache directory
+    # <2> max_gb (float)       : size limit (default : S1_config DEM_CACHE_MAX_GB)
+    # <3> max_age_days (float) : age limit (default : S1_config DEM_CACHE_MAX_AGE_DAYS)
+    ############################################################
+    max_gb = S1_config['DEM_CACHE_MAX_GB'] if max_gb is None else max_gb
+    max_age_days = S1_config['DEM_CACHE_MAX_AGE_DAYS'] if max_age_days is None else max_age_days
+    tiles = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.hgt')]
+    tiles.sort(key=os.path.getmtime)
+    total_bytes = sum(os.path.getsize(tile) for tile in tiles)
+    oldest_kept = time.time() - max_age_days * 86400
+    for marker in [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.missing')]:
+        if os.path.getmtime(marker) < oldest_kept:
+            os.remove(marker)
+    evicted = 0
+    for tile in tiles:
+        if os.path.getmtime(tile) >= oldest_kept and total_bytes <= max_gb * 1024**3:
+            break
+        total_bytes -= os.path.getsize(tile)
+        os.remove(tile)
+        evicted += 1
+    if evicted:
+        print(f"dem cache eviction: {evicted} tiles removed, {total_bytes/1024**3:.2f} GB kept")
+    return evicted
+
+
+def load_geoid_grid(cache_dir, egm96_url=EGM96_URL):
+    # load the EGM96 geoid undulation grid (cached), return (grid, lon_first, dlon, lat_first, dlat) of pixel centers
+    geoid_path = os.path.join(cache_dir, os.path.basename(urlparse(egm96_url).path))
+    if not os.path.exists(geoid_path) and not fetch_url(egm96_url, geoid_path):
+        raise FileNotFoundError(f"EGM96 geoid grid not found: {egm96_url}")
+    ds = gdal.Open(geoid_path, gdal.GA_ReadOnly)
+    x0, dx, _, y0, _, dy = ds.GetGeoTransform()
+    grid = ds.GetRasterBand(1).ReadAsArray().astype(np.float64)
+    ds = None
+    return grid, x0 + dx/2, dx, y0 + dy/2, dy
+
+
+def sample_geoid(geoid, lats, lons):
+    # bilinear geoid undulation on the grid lats (rows) x lons (cols)
+    grid, lon_first, dlon, lat_first, dlat = geoid
+    fy = np.clip((lats - lat_first) / dlat, 0, grid.shape[0] - 1)
+    fx = np.clip((lons - lon_first) / dlon, 0, grid.shape[1] - 1)
+    iy, ix = np.minimum(fy.astype(int), grid.shape[0] - 2), np.minimum(fx.astype(int), grid.shape[1] - 2)
+    wy, wx = (fy - iy)[:, None], (fx - ix)[None, :]
+    top = grid[iy][:, ix] * (1 - wx) + grid[iy][:, ix + 1] * wx
+    bottom = grid[iy + 1][:, ix] * (1 - wx) + grid[iy + 1][:, ix + 1] * wx
+    return top * (1 - wy) + bottom * wy
+
+
+def mosaic_dem_tiles(tile_paths, lat0, lat1, lon0, lon1, output_file, geoid=None, block_rows=DEM_BLOCK_ROWS):
+    ############################################################
+    # mosaic the SRTM tiles of [lat0, lat1] x [lon0, lon1] into an ISCE2 int16 DEM,
+    # written row block by row block with its .xml/.vrt
+    # <1> tile_paths (dict)    : {(lat, lon): .hgt path or None}
+    # <2~5> lat0, lat1, lon0, lon1 (int): integer degree bounds of the mosaic
+    # <6> output_file (str)    : the output DEM
+    # <7> geoid (tuple)        : the EGM96 grid of load_geoid_grid, heights are converted to the
+    #                            WGS84 ellipsoid if given
+    # <8> block_rows (int)     : number of rows per written block
+    ############################################################
+    nlat, nlon = lat1 - lat0, lon1 - lon0
+    length, width = nlat * SRTM_SAMPLES + 1, nlon * SRTM_SAMPLES + 1
+    delta = 1.0 / SRTM_SAMPLES
+    tiles = {
+        key: np.memmap(path, dtype='>i2', mode='r', shape=(SRTM_SAMPLES + 1, SRTM_SAMPLES + 1))
+        for key, path in tile_paths.items() if path is not None
+    }
+    lons = lon0 + np.arange(width) * delta
+    with open(output_file, 'wb') as out:
+        for y0 in range(0, length, block_rows):
+            y1 = min(y0 + block_rows, length)
+            block = np.zeros((y1 - y0, width), dtype=np.int16)
+            for k in range(y0 // SRTM_SAMPLES, min((y1 - 1) // SRTM_SAMPLES, nlat - 1) + 1):
+                ## tile row k covers the output rows k*3600 .. k*3600+3600 (shared edge row)
+                r0, r1 = max(y0, k * SRTM_SAMPLES), min(y1, k * SRTM_SAMPLES + SRTM_SAMPLES + 1)
+                for j in range(nlon):
+                    tile = tiles.get((lat1 - 1 - k, lon0 + j))
+                    if tile is not None:
+                        block[r0 - y0:r1 - y0, j * SRTM_SAMPLES:(j + 1) * SRTM_SAMPLES + 1] = \
+                            tile[r0 - k * SRTM_SAMPLES:r1 - k * SRTM_SAMPLES]
+            if geoid is not None:
+                ## keep the SRTM voids (-32768) out of the geoid correction, they would wrap around int16
+                lats = lat1 - np.arange(y0, y1) * delta
+                void = block == SRTM_VOID
+                block = np.round(block + sample_geoid(geoid, lats, lons)).astype(np.int16)
+                block[void] = SRTM_VOID
+            out.write(block.astype('<i2').tobytes())
+    write_raw_sidecars(output_file, "dem", width, length, 1, np.dtype('<i2'),
+                       coords=[(float(lon0), delta), (float(lat1), -delta)],
+                       props={"family": "demimage", "reference": "WGS84" if geoid is not None else "EGM96"})
+    print(f"DEM mosaic {output_file} finished ({length} x {width})")
+
+
+def download_S1_SLC_dem(lat_min, lat_max, lon_min, lon_max, dem_dir, dem_url=DEM_URL,
+                        cache_dir=None, buffer_deg=1, njobs=None, egm96_url=EGM96_URL):
+    # download Digital Elevation Model : fetch SRTMGL1 tiles into the shared tile cache
+    # and mosaic them to the ISCE2 demLat_*_Lon_*.dem.wgs84 
     # <1> lat_min (float): minimum latitude (south)
     # <2> lat_max (float): maximum latitude (north)  
     # <3> lon_min (float): minimum longitude (west)
     # <4> lon_max (float): maximum longitude (east)
     # <5> dem_dir (str): output directory for DEM files
+    # <6> dem_url (str): SRTMGL1 mirror, http(s):// or file:// (default : DEM_URL)
+    # <7> cache_dir (str): shared tile cache (default : the "dem/SRTMGL1" directory of the IntfLab cache)
+    # <8> buffer_deg (int): buffer around the bbox in degrees, the stack covers whole bursts (default : 1)
+    # <9> njobs (int): number of parallel tile fetches (default : DEM_JOBS)
+    # <10> egm96_url (str): EGM96 geoid grid, http(s):// or file:// (default : EGM96_URL)
     ## create dem directory
     if not os.path.exists(dem_dir):
         os.mkdir(dem_dir)
-    os.chdir(dem_dir)
+    if cache_dir is None:
+        cache_dir = get_cache_dir(os.path.join("dem", "SRTMGL1"))
+    os.makedirs(cache_dir, exist_ok=True)
     ## make lat/lon buffer
-    lat_min_dem = int(float(lat_min)) - 1
-    lat_max_dem = int(float(lat_max)) + 1
-    lon_min_dem = int(float(lon_min)) - 1
-    lon_max_dem = int(float(lon_max)) + 1
-        
-    ## command
-    log_file = os.path.join(dem_dir, "dem_download.log")
-    cmd = f"dem.py -b {str(lat_min_dem)} {str(lat_max_dem)} {str(lon_min_dem)} {str(lon_max_dem)} -r -s 1 -u http://step.esa.int/auxdata/dem/SRTMGL1/ -c > {log_file}"
-    print(f"Running command {cmd}")
-    os.system(cmd)
+    lat0 = int(np.floor(float(lat_min))) - buffer_deg
+    lat1 = int(np.ceil(float(lat_max))) + buffer_deg
+    lon0 = int(np.floor(float(lon_min))) - buffer_deg
+    lon1 = int(np.ceil(float(lon_max))) + buffer_deg
+    keys = [(lat, lon) for lat in range(lat0, lat1) for lon in range(lon0, lon1)]
+    print(f"fetching {len(keys)} SRTMGL1 tiles of [{lat0}, {lat1}] x [{lon0}, {lon1}] from {dem_url}")
+    session = requests.Session()
+    paths = Parallel(n_jobs=min(njobs or DEM_JOBS, len(keys)), prefer="threads")(
+        delayed(fetch_srtm_tile)(get_tile_name(lat, lon), cache_dir, dem_url, session) for lat, lon in keys
+    )
+    ## mosaic straight to the ellipsoid heights 
+    geoid = load_geoid_grid(cache_dir, egm96_url)
+    name = f"demLat_{get_tile_name(lat0, 0)[:3]}_{get_tile_name(lat1, 0)[:3]}" \
+           f"_Lon_{get_tile_name(0, lon0)[3:]}_{get_tile_name(0, lon1)[3:]}.dem.wgs84"
+    mosaic_dem_tiles(dict(zip(keys, paths)), lat0, lat1, lon0, lon1, os.path.join(dem_dir, name), geoid=geoid)
+    evict_dem_cache(cache_dir)
     
 
 def create_parser():
@@ -61,6 +285,12 @@ def create_parser():
                         help='show the logo of IntfLab (default : False)')
     parser.add_argument('--reset', action='store_true', default=False,
                         help='whether reset the DEM directory (default : False)')
+    parser.add_argument('--dem-url', type=str, default=DEM_URL,
+                        help=f'SRTMGL1 tile mirror, http(s):// or file:// (default : {DEM_URL})')
+    parser.add_argument('--egm96-url', type=str, default=EGM96_URL,
+                        help=f'EGM96 geoid grid, http(s):// or file:// (default : {EGM96_URL})')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='shared DEM tile cache directory (default : $INTFLAB_CACHE_DIR/dem/SRTMGL1)')
     return parser
 
 
@@ -84,4 +314,6 @@ if __name__ == "__main__":
         print(f"reset mode is :{reset}")
         reset_dem_dir(dem_dir)
         
-    download_S1_SLC_dem(lat_min, lat_max, lon_min, lon_max, dem_dir)
\ No newline at end of file
+    download_S1_SLC_dem(lat_min, lat_max, lon_min, lon_max, dem_dir,
+                        dem_url=args.dem_url, cache_dir=args.cache_dir,
+                        egm96_url=args.egm96_url)
\ No newline at end of file
@@ -5,40 +5,102 @@
 #############################
 
 import os
+import re
 import sys
-import glob
+import time
+import bisect
+import shutil
+import sqlite3
+import hashlib
 import requests
 import argparse
+import xml.etree.ElementTree as ET
 from datetime import datetime, timedelta
-from multiprocessing import cpu_count
 from joblib import Parallel, delayed
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from lab_utils import S1_config
+from lab_utils import S1_config, get_cache_dir, query_scenes, cache_lock
 from lab_utils import logo as show_logo
 from reset import reset_orbit_dir
 
 
-def download_file(session, task):
+ORBIT_URL = S1_config['ORBIT_URL']
+ORBIT_CATALOG_NAME = "orbit_catalog.sqlite"
+ORBIT_MAX_VALIDITY = timedelta(days=2)
+ORBIT_PATTERN = re.compile(r'S1[ABCD]_OPER_AUX_POEORB_OPOD_\d{8}T\d{6}_V(\d{8}T\d{6})_(\d{8}T\d{6})\.EOF')
+DOWNLOAD_JOBS = 8
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+SAFE_PATTERN = re.compile(r'^(S1[ABCD])_.*?_(\d{8}T\d{6})_(\d{8}T\d{6})_')
+
+
+def download_file(session, task, chunk_size=DOWNLOAD_CHUNK_SIZE):
     ############################################################
     # download the orbit files 
+    # the file is written to save_path.part and renamed when complete, an existing
+    # .part file of an interrupted download is resumed with a HTTP Range request,
+    # the .part file is locked (cache_lock) so two processes never append to the same one,
+    # a save_path completed by another process meanwhile is not downloaded again
     # <1> session (requests.session): the session between user and net
-    # <2> task (list): the task of download files 
+    # <2> task (list): the task of download files (file_url, save_path)
+    # <3> chunk_size (int): the stream chunk size in bytes
+    # <return> (bool, int): whether the download succeeded, bytes transferred
     ############################################################
     file_url, save_path = task
+    part_path = save_path + ".part"
+    nbytes = 0
     try:
-        with session.get(file_url, stream=True, timeout=666) as r:
-            r.raise_for_status()
-            with open(save_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+        with cache_lock(part_path):
+            if os.path.exists(save_path) and not os.path.exists(part_path):
+                print(f"{os.path.basename(save_path)} was downloaded by another process")
+                return True, nbytes
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            with session.get(file_url, stream=True, timeout=666, headers=headers) as r:
+                ## 416 : the .part file already holds the whole file
+                if not (offset and r.status_code == 416):
+                    r.raise_for_status()
+                    ## 206 : the server resumes from offset, 200 : the server sends the whole file again
+                    mode = 'ab' if r.status_code == 206 else 'wb'
+                    with open(part_path, mode) as f:
+                        for chunk in r.iter_content(chunk_size=chunk_size):
+                            if chunk:
+                                f.write(chunk)
+                                nbytes += len(chunk)
+            os.replace(part_path, save_path)
         print(f"Downloaded: {os.path.basename(save_path)}")
+        return True, nbytes
     except Exception as e:
         print(f"Failed to download {file_url}: {e}")
+        return False, nbytes
+
+
+def download_file_list(session, download_tasks, njobs=None):
+    ############################################################
+    # download files on a thread pool sharing the pooled session
+    # <1> session (requests.session): the session created by create_session
+    # <2> download_tasks (list): [(file_url, save_path)]
+    # <3> njobs (int): number of download threads (default : DOWNLOAD_JOBS)
+    # <return> (int, int): number of files downloaded, number of failures
+    ############################################################
+    if not download_tasks:
+        print("nothing to download.")
+        return 0, 0
+    njobs = min(njobs or DOWNLOAD_JOBS, len(download_tasks))
+    print(f"starting parallel download of {len(download_tasks)} files with {njobs} threads...")
+    start = time.time()
+    results = Parallel(n_jobs=njobs, prefer="threads")(
+        delayed(download_file)(session, task) for task in download_tasks
+    )
+    elapsed = max(time.time() - start, 1e-6)
+    n_done = sum(1 for ok, _ in results if ok)
+    total_bytes = sum(nbytes for _, nbytes in results)
+    print(f"downloaded {n_done}/{len(download_tasks)} files, {total_bytes/1024**2:.1f} MB "
+          f"in {elapsed:.1f} s ({total_bytes/1024**2/elapsed:.2f} MB/s)")
+    return n_done, len(download_tasks) - n_done
 
 
-def create_session():
+def create_session(pool_size=DOWNLOAD_JOBS):
+    # one session shared by the download threads, pool_size keep-alive connections per host
     session = requests.Session()
     retries = Retry(
         total=5,                
@@ -46,61 +108,314 @@ def create_session():
         status_forcelist=[500, 502, 503, 504],
         allowed_methods=["GET"]
     )
-    session.mount("https://", HTTPAdapter(max_retries=retries))
+    adapter = HTTPAdapter(max_retries=retries, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
     session.headers.update({"User-Agent": "Mozilla/5.0"})
     return session
 
-def get_response(session):
-    resp = session.get(ORBIT_URL, timeout=666).content
-    lst = [str(i[:77])[2:-1] for i in resp.split(b'href="')]
-    return lst
+def parse_orbit_listing(content):
+    # find the POEORB file names in the html listing of ORBIT_URL
+    text = content.decode('utf-8', errors='ignore')
+    return sorted(set(match.group(0) for match in ORBIT_PATTERN.finditer(text)))
+
+
+def get_response(session, orbit_url=ORBIT_URL):
+    resp = session.get(orbit_url, timeout=666).content
+    return parse_orbit_listing(resp)
+
+
+def parse_orbit_name(filename):
+    # parse mission and validity start/stop of a POEORB file name
+    # S1A_OPER_AUX_POEORB_OPOD_20230121T080725_V20221231T225942_20230102T005942.EOF
+    # <return> (mission, start, stop) as strings, start/stop as YYYYmmddTHHMMSS; None if not an orbit file
+    match = ORBIT_PATTERN.fullmatch(filename)
+    if match is None:
+        return None
+    return filename[:3], match.group(1), match.group(2)
+
+
+def parse_safe_name(safe_file):
+    # parse mission and sensing start/stop of a S1 SAFE name
+    # S1A_IW_SLC__1SDV_20230101T101010_20230101T101037_046594_059596_8DF0.SAFE
+    # <return> (mission, start, stop) as strings, None if not a S1 SAFE name
+    match = SAFE_PATTERN.search(os.path.basename(safe_file))
+    if match is None:
+        return None
+    return match.group(1), match.group(2), match.group(3)
+
+
+def open_orbit_catalog(catalog_file):
+    # open (create) the sqlite orbit catalog
+    # table orbits : filename, mission, validity start, validity stop
+    # table cache  : the orbit files in the shared cache, stored as objects/<sha256>
+    # table meta   : the etag / last-modified of the last listing download
+    conn = sqlite3.connect(catalog_file, timeout=60)
+    conn.execute("CREATE TABLE IF NOT EXISTS orbits (filename TEXT PRIMARY KEY, mission TEXT, start TEXT, stop TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS cache (filename TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, last_used REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS orbits_mission_start ON orbits (mission, start)")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+
+def update_orbit_catalog(session, catalog_file, orbit_url=ORBIT_URL):
+    ############################################################
+    # refresh the orbit catalog from the ASF listing with a conditional request,
+    # the listing is only downloaded and parsed when it changed (ETag / Last-Modified)
+    # <1> session (requests.session) : the session between user and net
+    # <2> catalog_file (str)         : the sqlite orbit catalog
+    # <3> orbit_url (str)            : the orbit listing url (default : ORBIT_URL)
+    # <return> number of new orbit files in the catalog
+    ############################################################
+    conn = open_orbit_catalog(catalog_file)
+    meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+    headers = {}
+    if 'etag' in meta:
+        headers['If-None-Match'] = meta['etag']
+    if 'last_modified' in meta:
+        headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        resp = session.get(orbit_url, headers=headers, timeout=666)
+        resp.raise_for_status()
+    except Exception as e:
+        print(f"WARNING: could not refresh the orbit catalog, using the local one: {e}")
+        conn.close()
+        return 0
+    if resp.status_code == 304:
+        print("orbit listing not modified, using the local orbit catalog")
+        conn.close()
+        return 0
+    rows = []
+    for filename in parse_orbit_listing(resp.content):
+        mission, start, stop = parse_orbit_name(filename)
+        rows.append((filename, mission, start, stop))
+    with conn:
+        n_before = conn.execute("SELECT COUNT(*) FROM orbits").fetchone()[0]
+        conn.executemany("INSERT OR IGNORE INTO orbits VALUES (?, ?, ?, ?)", rows)
+        n_after = conn.execute("SELECT COUNT(*) FROM orbits").fetchone()[0]
+        for key, header in (('etag', 'ETag'), ('last_modified', 'Last-Modified')):
+            if header in resp.headers:
+                conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, resp.headers[header]))
+    conn.close()
+    print(f"orbit catalog updated: {n_after - n_before} new orbit files, {n_after} in total")
+    return n_after - n_before
+
+
+def load_orbit_index(catalog_file):
+    # load the catalog as {mission: (sorted validity starts, [(start, stop, filename)])} for bisect lookups
+    conn = open_orbit_catalog(catalog_file)
+    index = {}
+    for filename, mission, start, stop in conn.execute(
+            "SELECT filename, mission, start, stop FROM orbits ORDER BY mission, start, filename"):
+        starts, entries = index.setdefault(mission, ([], []))
+        starts.append(start)
+        entries.append((start, stop, filename))
+    conn.close()
+    return index
 
 
-def download_S1_SLC_orbit_list(SLC_dir, orbits_dir, update_mode):
+def find_orbit(orbit_index, mission, start, stop):
+    ############################################################
+    # binary-search the orbit file covering [start, stop] of a scene
+    # <1> orbit_index (dict) : see load_orbit_index
+    # <2> mission (str)      : S1A / S1B / S1C
+    # <3> start, stop (str)  : sensing start/stop YYYYmmddTHHMMSS
+    # <return> the covering orbit file name (latest validity start if several), None if not found
+    ############################################################
+    if mission not in orbit_index:
+        return None
+    starts, entries = orbit_index[mission]
+    ## POEORB files are valid ~26 hours, only the few entries starting before the scene are candidates
+    earliest = (datetime.strptime(start, '%Y%m%dT%H%M%S') - ORBIT_MAX_VALIDITY).strftime('%Y%m%dT%H%M%S')
+    i = bisect.bisect_right(starts, start)
+    for j in range(i - 1, bisect.bisect_left(starts, earliest) - 1, -1):
+        orbit_start, orbit_stop, filename = entries[j]
+        if orbit_stop >= stop:
+            return filename
+    return None
+
+
+def validate_orbit_file(path, filename):
+    # check that an orbit file is well-formed xml and its validity window matches its name
+    try:
+        root = ET.parse(path).getroot()
+        start = root.findtext('.//Validity_Start').strip()
+        stop = root.findtext('.//Validity_Stop').strip()
+    except (ET.ParseError, AttributeError, OSError):
+        return False
+    _, name_start, name_stop = parse_orbit_name(filename)
+    ## UTC=2022-12-31T22:59:42 -> 20221231T225942
+    to_compact = lambda value: re.sub(r'[-:]', '', value.replace('UTC=', ''))[:15]
+    return to_compact(start) == name_start and to_compact(stop) == name_stop
+
+
+def get_cached_orbit(conn, cache_dir, filename):
+    # return the path of a valid cached orbit file, corrupt entries are dropped from the cache
+    row = conn.execute("SELECT sha256, size FROM cache WHERE filename = ?", (filename,)).fetchone()
+    if row is None:
+        return None
+    sha256, size = row
+    path = os.path.join(cache_dir, "objects", sha256)
+    if os.path.exists(path) and os.path.getsize(path) == size and validate_orbit_file(path, filename):
+        with conn:
+            conn.execute("UPDATE cache SET last_used = ? WHERE filename = ?", (time.time(), filename))
+        return path
+    print(f"WARNING: cached orbit file {filename} is corrupt, download it again")
+    with conn:
+        conn.execute("DELETE FROM cache WHERE filename = ?", (filename,))
+    return None
+
+
+def touch_cached_orbits(conn, filenames):
+    # mark cached orbit files as used now, so the eviction keeps the ones the projects still link
+    now = time.time()
+    with conn:
+        conn.executemany("UPDATE cache SET last_used = ? WHERE filename = ?",
+                         [(now, filename) for filename in filenames])
+
+
+def add_orbit_to_cache(conn, cache_dir, filename, src_path):
+    # move a downloaded orbit file into the content-addressed cache, return its cache path (None if invalid)
+    if not validate_orbit_file(src_path, filename):
+        print(f"WARNING: downloaded orbit file {filename} is invalid, drop it")
+        os.remove(src_path)
+        return None
+    sha = hashlib.sha256()
+    with open(src_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    sha256 = sha.hexdigest()
+    path = os.path.join(cache_dir, "objects", sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(src_path, path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                     (filename, sha256, os.path.getsize(path), time.time()))
+    return path
+
+
+def link_orbit_file(cache_path, orbit_path):
+    # hardlink a cached orbit file into the project, symlink across filesystems
+    try:
+        os.link(cache_path, orbit_path)
+    except OSError:
+        os.symlink(cache_path, orbit_path)
+
+
+def evict_orbit_cache(cache_dir, max_gb=None, max_age_days=None):
+    ############################################################
+    # evict the shared orbit cache, first the files unused for max_age_days,
+    # then the least recently used files until the cache is below max_gb
+    # hardlinked project copies are kept, symlinked ones are downloaded again if needed
+    # <1> cache_dir (str)      : the shared orbit cache directory
+    # <2> max_gb (float)       : size limit (default : S1_config ORBIT_CACHE_MAX_GB)
+    # <3> max_age_days (float) : age limit (default : S1_config ORBIT_CACHE_MAX_AGE_DAYS)
+    ############################################################
+    max_gb = S1_config['ORBIT_CACHE_MAX_GB'] if max_gb is None else max_gb
+    max_age_days = S1_config['ORBIT_CACHE_MAX_AGE_DAYS'] if max_age_days is None else max_age_days
+    conn = open_orbit_catalog(os.path.join(cache_dir, ORBIT_CATALOG_NAME))
+    rows = conn.execute("SELECT filename, sha256, size, last_used FROM cache ORDER BY last_used").fetchall()
+    total_bytes = sum(row[2] for row in rows)
+    oldest_kept = time.time() - max_age_days * 86400
+    evicted = 0
+    with conn:
+        for filename, sha256, size, last_used in rows:
+            if last_used >= oldest_kept and total_bytes <= max_gb * 1024**3:
+                break
+            path = os.path.join(cache_dir, "objects", sha256)
+            if os.path.exists(path):
+                os.remove(path)
+            conn.execute("DELETE FROM cache WHERE filename = ?", (filename,))
+            total_bytes -= size
+            evicted += 1
+    conn.close()
+    if evicted:
+        print(f"orbit cache eviction: {evicted} files removed, {total_bytes/1024**2:.1f} MB kept")
+    return evicted
+
+
+def download_S1_SLC_orbit_list(SLC_dir, orbits_dir, update_mode, cache_dir=None,
+                               orbit_url=ORBIT_URL, njobs=None, safe_names=None):
     ############################################################
     # download S1*.zip orbit files 
+    # the files are kept in a cache shared by all projects and linked into orbits_dir
     # <1> SLC_dir (str)          :  the SLC_dir directory of the S1*.zip 
     # <2> orbits_dir (str)       :  the orbit files output directory 
     # <3> update_mode (str)      :  whether ignore the exist files , delete and update overwrite it
+    # <4> cache_dir (str)        :  the shared orbit cache holding the sqlite orbit catalog
+    #                               (default : the "orbits" directory of the IntfLab cache)
+    # <5> orbit_url (str)        :  the orbit listing/download url (default : ORBIT_URL)
+    # <6> njobs (int)            :  number of download threads (default : DOWNLOAD_JOBS)
+    # <7> safe_names (list)      :  SAFE names to find the orbits of instead of the S1*.SAFE of SLC_dir,
+    #                               e.g. the names of the zips still being extracted
     ############################################################
     download_tasks = list()
+    link_tasks = list()
+    linked_files = list()
     if not os.path.exists(orbits_dir):
         os.mkdir(orbits_dir)
-    ## create data list 
+    if cache_dir is None:
+        cache_dir = get_cache_dir("orbits")
+    catalog_file = os.path.join(cache_dir, ORBIT_CATALOG_NAME)
+    ## refresh the local catalog 
     session = create_session()
-    lst = get_response(session=session)
+    update_orbit_catalog(session, catalog_file, orbit_url)
+    orbit_index = load_orbit_index(catalog_file)
     ## S1_pattern directorys
-    S1_dir = os.path.join(SLC_dir, "S1*.SAFE")
-    for file in glob.glob(S1_dir):
-        date_str = file.split('_')[-5][:8]
-        y, m, d = int(date_str[:4]),  int(date_str[4:6]),  int(date_str[6:8])
-        dt = datetime(y, m, d)
-        prev_dt = dt - timedelta(days=1)
-        next_dt = dt + timedelta(days=1)
-        prev_dt_str = f'{prev_dt.year}{prev_dt.month:02d}{prev_dt.day:02d}'
-        next_dt_str = f'{next_dt.year}{next_dt.month:02d}{next_dt.day:02d}'
-        
-        for filename in lst:
-            orbit_path = os.path.join(orbits_dir, filename)
-            if os.path.exists(orbit_path):
-                if update_mode:
-                    cmd = f"rm -rf {orbit_path}"
-                    print(f"update_mode: {update_mode}, Running Command : {cmd}")
-                    os.system(cmd)
-                else:
-                    print(f"update_mode: {update_mode}, pass it and continue")
-                    continue
-            if (filename[-35:-27] == prev_dt_str) and (filename[-19:-11] == next_dt_str):
-                download_tasks.append((
-                f"{ORBIT_URL}{filename}",
-                        orbit_path
-                        ))  
-                        
-    njobs = min(max(cpu_count() // 4, 2), 8)
-    print(f"starting parallel download with {njobs} jobs...")
-    Parallel(n_jobs=njobs)(
-        delayed(download_file)(session, task) for task in download_tasks
-    )
+    if safe_names is None:
+        safe_files = [scene["path"] for scene in query_scenes(SLC_dir, kind="SAFE")]
+    else:
+        safe_files = sorted(safe_names)
+    for file in safe_files:
+        scene = parse_safe_name(file)
+        if scene is None:
+            print(f"WARNING: can not parse the SAFE name {os.path.basename(file)}, skip it")
+            continue
+        filename = find_orbit(orbit_index, *scene)
+        if filename is None:
+            print(f"WARNING: no POEORB orbit file found for {os.path.basename(file)}")
+            continue
+        orbit_path = os.path.join(orbits_dir, filename)
+        ## a symlink to a cache file removed by evict_orbit_cache is linked again
+        if os.path.lexists(orbit_path) and not os.path.exists(orbit_path):
+            print(f"{filename} links to an evicted cache file, link it again")
+            os.remove(orbit_path)
+        if os.path.exists(orbit_path):
+            if update_mode:
+                print(f"update_mode: {update_mode}, remove {filename}")
+                os.remove(orbit_path)
+            else:
+                print(f"update_mode: {update_mode}, {filename} exists, pass it and continue")
+                linked_files.append(filename)
+                continue
+        if (filename, orbit_path) not in link_tasks:
+            link_tasks.append((filename, orbit_path))
+
+    ## download the orbit files missing in the shared cache
+    conn = open_orbit_catalog(catalog_file)
+    touch_cached_orbits(conn, linked_files)
+    cached = {filename: get_cached_orbit(conn, cache_dir, filename) for filename, _ in link_tasks}
+    download_dir = os.path.join(cache_dir, "downloading")
+    os.makedirs(download_dir, exist_ok=True)
+    for filename, path in cached.items():
+        if path is None:
+            download_tasks.append((f"{orbit_url}{filename}", os.path.join(download_dir, filename)))
+    print(f"{len(cached) - len(download_tasks)} orbit files found in the cache {cache_dir}")
+    download_file_list(session, download_tasks, njobs)
+    for _, save_path in download_tasks:
+        filename = os.path.basename(save_path)
+        ## another process may have moved the same download into the cache meanwhile
+        with cache_lock(save_path + ".part"):
+            cached[filename] = get_cached_orbit(conn, cache_dir, filename)
+            if cached[filename] is None and os.path.exists(save_path):
+                cached[filename] = add_orbit_to_cache(conn, cache_dir, filename, save_path)
+    conn.close()
+    ## link the cached files into the project
+    for filename, orbit_path in link_tasks:
+        if cached[filename] is not None:
+            link_orbit_file(cached[filename], orbit_path)
+    print(f"{sum(1 for path in cached.values() if path)}/{len(cached)} orbit files linked to {orbits_dir}")
+    evict_orbit_cache(cache_dir)
     print("all downloads finished.")
 
 
@@ -120,14 +435,17 @@ def create_parser():
                         help='whether reset the orbits directory (default : False)')
     parser.add_argument('--logo', action='store_true', default=False,
                         help='show the logo of IntfLab (default : False)')
+    parser.add_argument('--orbit-url', type=str, default=ORBIT_URL,
+                        help=f'orbit listing/download url (default : {ORBIT_URL})')
+    parser.add_argument('--njobs', type=int, default=None,
+                        help=f'number of download threads (default : {DOWNLOAD_JOBS})')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='shared orbit cache directory (default : $INTFLAB_CACHE_DIR/orbits)')
     return parser
 
 
     
 if __name__ == '__main__':
-    # basic information 
-    global ORBIT_URL
-    ORBIT_URL = S1_config['ORBIT_URL']
     # create parser
     parser = create_parser()
     args = parser.parse_args()
@@ -141,6 +459,9 @@ if __name__ == '__main__':
         reset_orbit_dir(orbit_dir=orbit_dir)
     # download orbit files
     download_S1_SLC_orbit_list(SLC_dir, orbit_dir, 
-                               update_mode=update_mode
+                               update_mode=update_mode,
+                               cache_dir=args.cache_dir,
+                               orbit_url=args.orbit_url,
+                               njobs=args.njobs
                                )
     
\ No newline at end of file
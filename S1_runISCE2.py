@@ -7,10 +7,16 @@
 #############################
 
 import os
+import re
 import sys
+import csv
 import glob
+import json
+import time
+import hashlib
 import argparse
 import subprocess
+import xml.etree.ElementTree as ET
 from pathlib import Path
 from multiprocessing import cpu_count
 
@@ -33,7 +39,7 @@ def find_run_files(run_files_dir):
     return sorted([str(f) for f in run_files])
 
 
-def run_stack_processing(run_files_dir, cores=None, expected_files=16):
+def run_stack_processing(run_files_dir, cores=None, expected_files=16, resume=True, mem_budget=None):
     """
     Execute ISCE2 stack processing runfiles using run.py
     
@@ -41,6 +47,8 @@ def run_stack_processing(run_files_dir, cores=None, expected_files=16):
         run_files_dir (str): Directory containing run files
         cores (int): Number of CPU cores to use
         expected_files (int): Expected number of run files
+        resume (bool): Skip the run files completed in the journal
+        mem_budget (float): Memory (GB) for the parallel lines of a step, bounds -p per step
         
     Returns:
         bool: True if all files processed successfully
@@ -48,7 +56,7 @@ def run_stack_processing(run_files_dir, cores=None, expected_files=16):
     
     # Auto-detect cores if not specified
     if cores is None:
-        cores = min(max(cpu_count() // 2, 1), 8)
+        cores = get_max_workers()
     
     print(f"Stack processing parameters:")
     print(f"  Run files directory: {run_files_dir}")
@@ -65,18 +73,19 @@ def run_stack_processing(run_files_dir, cores=None, expected_files=16):
     print(f"  Found run files: {len(scripts)}")
     
     if len(scripts) != expected_files:
-        print(f"WARNING: Expected {expected_files} run files but found {len(scripts)}")
-        response = input("Do you want to continue? (y/N): ").lower().strip()
-        if response != 'y':
-            print("Processing cancelled by user")
-            return False
+        print(f"WARNING: Expected {expected_files} run files but found {len(scripts)}, continue")
     
     # Create logs directory
     logs_dir = Path(run_files_dir) / 'logs'
     logs_dir.mkdir(exist_ok=True)
+    journal_file = logs_dir / JOURNAL_NAME
+    finished = load_journal(journal_file) if resume else {}
+    mem_budget_gb = get_memory_budget_gb(mem_budget)
+    step_memory = load_step_memory(logs_dir)
     
     success_count = 0
     total_files = len(scripts)
+    profile = []
     
     # Process each run file
     for i in range(1, expected_files + 1):
@@ -90,31 +99,63 @@ def run_stack_processing(run_files_dir, cores=None, expected_files=16):
         script = matched_scripts[0]
         script_name = os.path.basename(script)
         log_file = logs_dir / f"log_run{i:02d}.log"
+        with open(script, "r") as f:
+            fingerprint = get_task_fingerprint(f.read(), run_files_dir)
+        record = finished.get((script_name, 0))
+        if is_journal_done(record, fingerprint, run_files_dir):
+            print(f"✓ {script_name} already completed, skip it")
+            success_count += 1
+            continue
         
         print(f"\n{'='*60}")
         print(f"Step {i:02d}/{expected_files}: Processing {script_name}")
         print(f"{'='*60}")
         
+        # Bound the parallel lines of the step by the memory budget
+        step_cores = cores
+        if mem_budget_gb is not None:
+            commands = [line for group in parse_run_file(script) for line in group]
+            if commands:
+                mem_gb = estimate_task_memory(get_step_name(script), commands[0], run_files_dir, step_memory)
+                step_cores = max(1, min(cores, int(mem_budget_gb // mem_gb)))
+                print(f"  {len(commands)} lines, ~{mem_gb:.1f} GB each, parallel lines: {step_cores}")
+        
         # Build command
-        cmd = ["run.py", "--input", script, "-p", str(cores)]
+        cmd = ["run.py", "--input", script, "-p", str(step_cores)]
         
+        start = time.time()
         try:
             with open(log_file, "w") as f:
-                result = subprocess.run(
+                proc = subprocess.Popen(
                     cmd, 
                     stdout=f, 
                     stderr=subprocess.STDOUT, 
-                    check=True,
                     cwd=run_files_dir
                 )
+                usage = wait_profiled(proc, block=True)
+            end = time.time()
+            profile.append(dict(usage, step=get_step_name(script), script=script_name, line=0,
+                                start=start, end=end, wall_time=end - start, cmd=" ".join(cmd)))
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+            commands = [line for group in parse_run_file(script) for line in group]
+            append_journal(journal_file, {"script": script_name, "line": 0, "status": "done",
+                                          "start": start, "runtime": time.time() - start,
+                                          "returncode": 0, "fingerprint": fingerprint,
+                                          "outputs": get_task_outputs(get_step_name(script), commands,
+                                                                      run_files_dir, start)})
             
             print(f"✓ {script_name} completed successfully")
             print(f"  Log saved to: {log_file}")
             success_count += 1
             
         except subprocess.CalledProcessError as e:
+            append_journal(journal_file, {"script": script_name, "line": 0, "status": "failed",
+                                          "start": start, "runtime": time.time() - start,
+                                          "returncode": e.returncode, "fingerprint": fingerprint})
             print(f"✗ ERROR: {script_name} execution failed (return code: {e.returncode})")
             print(f"  Check log file for details: {log_file}")
+            write_profile(profile, logs_dir)
             return False
         except FileNotFoundError:
             print(f"✗ ERROR: run.py not found. Please ensure ISCE2 is installed and in PATH.")
@@ -129,10 +170,582 @@ def run_stack_processing(run_files_dir, cores=None, expected_files=16):
     print(f"  Success rate: {success_count/total_files*100:.1f}%")
     print(f"  Logs directory: {logs_dir}")
     print(f"{'='*60}")
+    write_profile(profile, logs_dir)
     
     return success_count == len([s for s in scripts if any(f'run_{i:02d}' in os.path.basename(s) for i in range(1, expected_files + 1))])
 
 
+## how a stackSentinel step waits for the previous steps, the other steps wait for all the previous steps
+##  []      : no dependency, e.g. unpacking the secondaries does not need the reference
+##  "keyed" : each line only waits for the line of the previous step with the same date / date pair
+STEP_DEPENDENCIES = {
+    "unpack_topo_reference" : [],
+    "unpack_secondary_slc"  : [],
+    "overlap_resample"      : "keyed",
+    "fullBurst_resample"    : "keyed",
+    "merge_burst_igram"     : "keyed",
+    "filter_coherence"      : "keyed",
+    "unwrap"                : "keyed",
+}
+## per-line completion journal in run_files/logs, one json record per finished line
+JOURNAL_NAME = "journal.jsonl"
+## output directories (relative to the stack work directory) of the steps whose lines name no date / date pair,
+## the outputs of the other lines are looked up in the directories named by their date / date pair
+STEP_OUTPUT_DIRS = {
+    "unpack_topo_reference"         : ["reference", "geom_reference"],
+    "extract_burst_overlaps"        : ["reference"],
+    "timeseries_misreg"             : ["misreg"],
+    "merge_reference_secondary_slc" : ["merged/geom_reference"],
+}
+## memory reserved per run-file line when sizing the pool
+DEFAULT_TASK_MEM_GB = 2.0
+POLL_INTERVAL = 0.2
+## memory model of a run-file line : (size, bytes per pixel), the size is
+##  "burst"  : pixels of the largest reference burst
+##  "scene"  : full-resolution pixels of the merged scene
+##  "looked" : pixels of the scene after nalks x nrlks multilooking
+## the steps not listed reserve DEFAULT_TASK_MEM_GB
+STEP_MEMORY_MODEL = {
+    "unpack_topo_reference"         : ("burst", 40),
+    "unpack_secondary_slc"          : ("burst", 16),
+    "fullBurst_geo2rdr"             : ("burst", 48),
+    "fullBurst_resample"            : ("burst", 32),
+    "generate_burst_igram"          : ("burst", 24),
+    "merge_reference_secondary_slc" : ("scene", 24),
+    "merge_burst_igram"             : ("scene", 16),
+    "filter_coherence"              : ("looked", 48),
+    "unwrap"                        : ("looked", 64),
+}
+## memory of the python / ISCE2 runtime of a line, the safety margin on the estimates
+## and the fraction of MemAvailable given to the run-file lines
+TASK_BASE_MEM_GB = 0.5
+MEMORY_MARGIN = 1.2
+MEMORY_BUDGET_FRACTION = 0.8
+LOOKS_PATTERN = {
+    "alks": re.compile(r"^\s*(?:alks|nalks|azimuth_looks)\s*:\s*(\d+)", re.M),
+    "rlks": re.compile(r"^\s*(?:rlks|nrlks|range_looks)\s*:\s*(\d+)", re.M),
+}
+## per-line resource profile in run_files/logs (.json / .csv) and the number of steps in the summary
+PROFILE_NAME = "profile"
+PROFILE_TOP_STEPS = 10
+PROFILE_FIELDS = ["step", "script", "line", "start", "end", "wall_time", "cpu_time",
+                  "max_rss_mb", "read_mb", "write_mb", "returncode", "cmd"]
+
+
+def get_task_fingerprint(cmd, run_files_dir):
+    # fingerprint of the inputs of a run-file line (or the text of a whole run file) : the command
+    # and the size/mtime of the config files it passes with -c (written by stackSentinel),
+    # the outputs are recorded apart by get_task_outputs
+    sha = hashlib.sha1(cmd.encode())
+    tokens = cmd.split()
+    for flag, token in zip(tokens[:-1], tokens[1:]):
+        if flag != "-c":
+            continue
+        path = token if os.path.isabs(token) else os.path.join(run_files_dir, token)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            sha.update(f"{token}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return sha.hexdigest()
+
+
+def get_output_dirs(step, cmds, run_files_dir):
+    # the directories a run-file step writes its lines' outputs to : the date / date pair directories
+    # of the stack named by the lines (e.g. coreg_secondarys/20230113, merged/interferograms/20230101_20230113)
+    # and the STEP_OUTPUT_DIRS of the step
+    process_dir = os.path.dirname(os.path.abspath(run_files_dir))
+    output_dirs = [os.path.join(process_dir, path) for path in STEP_OUTPUT_DIRS.get(step, [])]
+    for key in sorted({get_line_key(cmd) for cmd in cmds} - {None}):
+        output_dirs += glob.glob(os.path.join(process_dir, "*", key))
+        output_dirs += glob.glob(os.path.join(process_dir, "merged", "*", key))
+    return [path for path in output_dirs if os.path.isdir(path)]
+
+
+def get_task_outputs(step, cmds, run_files_dir, start):
+    # [[path, size, mtime_ns]] of the files written since start (time.time()) in the output
+    # directories of the lines, path relative to the stack work directory
+    process_dir = os.path.dirname(os.path.abspath(run_files_dir))
+    since_ns = int(start) * 10**9
+    outputs = []
+    for output_dir in get_output_dirs(step, cmds, run_files_dir):
+        for root, _, files in os.walk(output_dir):
+            for name in files:
+                stat = os.stat(os.path.join(root, name))
+                if stat.st_mtime_ns >= since_ns:
+                    outputs.append([os.path.relpath(os.path.join(root, name), process_dir),
+                                    stat.st_size, stat.st_mtime_ns])
+    return sorted(outputs)
+
+
+def outputs_unchanged(record, run_files_dir):
+    # whether the outputs recorded in a journal record are still in place with their size/mtime
+    process_dir = os.path.dirname(os.path.abspath(run_files_dir))
+    for path, size, mtime_ns in record.get("outputs", []):
+        path = os.path.join(process_dir, path)
+        if not os.path.isfile(path):
+            return False
+        stat = os.stat(path)
+        if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+            return False
+    return True
+
+
+def is_journal_done(record, fingerprint, run_files_dir):
+    # a journal record completes a line when it is done with the same inputs and its outputs are unchanged
+    return bool(record) and record["status"] == "done" and record["fingerprint"] == fingerprint \
+        and outputs_unchanged(record, run_files_dir)
+
+
+def load_journal(journal_file):
+    # load the completion journal, the last record of each (run file, line) wins
+    # <return> {(run file name, line): record}, line 0 records a whole run file of run.py
+    finished = {}
+    if not os.path.exists(journal_file):
+        return finished
+    with open(journal_file, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                ## a record truncated by a crash
+                continue
+            finished[(record["script"], record["line"])] = record
+    return finished
+
+
+def append_journal(journal_file, record):
+    with open(journal_file, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def get_step_name(script):
+    # run_13_generate_burst_igram -> generate_burst_igram
+    return re.sub(r'^run_\d+_', '', os.path.basename(script))
+
+
+def get_line_key(cmd):
+    # the date / date pair of a run-file line from its config file, e.g. config_igram_20230101_20230113 -> 20230101_20230113
+    dates = re.findall(r'\d{8}', os.path.basename(cmd.split()[-1])) if cmd.split() else []
+    return "_".join(dates) if dates else None
+
+
+def parse_run_file(script):
+    # read the command lines of a run file, split into groups at the "wait" lines
+    groups, group = [], []
+    with open(script, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line == "wait":
+                if group:
+                    groups.append(group)
+                group = []
+                continue
+            group.append(line.rstrip("&").strip())
+    if group:
+        groups.append(group)
+    return groups
+
+
+def build_task_graph(scripts):
+    ############################################################
+    # build the line-level task graph of the run files
+    # <1> scripts (list): run files in processing order
+    # <return> (units, tasks)
+    #   units : [{"name", "script", "tasks", "remaining"}] one unit per run file (group)
+    #   tasks : [{"id", "unit", "line", "cmd", "key", "wait_units", "wait_tasks", "status"}]
+    ############################################################
+    units, tasks = [], []
+    previous_keys = {}
+    for script in scripts:
+        step_name = get_step_name(script)
+        dependency = STEP_DEPENDENCIES.get(step_name)
+        line = 0
+        for g, group in enumerate(parse_run_file(script)):
+            u = len(units)
+            if g > 0 or dependency is None:
+                wait_units = set(range(u))
+            elif dependency == "keyed":
+                wait_units = set()
+            else:
+                wait_units = set(units.index(unit) for unit in units if get_step_name(unit["script"]) in dependency)
+            unit = {"name": step_name if g == 0 else f"{step_name}.{g}", "script": script,
+                    "tasks": [], "remaining": len(group)}
+            keys = {}
+            for cmd in group:
+                line += 1
+                key = get_line_key(cmd)
+                task = {"id": len(tasks), "unit": u, "line": line, "cmd": cmd, "key": key,
+                        "wait_units": set(wait_units), "wait_tasks": set(), "status": "pending"}
+                if g == 0 and dependency == "keyed":
+                    if key is not None and key in previous_keys:
+                        task["wait_tasks"].update(previous_keys[key])
+                    elif u > 0:
+                        task["wait_units"].add(u - 1)
+                keys.setdefault(key, []).append(task["id"])
+                unit["tasks"].append(task["id"])
+                tasks.append(task)
+            previous_keys = keys
+            units.append(unit)
+    return units, tasks
+
+
+def get_available_memory_gb():
+    # MemAvailable of /proc/meminfo in GB, None if unknown
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024**2
+    except OSError:
+        pass
+    return None
+
+
+def get_cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return cpu_count()
+
+
+def get_max_workers(cores=None, task_mem_gb=DEFAULT_TASK_MEM_GB):
+    # size the pool from the host cores and the available memory
+    workers = cores or get_cpu_count()
+    mem_gb = get_available_memory_gb()
+    if mem_gb is not None:
+        workers = min(workers, int(mem_gb // task_mem_gb))
+    return max(workers, 1)
+
+
+def get_memory_budget_gb(mem_budget=None):
+    # memory given to the run-file lines : mem_budget (GB) or a fraction of MemAvailable, None if unknown
+    if mem_budget is not None:
+        return mem_budget
+    mem_gb = get_available_memory_gb()
+    return mem_gb * MEMORY_BUDGET_FRACTION if mem_gb is not None else None
+
+
+def get_isce_xml_size(xml_file):
+    # (width, length) of an ISCE2 image xml
+    props = {}
+    for prop in ET.parse(xml_file).getroot().iter("property"):
+        value = prop.find("value")
+        if prop.get("name") in ("width", "length") and value is not None:
+            props[prop.get("name")] = int(float(value.text))
+    return props.get("width", 0), props.get("length", 0)
+
+
+def get_scene_pixels(process_dir):
+    ############################################################
+    # pixels of the largest reference burst and of the merged scene (sum of the bursts),
+    # from the burst xml files written by unpack_topo_reference
+    # <return> (burst_pixels, scene_pixels), (0, 0) before the reference is unpacked
+    ############################################################
+    burst_pixels = []
+    for xml_file in glob.glob(os.path.join(process_dir, "reference", "IW*", "burst_*.slc.xml")):
+        try:
+            width, length = get_isce_xml_size(xml_file)
+        except (ET.ParseError, ValueError, OSError):
+            continue
+        burst_pixels.append(width * length)
+    if not burst_pixels:
+        return 0, 0
+    return max(burst_pixels), sum(burst_pixels)
+
+
+def get_task_looks(cmd, run_files_dir):
+    # nalks * nrlks read from the -c config file of a run-file line, 1 if not set
+    tokens = cmd.split()
+    looks = {"alks": 1, "rlks": 1}
+    for flag, token in zip(tokens[:-1], tokens[1:]):
+        path = token if os.path.isabs(token) else os.path.join(run_files_dir, token)
+        if flag != "-c" or not os.path.isfile(path):
+            continue
+        with open(path, "r") as f:
+            config = f.read()
+        for name, pattern in LOOKS_PATTERN.items():
+            match = pattern.search(config)
+            if match:
+                looks[name] = int(match.group(1))
+    return looks["alks"] * looks["rlks"]
+
+
+def load_step_memory(logs_dir):
+    # peak rss (GB) of a line of each step in the profile of the previous run, {} if there is none
+    try:
+        with open(Path(logs_dir) / f"{PROFILE_NAME}.json", "r") as f:
+            lines = json.load(f)["lines"]
+    except (OSError, ValueError, KeyError):
+        return {}
+    step_memory = {}
+    for record in lines:
+        step = record["step"].split(".")[0]
+        step_memory[step] = max(step_memory.get(step, 0.0), record["max_rss_mb"] / 1024)
+    return step_memory
+
+
+def estimate_task_memory(step, cmd, run_files_dir, step_memory):
+    ############################################################
+    # memory (GB) reserved for a run-file line of a step :
+    # the measured peak of the step (previous profile or lines finished in this run) if any,
+    # else the STEP_MEMORY_MODEL on the scene dimensions and the looks, else DEFAULT_TASK_MEM_GB
+    ############################################################
+    step = step.split(".")[0]
+    if step in step_memory:
+        return step_memory[step] * MEMORY_MARGIN
+    if step not in STEP_MEMORY_MODEL:
+        return DEFAULT_TASK_MEM_GB
+    burst_pixels, scene_pixels = get_scene_pixels(os.path.dirname(os.path.abspath(run_files_dir)))
+    if scene_pixels == 0:
+        return DEFAULT_TASK_MEM_GB
+    size, bytes_per_pixel = STEP_MEMORY_MODEL[step]
+    if size == "burst":
+        pixels = burst_pixels
+    elif size == "scene":
+        pixels = scene_pixels
+    else:
+        pixels = scene_pixels / get_task_looks(cmd, run_files_dir)
+    return (TASK_BASE_MEM_GB + pixels * bytes_per_pixel / 1024**3) * MEMORY_MARGIN
+
+
+def run_task_graph(units, tasks, run_files_dir, logs_dir, max_workers, journal_file=None, profile=None,
+                   mem_budget_gb=None):
+    ############################################################
+    # dispatch the ready tasks of the graph on max_workers processes
+    # a task is ready when its wait_units are complete and its wait_tasks are done,
+    # no new task is started after a failure 
+    # the tasks already marked "done" (resumed from the journal) are not run again
+    # the resource usage of each finished task is appended to profile (list) when given
+    # with mem_budget_gb, a task is only started while the estimated memory of the running
+    # tasks stays under the budget (one task always runs), the estimates of a step follow
+    # the peak rss of its finished lines
+    # <return> bool: True if all tasks succeeded
+    ############################################################
+    env = dict(os.environ)
+    env.setdefault("OMP_NUM_THREADS", str(max(get_cpu_count() // max_workers, 1)))
+    pending = [task for task in tasks if task["status"] == "pending"]
+    running = {}
+    failed = []
+    step_memory = load_step_memory(logs_dir)
+    measured = {}
+    reserved_gb = 0.0
+    while pending or running:
+        ## start the ready tasks
+        if not failed:
+            still_pending = []
+            blocked = False
+            for task in pending:
+                ready = not blocked and len(running) < max_workers and \
+                    all(units[u]["remaining"] == 0 for u in task["wait_units"]) and \
+                    all(tasks[t]["status"] == "done" for t in task["wait_tasks"])
+                unit = units[task["unit"]]
+                if ready and mem_budget_gb is not None:
+                    task["mem_gb"] = estimate_task_memory(unit["name"], task["cmd"], run_files_dir,
+                                                          dict(step_memory, **measured))
+                    ## the first ready task over the budget holds back the later ones so it is not starved
+                    if running and reserved_gb + task["mem_gb"] > mem_budget_gb:
+                        ready, blocked = False, True
+                if not ready:
+                    still_pending.append(task)
+                    continue
+                reserved_gb += task.get("mem_gb", 0.0)
+                step_logs_dir = Path(logs_dir) / os.path.basename(unit["script"])
+                step_logs_dir.mkdir(exist_ok=True)
+                log = open(step_logs_dir / f"line_{task['line']:04d}.log", "w")
+                proc = subprocess.Popen(task["cmd"], shell=True, cwd=run_files_dir, env=env,
+                                        stdout=log, stderr=subprocess.STDOUT)
+                task["status"] = "running"
+                task["start"] = time.time()
+                running[proc] = (task, log)
+            pending = still_pending
+        elif not running:
+            break
+        ## collect the finished tasks
+        time.sleep(POLL_INTERVAL)
+        for proc in list(running):
+            usage = wait_profiled(proc)
+            if usage is None:
+                continue
+            end = time.time()
+            task, log = running.pop(proc)
+            log.close()
+            unit = units[task["unit"]]
+            reserved_gb -= task.get("mem_gb", 0.0)
+            step = unit["name"].split(".")[0]
+            measured[step] = max(measured.get(step, 0.0), usage["max_rss_mb"] / 1024)
+            if journal_file is not None:
+                outputs = get_task_outputs(step, [task["cmd"]], run_files_dir, task["start"]) \
+                    if proc.returncode == 0 else []
+                append_journal(journal_file, {
+                    "script": os.path.basename(unit["script"]), "line": task["line"],
+                    "status": "done" if proc.returncode == 0 else "failed",
+                    "start": task["start"], "runtime": end - task["start"],
+                    "returncode": proc.returncode, "fingerprint": task["fingerprint"],
+                    "outputs": outputs})
+            if profile is not None:
+                profile.append(dict(usage, step=unit["name"], script=os.path.basename(unit["script"]),
+                                    line=task["line"], start=task["start"], end=end,
+                                    wall_time=end - task["start"], cmd=task["cmd"]))
+            if proc.returncode == 0:
+                task["status"] = "done"
+                unit["remaining"] -= 1
+                if unit["remaining"] == 0:
+                    print(f"✓ {unit['name']} completed")
+            else:
+                task["status"] = "failed"
+                failed.append(task)
+                print(f"✗ ERROR: {os.path.basename(unit['script'])} line {task['line']} failed "
+                      f"(return code: {proc.returncode}): {task['cmd']}")
+    if failed:
+        print(f"{len(failed)} task(s) failed, check the logs in {logs_dir}")
+    return not failed
+
+
+def wait_profiled(proc, block=False):
+    ############################################################
+    # reap a child process with wait4 to get its resource usage, including the
+    # commands it started (run-file lines are run by a shell)
+    # <return> None if the process is still running, else a dict with
+    #   returncode, cpu_time (s), max_rss_mb, read_mb, write_mb (block I/O of the disks)
+    ############################################################
+    pid, status, usage = os.wait4(proc.pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+        return None
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    ## ru_maxrss is in kB, ru_inblock/ru_oublock count 512 B blocks on linux
+    return {"returncode": proc.returncode,
+            "cpu_time": usage.ru_utime + usage.ru_stime,
+            "max_rss_mb": usage.ru_maxrss / 1024,
+            "read_mb": usage.ru_inblock * 512 / 1024**2,
+            "write_mb": usage.ru_oublock * 512 / 1024**2}
+
+
+def summarize_profile(records):
+    # aggregate the line profiles by step : wall time from the first start to the last end,
+    # summed cpu time and I/O, peak rss of a line, cpu_ratio = cpu_time / wall_time
+    steps = {}
+    for record in records:
+        step = steps.setdefault(record["script"], {
+            "script": record["script"], "step": record["step"], "lines": 0,
+            "start": record["start"], "end": record["end"], "line_time": 0.0,
+            "cpu_time": 0.0, "max_rss_mb": 0.0, "read_mb": 0.0, "write_mb": 0.0})
+        step["lines"] += 1
+        step["start"] = min(step["start"], record["start"])
+        step["end"] = max(step["end"], record["end"])
+        step["line_time"] += record["wall_time"]
+        step["cpu_time"] += record["cpu_time"]
+        step["max_rss_mb"] = max(step["max_rss_mb"], record["max_rss_mb"])
+        step["read_mb"] += record["read_mb"]
+        step["write_mb"] += record["write_mb"]
+    for step in steps.values():
+        step["wall_time"] = step["end"] - step["start"]
+        step["cpu_ratio"] = step["cpu_time"] / step["line_time"] if step["line_time"] > 0 else 0.0
+    return sorted(steps.values(), key=lambda step: step["wall_time"], reverse=True)
+
+
+def write_profile(records, logs_dir):
+    ############################################################
+    # write the line profiles and the step summary to logs/profile.json and the
+    # line profiles to logs/profile.csv, print the slowest steps
+    # a low cpu_ratio (cpu time per line time) points to an I/O-bound step
+    # <return> list: the step summaries, slowest first
+    ############################################################
+    if not records:
+        return []
+    steps = summarize_profile(records)
+    with open(Path(logs_dir) / f"{PROFILE_NAME}.json", "w") as f:
+        json.dump({"steps": steps, "lines": records}, f, indent=2)
+    with open(Path(logs_dir) / f"{PROFILE_NAME}.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=PROFILE_FIELDS)
+        writer.writeheader()
+        writer.writerows(records)
+    print(f"\nSlowest steps (profile saved to {Path(logs_dir) / PROFILE_NAME}.json/.csv):")
+    print(f"  {'step':<32}{'lines':>6}{'wall(h)':>9}{'cpu(h)':>9}{'cpu/line':>9}"
+          f"{'rss(GB)':>9}{'read(GB)':>10}{'write(GB)':>10}")
+    for step in steps[:PROFILE_TOP_STEPS]:
+        print(f"  {step['step']:<32}{step['lines']:>6}{step['wall_time']/3600:>9.2f}"
+              f"{step['cpu_time']/3600:>9.2f}{step['cpu_ratio']:>9.2f}{step['max_rss_mb']/1024:>9.2f}"
+              f"{step['read_mb']/1024:>10.2f}{step['write_mb']/1024:>10.2f}")
+    return steps
+
+
+def resume_task_graph(units, tasks, run_files_dir, journal_file):
+    # fingerprint the tasks and mark those completed in the journal as done, return their number,
+    # a line whose recorded outputs were removed or rewritten since is run again
+    finished = load_journal(journal_file)
+    n_done = 0
+    for task in tasks:
+        unit = units[task["unit"]]
+        task["fingerprint"] = get_task_fingerprint(task["cmd"], run_files_dir)
+        record = finished.get((os.path.basename(unit["script"]), task["line"]))
+        if is_journal_done(record, task["fingerprint"], run_files_dir):
+            task["status"] = "done"
+            unit["remaining"] -= 1
+            n_done += 1
+    return n_done
+
+
+def run_stack_parallel(run_files_dir, cores=None, expected_files=16, skip_steps=(), resume=True,
+                       mem_budget=None):
+    ############################################################
+    # execute the ISCE2 stack run files as one line-level task graph,
+    # the lines of independent steps / dates run concurrently on the whole host
+    # <1> run_files_dir (str): directory containing run files
+    # <2> cores (int): number of concurrent lines (default: host cores, bounded by memory)
+    # <3> expected_files (int): expected number of run files
+    # <4> skip_steps (list): step names to leave out, e.g. ["unwrap"]
+    # <5> resume (bool): skip the lines completed in the journal logs/journal.jsonl
+    # <6> mem_budget (float): memory (GB) for the concurrent lines (default: 80% of MemAvailable)
+    # <return> bool: True if all lines succeeded
+    ############################################################
+    try:
+        scripts = find_run_files(run_files_dir)
+    except (FileNotFoundError, NotADirectoryError) as e:
+        print(f"ERROR: {e}")
+        return False
+    if len(scripts) != expected_files:
+        print(f"WARNING: Expected {expected_files} run files but found {len(scripts)}")
+    scripts = [script for script in scripts if get_step_name(script) not in skip_steps]
+    logs_dir = Path(run_files_dir) / 'logs'
+    logs_dir.mkdir(exist_ok=True)
+    units, tasks = build_task_graph(scripts)
+    journal_file = logs_dir / JOURNAL_NAME
+    if resume:
+        n_done = resume_task_graph(units, tasks, run_files_dir, journal_file)
+        print(f"  Resumed from the journal: {n_done}/{len(tasks)} lines already completed")
+    else:
+        for task in tasks:
+            task["fingerprint"] = get_task_fingerprint(task["cmd"], run_files_dir)
+    max_workers = cores or get_cpu_count()
+    mem_budget_gb = get_memory_budget_gb(mem_budget)
+    print(f"Stack processing parameters:")
+    print(f"  Run files directory: {run_files_dir}")
+    print(f"  Run files: {len(scripts)}, lines: {len(tasks)}")
+    print(f"  Concurrent lines: up to {max_workers}")
+    if mem_budget_gb is not None:
+        print(f"  Memory budget: {mem_budget_gb:.1f} GB")
+    start = time.time()
+    profile = []
+    success = run_task_graph(units, tasks, run_files_dir, logs_dir, max_workers, journal_file, profile,
+                             mem_budget_gb)
+    print(f"Processing finished in {(time.time() - start)/3600:.2f} h, success: {success}")
+    write_profile(profile, logs_dir)
+    return success
+
+
+def auto_insar_stacking_ISCE2(run_files_dir, nounwrap=False, cores=None, resume=True, mem_budget=None):
+    # run the stackSentinel run files with the parallel scheduler (step 5 of S1stackApp)
+    # <1> run_files_dir (str): directory containing run files
+    # <2> nounwrap (bool): leave out the unwrap step
+    # <3> cores (int): number of concurrent lines (default: auto)
+    # <4> resume (bool): skip the lines completed in the journal
+    # <5> mem_budget (float): memory (GB) for the concurrent lines (default: auto)
+    skip_steps = ["unwrap"] if nounwrap else []
+    return run_stack_parallel(run_files_dir, cores=cores, skip_steps=skip_steps, resume=resume,
+                              mem_budget=mem_budget)
+
+
 def create_parser():
     """Create argument parser"""
     parser = argparse.ArgumentParser(
@@ -145,6 +758,12 @@ def create_parser():
                        help='Number of CPU cores to use (default: auto-detect)')
     parser.add_argument('--expected-files', type=int, default=16,
                        help='Expected number of run files (default: 16)')
+    parser.add_argument('--scheduler', type=str, default='dag', choices=['dag', 'runpy'],
+                       help='dag: line-level parallel scheduler, runpy: one run.py per step (default: dag)')
+    parser.add_argument('--no-resume', action='store_true', default=False,
+                       help='run all lines again, ignoring the completion journal (default: False)')
+    parser.add_argument('--mem-budget', type=float, default=None,
+                       help='memory (GB) for the concurrent lines (default: 80%% of the available memory)')
     
     return parser
 
@@ -154,10 +773,21 @@ if __name__ == "__main__":
     args = parser.parse_args()
     
     # Run stack processing
-    success = run_stack_processing(
-        args.run_files_dir, 
-        args.cores, 
-        args.expected_files
-    )
+    if args.scheduler == 'dag':
+        success = run_stack_parallel(
+            args.run_files_dir,
+            args.cores,
+            args.expected_files,
+            resume=not args.no_resume,
+            mem_budget=args.mem_budget
+        )
+    else:
+        success = run_stack_processing(
+            args.run_files_dir, 
+            args.cores, 
+            args.expected_files,
+            resume=not args.no_resume,
+            mem_budget=args.mem_budget
+        )
     
     sys.exit(0 if success else 1)
\ No newline at end of file
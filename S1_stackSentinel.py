@@ -5,18 +5,107 @@
 #############################
 
 import os
+import re
 import sys
 import argparse
 import glob
+import time
+import shutil
 import subprocess
 from cores.validation import S1ParameterValidator
 from lab_utils import logo as show_logo
+from lab_utils import query_scenes
 from reset import reset_process_dir
 
 
+def get_extracted_swaths(slc_dir):
+    # find the IW swath numbers extracted in the SAFE directories of slc_dir, from the scene index
+    # (selective unzip only extracts the swaths intersecting the bbox)
+    # <1> slc_dir (str): directory containing Sentinel-1 SLC files
+    # <return> swaths (list): sorted swath numbers, empty if no swath is found
+    swaths = set()
+    for scene in query_scenes(slc_dir, kind="SAFE"):
+        swaths.update(int(swath) for swath in scene["swaths"].split(",") if swath)
+    return sorted(swaths)
+
+
+def get_safe_dates(slc_dir):
+    # acquisition dates (YYYYMMDD) of the SAFE directories in slc_dir, from the scene index
+    return sorted({scene["date"] for scene in query_scenes(slc_dir, kind="SAFE")})
+
+
+def get_stack_dates(process_dir):
+    ############################################################
+    # dates already processed in an ISCE2 stack
+    # <1> process_dir (str): stackSentinel work directory
+    # <return> (reference_date, dates): the stack reference (None without a stack) and all the
+    #          dates found in merged/SLC and coreg_secondarys
+    # raise ValueError when the stack has dates but no single reference (merged and not coregistered),
+    # stackSentinel.py would otherwise pick a new reference and redo the whole stack
+    ############################################################
+    date_pattern = re.compile(r'^\d{8}$')
+    def list_dates(path):
+        if not os.path.isdir(path):
+            return set()
+        return {name for name in os.listdir(path) if date_pattern.match(name)}
+    merged_dates = list_dates(os.path.join(process_dir, 'merged', 'SLC'))
+    coreg_dates = list_dates(os.path.join(process_dir, 'coreg_secondarys'))
+    ## the reference is merged but never coregistered
+    stack_dates = sorted(merged_dates | coreg_dates)
+    reference_dates = sorted(merged_dates - coreg_dates)
+    if not stack_dates:
+        return None, stack_dates
+    if len(reference_dates) != 1:
+        raise ValueError(f"can not find the reference of the stack in {process_dir}: "
+                         f"dates merged but not coregistered {reference_dates} (expected exactly one)")
+    return reference_dates[0], stack_dates
+
+
+def archive_run_files(process_dir):
+    # move the run files (and their logs) of the previous run aside to run_files_<time>
+    run_files_dir = os.path.join(process_dir, 'run_files')
+    if not os.path.isdir(run_files_dir):
+        return None
+    archive_dir = f"{run_files_dir}_{time.strftime('%Y%m%dT%H%M%S')}"
+    shutil.move(run_files_dir, archive_dir)
+    print(f"previous run files moved to {archive_dir}")
+    return archive_dir
+
+
+def update_stack_sentinel(lat_min, lat_max, lon_min, lon_max,
+                          dem_dir, aux_dir, slc_dir, orbits_dir,
+                          nalks, nrlks, process_dir, swath_num=None, polarization=None):
+    ############################################################
+    # generate the runfiles of the new acquisitions only
+    # the dates of slc_dir are compared with the processed stack (merged/SLC, coreg_secondarys),
+    # stackSentinel.py then finds the coregistered secondaries in the work directory and only
+    # writes the coregistration / interferogram / unwrapping work of the new dates and their
+    # new pairs, reusing the reference and its geometry
+    # <1~12> : see stack_sentinel
+    # <return> new_dates (list): the new dates, empty if the stack is up to date
+    ############################################################
+    reference_date, stack_dates = get_stack_dates(process_dir)
+    if not stack_dates:
+        print("no processed stack found, generate the full runfiles")
+        stack_sentinel(lat_min, lat_max, lon_min, lon_max, dem_dir, aux_dir, slc_dir, orbits_dir,
+                       nalks, nrlks, process_dir, swath_num=swath_num, polarization=polarization)
+        return get_safe_dates(slc_dir)
+    new_dates = sorted(set(get_safe_dates(slc_dir)) - set(stack_dates))
+    if not new_dates:
+        print(f"the stack of {len(stack_dates)} dates is up to date, nothing to update")
+        return []
+    print(f"update the stack of {len(stack_dates)} dates (reference {reference_date}) "
+          f"with {len(new_dates)} new dates : {new_dates}")
+    archive_run_files(process_dir)
+    stack_sentinel(lat_min, lat_max, lon_min, lon_max, dem_dir, aux_dir, slc_dir, orbits_dir,
+                   nalks, nrlks, process_dir, swath_num=swath_num, reference_date=reference_date,
+                   polarization=polarization)
+    return new_dates
+
+
 def stack_sentinel(lat_min, lat_max, lon_min, lon_max, 
                    dem_dir, aux_dir, slc_dir, orbits_dir,
-                   nalks, nrlks, process_dir):
+                   nalks, nrlks, process_dir, swath_num=None, reference_date=None, polarization=None):
     # Generate runfiles using stackSentinel.py
     # <1~4> lat_min, lat_max, lon_min, lon_max (float): bounding box coordinates
     # <5>  dem_dir (str): directory containing DEM files
@@ -26,6 +115,9 @@ def stack_sentinel(lat_min, lat_max, lon_min, lon_max,
     # <9>  nalks (int): number of azimuth looks
     # <10> nrlks (int): number of range looks
     # <11> process_dir (str): directory where runfiles will be generated
+    # <12> swath_num (list): IW swaths to process, default the swaths extracted in slc_dir
+    # <13> reference_date (str): stack reference date YYYYMMDD, default chosen by stackSentinel.py
+    # <14> polarization (str): polarization to process (vv/vh/hh/hv), default vv of stackSentinel.py
 
     # change to process directory
     
@@ -61,6 +153,14 @@ def stack_sentinel(lat_min, lat_max, lon_min, lon_max,
         '-f', '0.8',
         '-c', '5'
     ]
+    if swath_num is None:
+        swath_num = get_extracted_swaths(slc_dir)
+    if swath_num:
+        cmd += ['-n', ' '.join(str(swath) for swath in swath_num)]
+    if reference_date is not None:
+        cmd += ['-m', str(reference_date)]
+    if polarization is not None:
+        cmd += ['-p', polarization.lower()]
     
     print(f"Stack Sentinel parameters:")
     print(f"  Bounding box: [{lat_min}, {lat_max}] x [{lon_min}, {lon_max}]")
@@ -70,6 +170,11 @@ def stack_sentinel(lat_min, lat_max, lon_min, lon_max,
     print(f"  Orbits directory: {orbits_dir}")
     print(f"  Azimuth looks: {nalks}")
     print(f"  Range looks: {nrlks}")
+    print(f"  Swaths: {swath_num}")
+    if reference_date is not None:
+        print(f"  Reference date: {reference_date}")
+    if polarization is not None:
+        print(f"  Polarization: {polarization.lower()}")
     print(f"  Process directory: {process_dir}")
     print(f"Running command: {' '.join(cmd)}\n")
     
@@ -139,6 +244,10 @@ def create_parser():
                         help='show the logo of IntfLab (default : False)')
     parser.add_argument('--reset', action='store_true', default=False,
                         help='whether reset the process directory (default : False)')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='only generate the runfiles of the dates not yet in the stack (default : False)')
+    parser.add_argument('--polarization', type=str, default=None,
+                        help='polarization to process vv/vh/hh/hv (default : vv of stackSentinel.py)')
     return parser
 
 
@@ -172,8 +281,15 @@ if __name__ == "__main__":
     if not vad.validate_processing_parameters(nrlks, nalks):
         sys.exit(1)
     
-    stack_sentinel( 
-        lat_min, lat_max, lon_min, lon_max,
-        dem_dir, aux_dir, slc_dir, orbits_dir,
-        nalks, nrlks, process_dir
-    )
\ No newline at end of file
+    if args.incremental:
+        update_stack_sentinel(
+            lat_min, lat_max, lon_min, lon_max,
+            dem_dir, aux_dir, slc_dir, orbits_dir,
+            nalks, nrlks, process_dir, polarization=args.polarization
+        )
+    else:
+        stack_sentinel( 
+            lat_min, lat_max, lon_min, lon_max,
+            dem_dir, aux_dir, slc_dir, orbits_dir,
+            nalks, nrlks, process_dir, polarization=args.polarization
+        )
\ No newline at end of file
@@ -5,22 +5,332 @@
 ############################ 
 
 import os
+import re
 import sys
+import time
+import shutil
 import zipfile
 import glob
 import argparse
+import threading
+import xml.etree.ElementTree as ET
 from multiprocessing import cpu_count
 from joblib import Parallel, delayed
 from lab_utils import logo as show_logo
 from reset import reset_zipped_dir
 
 
-def unzip_S1_SLC(zip_file, safe_file, update_mode):
+## members larger than LARGE_MEMBER_SIZE (the measurement/*.tiff files) are scheduled as separate tasks
+UNZIP_BUFFER_SIZE = 16 * 1024 * 1024
+LARGE_MEMBER_SIZE = 64 * 1024 * 1024
+## swath/polarization specific members, e.g. s1a-iw2-slc-vv-20230101t...-004.tiff, calibration-s1a-iw2-slc-vv-...xml
+SWATH_MEMBER_PATTERN = re.compile(r'^(?:calibration-|noise-|rfi-)?s1[abcd]-iw(\d)-slc-(\w\w)-')
+## concurrent extraction streams on a rotational disk, more only thrash the heads
+HDD_MAX_JOBS = 3
+## written in a SAFE after its last member, a SAFE without it was interrupted and is finished on re-run
+UNZIP_MARKER = ".unzip_complete"
+
+
+def is_rotational_disk(path):
+    # check whether the block device holding path is a rotational disk (HDD), False if unknown
+    try:
+        dev = os.stat(path).st_dev
+        sys_dev = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+        ## partitions keep the queue information in the parent device
+        for queue in (os.path.join(sys_dev, "queue"), os.path.join(sys_dev, "..", "queue")):
+            rotational = os.path.join(queue, "rotational")
+            if os.path.exists(rotational):
+                with open(rotational) as f:
+                    return f.read().strip() == "1"
+    except (OSError, AttributeError):
+        pass
+    return False
+
+
+def get_unzip_njobs(slc_dir, n_tasks):
+    # size the extraction pool from the available cores and the disk type of slc_dir
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = cpu_count()
+    n_jobs = HDD_MAX_JOBS if is_rotational_disk(slc_dir) else cores
+    return max(min(n_jobs, n_tasks), 1)
+
+
+def get_S1_zip_swath_footprints(zip_file):
+    ############################################################
+    # read the swath footprints from the annotation xmls inside a S1 zip
+    # <1> zip_file : path to the S1 SLC zip file
+    # <return>     : {(swath, pol): [lat_min, lat_max, lon_min, lon_max]} from the geolocation grid
+    ############################################################
+    footprints = {}
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        for member in zip_ref.namelist():
+            if '/annotation/' not in member or '/calibration/' in member:
+                continue
+            match = SWATH_MEMBER_PATTERN.match(os.path.basename(member))
+            if not match or not member.endswith('.xml'):
+                continue
+            root = ET.fromstring(zip_ref.read(member))
+            points = root.findall('.//geolocationGridPoint')
+            lats = [float(point.findtext('latitude')) for point in points]
+            lons = [float(point.findtext('longitude')) for point in points]
+            if lats:
+                footprints[(int(match.group(1)), match.group(2))] = [min(lats), max(lats), min(lons), max(lons)]
+    return footprints
+
+
+def select_S1_zip_members(zip_file, bbox, polarization='vv'):
+    ############################################################
+    # select the members of a S1 zip needed to process a bbox
+    # the measurement/annotation/calibration files of the swaths whose geolocation grid
+    # intersects the bbox with the given polarization, plus all the files shared by the swaths
+    # <1> zip_file     : path to the S1 SLC zip file
+    # <2> bbox         : [lat_min, lat_max, lon_min, lon_max]
+    # <3> polarization : polarization to keep (default : vv)
+    # <return>         : (members, swaths) the selected member names and swath numbers
+    ############################################################
+    lat_min, lat_max, lon_min, lon_max = bbox
+    swaths = sorted(
+        swath for (swath, pol), (s, n, w, e) in get_S1_zip_swath_footprints(zip_file).items()
+        if pol == polarization.lower() and s <= lat_max and n >= lat_min and w <= lon_max and e >= lon_min
+    )
+    members = []
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        for member in zip_ref.namelist():
+            match = SWATH_MEMBER_PATTERN.match(os.path.basename(member))
+            if match is None or (int(match.group(1)) in swaths and match.group(2) == polarization.lower()):
+                members.append(member)
+    return members, swaths
+
+
+def is_measurement_member(member):
+    # whether a zip member is a measurement tiff of the SAFE
+    return member.endswith('.tiff') and '/measurement/' in member
+
+
+def write_virtual_measurements(zip_file, target_dir, members):
+    ############################################################
+    # write the measurement tiffs of a zip as GDAL VRTs reading the members in place
+    # through /vsizip/, the VRT keeps the *.tiff name so ISCE2 finds it in the SAFE,
+    # GDAL recognizes the VRT by its content. the raster size comes from the annotation xml
+    # <1> zip_file   : path to the S1 SLC zip file, must stay in place
+    # <2> target_dir : target directory of the SAFE
+    # <3> members    : measurement tiff member names
+    # <return>       : number of VRTs written
+    ############################################################
+    zip_path = os.path.abspath(zip_file)
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        for member in members:
+            info = zip_ref.getinfo(member)
+            if info.compress_type != zipfile.ZIP_STORED:
+                print(f"WARNING: {os.path.basename(member)} is compressed in the zip, reading it in place is slow")
+            annotation = member.replace('/measurement/', '/annotation/')[:-len('.tiff')] + '.xml'
+            root = ET.fromstring(zip_ref.read(annotation))
+            width = int(root.findtext('.//imageInformation/numberOfSamples'))
+            length = int(root.findtext('.//imageInformation/numberOfLines'))
+            vrt_path = os.path.join(target_dir, member)
+            os.makedirs(os.path.dirname(vrt_path), exist_ok=True)
+            with open(vrt_path, 'w') as vrt:
+                vrt.write(f'<VRTDataset rasterXSize="{width}" rasterYSize="{length}">\n')
+                vrt.write(f'    <VRTRasterBand dataType="CInt16" band="1">\n')
+                vrt.write(f'        <SimpleSource>\n')
+                vrt.write(f'            <SourceFilename relativeToVRT="0">/vsizip/{zip_path}/{member}</SourceFilename>\n')
+                vrt.write(f'            <SourceBand>1</SourceBand>\n')
+                vrt.write(f'            <SourceProperties RasterXSize="{width}" RasterYSize="{length}" DataType="CInt16"/>\n')
+                vrt.write(f'        </SimpleSource>\n')
+                vrt.write(f'    </VRTRasterBand>\n')
+                vrt.write('</VRTDataset>\n')
+    return len(members)
+
+
+def plan_unzip_tasks(zip_file, target_dir, members=None):
+    ############################################################
+    # split a S1 zip into extraction tasks 
+    # <1> zip_file   : path to the S1 SLC zip file
+    # <2> target_dir : target directory to extract files
+    # <3> members    : member names to extract (default : all)
+    # <return>       : [(zip_file, members, target_dir, nbytes)], one task per large member 
+    #                  and one task for all the small members (xml, png, kml ...)
+    ############################################################
+    tasks, small_members, small_bytes = [], [], 0
+    selected = set(members) if members is not None else None
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if selected is not None and info.filename not in selected:
+                continue
+            if info.file_size >= LARGE_MEMBER_SIZE or is_measurement_member(info.filename):
+                tasks.append((zip_file, [info.filename], target_dir, info.file_size))
+            else:
+                small_members.append(info.filename)
+                small_bytes += info.file_size
+    if small_members:
+        tasks.append((zip_file, small_members, target_dir, small_bytes))
+    return tasks
+
+
+def extract_members(zip_file, members, target_dir, buffer_size=UNZIP_BUFFER_SIZE):
+    ############################################################
+    # extract members of a zip with large buffered copies
+    # each file is written to *.part first and renamed when complete,
+    # a file already extracted with the member size (by an interrupted run) is kept
+    # <1> zip_file    : path to the S1 SLC zip file
+    # <2> members     : member names to extract
+    # <3> target_dir  : target directory to extract files
+    # <4> buffer_size : copy buffer size in bytes
+    # <return>        : (zip_file, number of files, number of bytes)
+    ############################################################
+    target_root = os.path.abspath(target_dir)
+    nbytes = 0
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        for member in members:
+            info = zip_ref.getinfo(member)
+            out_path = os.path.abspath(os.path.join(target_root, member))
+            if not out_path.startswith(target_root + os.sep):
+                raise ValueError(f"unsafe member path in {zip_file}: {member}")
+            if info.is_dir():
+                os.makedirs(out_path, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            if os.path.isfile(out_path) and os.path.getsize(out_path) == info.file_size:
+                continue
+            part_path = out_path + ".part"
+            with zip_ref.open(info) as src, open(part_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, buffer_size)
+            os.replace(part_path, out_path)
+            nbytes += info.file_size
+    return zip_file, len(members), nbytes
+
+
+def is_safe_complete(safe_file):
+    # whether all the members of the SAFE were extracted (its UNZIP_MARKER exists)
+    return os.path.exists(os.path.join(safe_file, UNZIP_MARKER))
+
+
+def mark_safe_complete(safe_file):
+    # write the UNZIP_MARKER of a SAFE after its last member
+    with open(os.path.join(safe_file, UNZIP_MARKER), 'w') as marker:
+        marker.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+
+
+def prepare_safe_file(safe_file, update_mode):
+    # handle an existing SAFE directory before unzipping, return False to skip this zip
+    ## if update_mode == True  : then delete the exist file and unzip it again
+    ## if update_mode == False : keep the exist file and skip unzip,
+    ##                           unless it is incomplete (no UNZIP_MARKER) : finish it
+    safe_file_basename = os.path.basename(safe_file)
+    if os.path.exists(safe_file):
+        if update_mode:
+            print(f"remove {safe_file_basename} ...")
+            shutil.rmtree(safe_file)
+        elif not is_safe_complete(safe_file):
+            print(f"{safe_file_basename} is incomplete (no {UNZIP_MARKER}), finish unzipping it")
+        else:
+            print(f"updateMode : {update_mode}. {safe_file_basename} exists, pass it")
+            return False
+    return True
+
+
+def run_unzip_tasks(zip_safe_pairs, slc_dir, n_jobs=None, bbox=None, polarization='vv', virtual=False):
+    ############################################################
+    # extract the planned member tasks of several zips across one pool
+    # and write one aggregated log per SAFE
+    # <1> zip_safe_pairs : [(zip_file, safe_file)] to extract
+    # <2> slc_dir        : slc directory to extract files
+    # <3> n_jobs         : number of parallel extraction jobs (default : auto)
+    # <4> bbox           : [lat_min, lat_max, lon_min, lon_max], extract only the swaths 
+    #                      intersecting the bbox (default : None, extract everything)
+    # <5> polarization   : polarization to keep in the bbox selective mode (default : vv)
+    # <6> virtual        : only extract the small files, the measurement tiffs are written as
+    #                      VRTs reading the zip in place (default : False)
+    # a SAFE gets its UNZIP_MARKER as soon as its last task finishes,
+    # a zip with no swath intersecting the bbox is skipped (not extracted, not marked complete)
+    ############################################################
+    tasks, virtual_members, skipped = [], {}, []
+    for zip_file, safe_file in zip_safe_pairs:
+        members = None
+        if bbox is not None:
+            members, swaths = select_S1_zip_members(zip_file, bbox, polarization)
+            if not swaths:
+                skipped.append((zip_file, safe_file))
+                continue
+            print(f"{os.path.basename(zip_file)} : swaths {swaths} ({polarization}) intersect the bbox")
+        if virtual:
+            if members is None:
+                with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+                    members = zip_ref.namelist()
+            virtual_members[zip_file] = [m for m in members if is_measurement_member(m)]
+            members = [m for m in members if not is_measurement_member(m)]
+        tasks += plan_unzip_tasks(zip_file, slc_dir, members)
+    if skipped:
+        print(f"skip {len(skipped)} zips with no swath ({polarization}) intersecting the bbox:")
+        for zip_file, _ in skipped:
+            print(f"  {os.path.basename(zip_file)}")
+        zip_safe_pairs = [pair for pair in zip_safe_pairs if pair not in skipped]
+    safe_files = dict(zip_safe_pairs)
+    remaining = {zip_file: 0 for zip_file in safe_files}
+    for task in tasks:
+        remaining[task[0]] += 1
+    summary = {zip_file: [0, 0] for zip_file in safe_files}
+    lock = threading.Lock()
+
+    def finish_zip(zip_file):
+        if zip_file in virtual_members:
+            summary[zip_file][0] += write_virtual_measurements(zip_file, slc_dir, virtual_members[zip_file])
+        mark_safe_complete(safe_files[zip_file])
+
+    def run_task(zip_file, members, target_dir):
+        result = extract_members(zip_file, members, target_dir)
+        with lock:
+            remaining[zip_file] -= 1
+            done = remaining[zip_file] == 0
+        if done:
+            finish_zip(zip_file)
+        return result
+
+    for zip_file, n_tasks in remaining.items():
+        if n_tasks == 0 and os.path.isdir(safe_files[zip_file]):
+            finish_zip(zip_file)
+    if not tasks:
+        return
+    ## the largest members first, so the few big tiffs do not form the tail
+    tasks.sort(key=lambda task: task[3], reverse=True)
+    if n_jobs is None:
+        n_jobs = get_unzip_njobs(slc_dir, len(tasks))
+    total_bytes = sum(task[3] for task in tasks)
+    print(f"extracting {len(zip_safe_pairs)} zips ({len(tasks)} tasks, {total_bytes/1024**3:.2f} GB) with {n_jobs} jobs ...")
+    start = time.time()
+    results = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(run_task)(zip_file, members, target_dir)
+        for zip_file, members, target_dir, _ in tasks
+    )
+    elapsed = time.time() - start
+    ## aggregate the progress per zip
+    for zip_file, n_files, nbytes in results:
+        summary[zip_file][0] += n_files
+        summary[zip_file][1] += nbytes
+    for zip_file, safe_file in zip_safe_pairs:
+        n_files, nbytes = summary[zip_file]
+        log_file = os.path.join(slc_dir, f"unzip_{os.path.basename(safe_file)}.log")
+        with open(log_file, 'w', encoding='utf-8') as log_f:
+            log_f.write(f'unzip_{os.path.basename(zip_file)}:\n')
+            log_f.write(f'total files extracted: {n_files}\n')
+            log_f.write(f'total bytes extracted: {nbytes}\n')
+            log_f.write('extraction completed successfully.\n')
+        print(f"unzip finished: {os.path.basename(zip_file)} ({n_files} files, {nbytes/1024**2:.1f} MB)")
+    print(f"all unzip finished in {elapsed:.1f} s, {total_bytes/1024**2/max(elapsed, 1e-6):.1f} MB/s")
+
+
+def unzip_S1_SLC(zip_file, safe_file, update_mode, n_jobs=None, bbox=None, polarization='vv', virtual=False):
     ############################################################
     # unzip a single Sentinel-1 SLC zip file from ASF/NASA
     # <1> zip_file    : path to the S1 SLC zip file
-    # <2> target_dir  : target directory to extract files
+    # <2> safe_file   : target SAFE directory of the zip file
     # <3> update_mode : whether update exist file
+    # <4> n_jobs      : number of parallel extraction jobs (default : auto)
+    # <5> bbox        : extract only the swaths intersecting [lat_min, lat_max, lon_min, lon_max]
+    # <6> polarization: polarization to keep in the bbox selective mode (default : vv)
+    # <7> virtual     : virtual SAFE, the measurement tiffs are read from the zip in place
     # <return>        : None
     ############################################################
     ## for the S1_mode 
@@ -29,69 +339,49 @@ def unzip_S1_SLC(zip_file, safe_file, update_mode):
     ## for the S1_burst mode :s
     ##  one single file to the single unzipped file
     ############################################################
-    zip_file_basename = os.path.basename(zip_file)
-    print(f"unzipping {zip_file_basename} ...")
-    safe_file_basename = os.path.basename(safe_file)
-    # skip if already extracted
-    ## if update_mode == True  : then delete the exist file and unzip it again
-    ## if update_mode == False : keep the exist file and skip unzip
-    if os.path.exists(safe_file):
-        if update_mode:
-            print(f"remove {safe_file_basename} ...")
-            cmd = f"rm -rf {safe_file}"
-            print(f"running command : {cmd}")
-            os.system(cmd)
-        else:
-            print(f"updateMode : {update_mode}. pass and return")
-            return 
-    # create log file
-    target_dir = os.path.dirname(safe_file)
-    log_file = os.path.join(target_dir, f"unzip_{safe_file_basename}.log")
-    with open(log_file, 'w', encoding='utf-8') as log_f:
-        log_f.write(f'unzip_{zip_file_basename}:\n')
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            file_list = zip_ref.namelist()
-            total_files = len(file_list)
-            log_f.write(f'total files to extract: {total_files}\n')
-            log_f.write('extracting files:\n')
-            for i, file_name in enumerate(file_list, 1):
-                log_f.write(f'\t[{i:4d}/{total_files}] {file_name}\n')
-                zip_ref.extract(file_name, path=target_dir)
-            log_f.write('extraction completed successfully.\n')
-        print(f"unzip finished: {zip_file_basename}")
+    print(f"unzipping {os.path.basename(zip_file)} ...")
+    if not prepare_safe_file(safe_file, update_mode):
+        return
+    run_unzip_tasks([(zip_file, safe_file)], os.path.dirname(safe_file), n_jobs=n_jobs,
+                    bbox=bbox, polarization=polarization, virtual=virtual)
 
 
-def unzip_S1_SLC_list(zipped_dir, slc_dir, update_mode):
+def unzip_S1_SLC_list(zipped_dir, slc_dir, update_mode, n_jobs=None, bbox=None, polarization='vv',
+                      virtual=False):
     ############################################################
     # Unzip multiple Sentinel-1 SLC zip files in parallel
+    # the measurement tiffs of all zips are scheduled as separate tasks
     # <1>       : zipped_dir    : zipped directory to storage zipped files
     # <2>       : slc_dir       : slc directory to extract files
     # <3>       : update_mode   : whether update exist file
+    # <4>       : n_jobs        : number of parallel extraction jobs (default : auto)
+    # <5>       : bbox          : extract only the swaths intersecting [lat_min, lat_max, lon_min, lon_max]
+    #                             (default : None, extract everything)
+    # <6>       : polarization  : polarization to keep in the bbox selective mode (default : vv)
+    # <7>       : virtual       : virtual SAFE, only the small files are extracted and the measurement 
+    #                             tiffs are VRTs reading the zips in place (default : False)
     # <return>  : None
     ############################################################
     # get S1 zip files
-    zip_files = get_S1_zip_files(zip_dir)
+    zip_files = get_S1_zip_files(zipped_dir)
     if not zip_files:
-        print(f"no sentinel-1 zip files found in {zip_dir}")
+        print(f"no sentinel-1 zip files found in {zipped_dir}")
         print("expected file pattern: S1*.SAFE.zip")
         sys.exit(1)
         
     if not os.path.exists(slc_dir):
         os.mkdir(slc_dir)
-    n_jobs = min(max(int(cpu_count() / 4), 2), 8)
     ## create safe_file_list to load safe file
-    safe_file_list = []
+    zip_safe_pairs = []
     for zip_file in zip_files:
         zip_basename = os.path.basename(zip_file)
         safe_basename = zip_basename[:-4] + ".SAFE"
         safe_file = os.path.join(slc_dir, safe_basename)
-        safe_file_list.append(safe_file)
-    ## Parallel unzip files
-    n_jobs = min(max(int(cpu_count() / 4), 2), 8) 
-    Parallel(n_jobs=n_jobs)(
-        delayed(unzip_S1_SLC)(zip_file, safe_file, update_mode) 
-        for zip_file, safe_file in zip(zip_files, safe_file_list)
-    )
+        if prepare_safe_file(safe_file, update_mode):
+            zip_safe_pairs.append((zip_file, safe_file))
+    ## Parallel unzip members of all files
+    run_unzip_tasks(zip_safe_pairs, slc_dir, n_jobs=n_jobs, bbox=bbox, polarization=polarization,
+                    virtual=virtual)
 
 
 def get_S1_zip_files(zipped_dir):
@@ -130,6 +420,15 @@ def create_parser():
                         help='show the logo of IntfLab')
     parser.add_argument('--mode', type=str, default="S1",
                         help='mode in processing Sentinel1 S1/S1_burst (default : S1)')
+    parser.add_argument('--njobs', type=int, default=None,
+                        help='number of parallel extraction jobs (default : auto from cores and disk)')
+    parser.add_argument('--bbox', type=float, nargs=4, default=None,
+                        metavar=('LAT_MIN', 'LAT_MAX', 'LON_MIN', 'LON_MAX'),
+                        help='extract only the swaths intersecting the bbox (default : extract all)')
+    parser.add_argument('--polarization', type=str, default='vv',
+                        help='polarization to keep with --bbox (default : vv)')
+    parser.add_argument('--virtual', action='store_true', default=False,
+                        help='virtual SAFE: keep the measurement tiffs in the zips and write VRTs (default : False)')
     return parser
 
 
@@ -149,4 +448,5 @@ if __name__ == "__main__":
     if logo:
         show_logo()
     # run unzip_S1_SLC_list to unzip each file 
-    unzip_S1_SLC_list(zip_dir, slc_dir, update_mode=update_mode)
\ No newline at end of file
+    unzip_S1_SLC_list(zip_dir, slc_dir, update_mode=update_mode, n_jobs=args.njobs,
+                      bbox=args.bbox, polarization=args.polarization, virtual=args.virtual)
\ No newline at end of file
@@ -0,0 +1,218 @@
+######################################################
+# S1batchApp.py : run the S1stackApp workflow of many projects on one worker pool
+# copyRight Author : Yisen Gao (AIRCAS-RADI AISAR) 30/08/2025 to present
+# written in       : Beijing China
+## The projects (AOIs) of a manifest are split into their S1stackApp steps, and
+## the steps of all projects are scheduled on one pool of cores : a project runs
+## its steps in order, the ready steps are started by priority and fair share
+## (the project which used the least core time first). The orbit and DEM steps
+## fill the shared caches, they run one project at a time so a file needed by
+## several projects is downloaded once and linked by the others.
+#######################################################
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from lab_utils import S1_config
+from lab_utils import logo as show_logo
+from S1_runISCE2 import get_memory_budget_gb
+
+
+STACK_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "S1stackApp.py")
+STEP_NAMES = {1: "unzip", 2: "orbit", 3: "dem", 4: "stackSentinel", 5: "runISCE2"}
+## steps filling a shared cache, only one project at a time holds the cache
+STEP_RESOURCES = {2: "orbit-cache", 3: "dem-cache"}
+## manifest keys used by the batch runner, the other keys are S1stackApp options
+BATCH_KEYS = ("priority", "steps")
+POLL_INTERVAL = 1.0
+
+
+def load_manifest(manifest_file):
+    ############################################################
+    # read the projects of a json manifest {"defaults": {...}, "projects": [{...}, ...]}
+    # the keys are the S1stackApp options without the leading "--" ("lat-min" or "lat_min"),
+    # plus "priority" (higher first, default 0) and "steps" (default [1, 2, 3, 4, 5])
+    # <return> projects (list): dicts of name, priority, steps and options
+    ############################################################
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    defaults = manifest.get("defaults", {})
+    projects = []
+    for entry in manifest["projects"]:
+        options = {key.replace("_", "-"): value for key, value in dict(defaults, **entry).items()}
+        if "project" not in options:
+            raise ValueError(f"a project of {manifest_file} has no 'project' name: {entry}")
+        projects.append({
+            "name": options["project"],
+            "priority": options.pop("priority", 0),
+            "steps": sorted(int(step) for step in options.pop("steps", STEP_NAMES)),
+            "options": options,
+        })
+    names = [project["name"] for project in projects]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"duplicate project names in {manifest_file}: {duplicates}")
+    return projects
+
+
+def get_step_command(project, step, cores, mem_budget=None):
+    # S1stackApp command line of one step of a project, the unzip and runISCE2 steps
+    # are bounded to the cores (and the memory share) the step takes from the pool
+    cmd = [sys.executable, STACK_APP, "--step", str(step)]
+    for key, value in project["options"].items():
+        if key == "step":
+            continue
+        if isinstance(value, bool):
+            if value:
+                cmd.append(f"--{key}")
+        else:
+            cmd += [f"--{key}", str(value)]
+    if step == 1 and "njobs" not in project["options"]:
+        cmd += ["--njobs", str(cores)]
+    if step == 5 and "cores" not in project["options"]:
+        cmd += ["--cores", str(cores)]
+    if step == 5 and "mem-budget" not in project["options"] and mem_budget is not None:
+        cmd += ["--mem-budget", f"{mem_budget:.1f}"]
+    return cmd
+
+
+def get_step_cores(step, total_cores, isce_cores):
+    # cores taken from the pool by a step, stackSentinel and the downloads take one
+    if step == 1:
+        return min(4, total_cores)
+    if step == 5:
+        return min(isce_cores, total_cores)
+    return 1
+
+
+def print_progress(projects, start):
+    print(f"\n[batch {(time.time() - start)/60:.1f} min]")
+    print(f"  {'project':<24}{'done':>6}  {'state':<24}{'core time(h)':>13}")
+    for project in projects:
+        done = len(project["done"])
+        if project["failed"]:
+            state = f"failed at {STEP_NAMES[project['failed']]}"
+        elif project["running"]:
+            state = f"running {STEP_NAMES[project['running']]}"
+        elif done == len(project["steps"]):
+            state = "finished"
+        else:
+            state = "waiting"
+        print(f"  {project['name']:<24}{done:>3}/{len(project['steps']):<2}  {state:<24}"
+              f"{project['core_seconds']/3600:>13.2f}")
+
+
+def run_batch(projects, log_dir, total_cores=None, isce_cores=None):
+    ############################################################
+    # schedule the steps of all projects on one pool of total_cores cores
+    # a project runs its steps in order, a failed step stops its project only
+    # the ready steps start by priority, then by fair share (least core time used),
+    # as long as their cores fit in the pool (a step always starts on an idle pool)
+    # <1> projects (list)    : projects of load_manifest
+    # <2> log_dir (str)      : directory of the step logs <project>/step_<n>_<name>.log
+    # <3> total_cores (int)  : size of the pool (default : host cores)
+    # <4> isce_cores (int)   : cores of a runISCE2 step (default : half of the pool)
+    # a runISCE2 step gets the share of the host memory budget of its cores, so the
+    # concurrent steps do not each plan with the whole MemAvailable
+    # <return> bool : True if all steps of all projects succeeded
+    ############################################################
+    total_cores = total_cores or os.cpu_count()
+    isce_cores = isce_cores or max(total_cores // 2, 1)
+    mem_budget_gb = get_memory_budget_gb()
+    for order, project in enumerate(projects):
+        project.update(order=order, done=[], running=None, failed=None, core_seconds=0.0)
+    running = {}
+    used_cores = 0
+    held = set()
+    start = time.time()
+    print(f"batch of {len(projects)} projects on {total_cores} cores ({isce_cores} per runISCE2 step)")
+    while True:
+        ## start the ready steps
+        ready = [project for project in projects
+                 if not project["running"] and not project["failed"]
+                 and len(project["done"]) < len(project["steps"])]
+        ready.sort(key=lambda project: (-project["priority"], project["core_seconds"], project["order"]))
+        for project in ready:
+            step = project["steps"][len(project["done"])]
+            cores = get_step_cores(step, total_cores, isce_cores)
+            resource = STEP_RESOURCES.get(step)
+            if resource in held or (running and used_cores + cores > total_cores):
+                continue
+            project_log_dir = os.path.join(log_dir, project["name"])
+            os.makedirs(project_log_dir, exist_ok=True)
+            log = open(os.path.join(project_log_dir, f"step_{step}_{STEP_NAMES[step]}.log"), "w")
+            mem_budget = mem_budget_gb * cores / total_cores if mem_budget_gb is not None else None
+            proc = subprocess.Popen(get_step_command(project, step, cores, mem_budget),
+                                    stdout=log, stderr=subprocess.STDOUT)
+            running[proc] = (project, step, cores, resource, log, time.time())
+            project["running"] = step
+            used_cores += cores
+            if resource:
+                held.add(resource)
+            print(f"start {project['name']} step {step} ({STEP_NAMES[step]}) on {cores} cores")
+        if not running:
+            break
+        ## collect the finished steps
+        time.sleep(POLL_INTERVAL)
+        finished = False
+        for proc in list(running):
+            if proc.poll() is None:
+                continue
+            project, step, cores, resource, log, step_start = running.pop(proc)
+            log.close()
+            used_cores -= cores
+            held.discard(resource)
+            project["running"] = None
+            project["core_seconds"] += cores * (time.time() - step_start)
+            if proc.returncode == 0:
+                project["done"].append(step)
+            else:
+                project["failed"] = step
+                print(f"ERROR: {project['name']} step {step} failed (return code: {proc.returncode}), "
+                      f"see {log.name}")
+            finished = True
+        if finished:
+            print_progress(projects, start)
+    failed = [project["name"] for project in projects if project["failed"]]
+    print(f"batch finished in {(time.time() - start)/3600:.2f} h, "
+          f"{len(projects) - len(failed)}/{len(projects)} projects succeeded")
+    if failed:
+        print(f"failed projects: {failed}")
+    return not failed
+
+
+def create_parser():
+    EPILOG = S1_config['S1batchApp']
+    parser = argparse.ArgumentParser(
+        description='run the S1stackApp workflow of several projects on one worker pool',
+        epilog=EPILOG,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--manifest', type=str, required=True,
+                        help='json manifest of the projects')
+    parser.add_argument('--cores', type=int, default=None,
+                        help='number of cores of the pool shared by all projects (default : all)')
+    parser.add_argument('--isce-cores', type=int, default=None,
+                        help='cores of one runISCE2 step (default : half of the pool)')
+    parser.add_argument('--log-dir', type=str, default='batch_logs',
+                        help='directory of the step logs (default : batch_logs)')
+    parser.add_argument('--logo', action='store_true', default=False,
+                        help='show the logo of IntfLab (default : False)')
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    args = parser.parse_args()
+    if args.logo:
+        show_logo()
+    try:
+        projects = load_manifest(args.manifest)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"ERROR: can not load the manifest {args.manifest}: {e}")
+        sys.exit(1)
+    success = run_batch(projects, os.path.abspath(args.log_dir), args.cores, args.isce_cores)
+    sys.exit(0 if success else 1)
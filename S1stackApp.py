@@ -15,8 +15,10 @@
 
 import os
 import sys
+import time
 import argparse
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from cores.validation import S1ParameterValidator
 from cores.workspace import S1WorkspaceManager
 from lab_utils import *
@@ -24,7 +26,7 @@ from S1_burst2safe import S1_burst2safe
 from S1_unzip import unzip_S1_SLC_list, get_S1_zip_files
 from S1_dem import download_S1_SLC_dem 
 from S1_orbit import download_S1_SLC_orbit_list, download_file
-from S1_stackSentinel import stack_sentinel
+from S1_stackSentinel import stack_sentinel, update_stack_sentinel
 from S1_runISCE2 import auto_insar_stacking_ISCE2
 from lab_utils import S1_config
 from lab_utils import logo as show_logo
@@ -60,6 +62,22 @@ def create_parser():
     ## S1/S1_burst 
     parser.add_argument('--mode', type=str, default='S1', 
                         help = "Sentinel1 process mode: S1 or S1_burst (default=S1) ")
+    parser.add_argument('--selective-unzip', action='store_true', default=False,
+                        help='only extract the swaths (S1) or take the bursts (S1_burst) intersecting the bbox in step 1 (default : False)')
+    parser.add_argument('--polarization', type=str, default='vv',
+                        help='polarization kept by --selective-unzip and processed by stackSentinel.py (default : vv)')
+    parser.add_argument('--virtual-safe', action='store_true', default=False,
+                        help='read the measurement tiffs from the zips in place instead of unzipping them (default : False)')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='only coregister and pair the dates not yet in the stack in steps 4-5 (default : False)')
+    parser.add_argument('--pipeline', action='store_true', default=False,
+                        help='run the unzip, orbit and DEM steps 1-3 concurrently when all steps run (default : False)')
+    parser.add_argument('--njobs', type=int, default=None,
+                        help='number of parallel extraction jobs in step 1 (default : auto)')
+    parser.add_argument('--cores', type=int, default=None,
+                        help='number of concurrent run-file lines in step 5 (default : auto)')
+    parser.add_argument('--mem-budget', type=float, default=None,
+                        help='memory (GB) for the concurrent run-file lines in step 5 (default : auto)')
     ## logo reset and update
     parser.add_argument('--logo', action='store_true', default=True,
                         help='show the logo of IntfLab (default : True)')
@@ -74,9 +92,52 @@ def create_parser():
 
 
 
+def prepare_inputs_pipelined(zip_source_dir, project_dir, slc_dir, orbit_dir, dem_dir,
+                             lat_min, lat_max, lon_min, lon_max, mode, update_mode,
+                             selective_unzip=False, polarization='vv', virtual_safe=False, njobs=None):
+    ############################################################
+    # run the steps 1-3 as overlapping stages : the disk-bound SLC extraction, and the
+    # network-bound orbit and DEM downloads run concurrently
+    # in the S1 mode the orbits are looked up from the zip names (the SAFE names) right away,
+    # in the S1_burst mode the SAFE names are only known once burst2safe is done
+    # returns when all the inputs of stackSentinel are ready, the first error is raised
+    ############################################################
+    def prepare_slc():
+        if mode == "S1":
+            bbox = [lat_min, lat_max, lon_min, lon_max] if selective_unzip else None
+            unzip_S1_SLC_list(zip_source_dir, slc_dir, update_mode=update_mode, n_jobs=njobs,
+                              bbox=bbox, polarization=polarization, virtual=virtual_safe)
+        elif mode == "S1_burst":
+            bbox = [lat_min, lat_max, lon_min, lon_max] if selective_unzip else None
+            S1_burst2safe(zip_source_dir, project_dir, update_mode, bbox=bbox, polarization=polarization)
+
+    def prepare_orbits(slc_stage):
+        if mode == "S1":
+            safe_names = [os.path.basename(zip_file)[:-4] + ".SAFE"
+                          for zip_file in get_S1_zip_files(zip_source_dir)]
+            download_S1_SLC_orbit_list(slc_dir, orbit_dir, update_mode=update_mode, safe_names=safe_names)
+        else:
+            slc_stage.result()
+            download_S1_SLC_orbit_list(slc_dir, orbit_dir, update_mode=update_mode)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        slc_stage = executor.submit(prepare_slc)
+        stages = {
+            slc_stage : "SLC",
+            executor.submit(prepare_orbits, slc_stage) : "orbit",
+            executor.submit(download_S1_SLC_dem, lat_min, lat_max, lon_min, lon_max, str(dem_dir)) : "DEM",
+        }
+        for stage in as_completed(stages):
+            stage.result()
+            print(f"pipeline stage {stages[stage]} ready after {time.time() - start:.1f} s")
+
+
 def S1_auto_InSAR_stacking(data_dir, work_dir, project, 
                         lat_min, lat_max, lon_min, lon_max, 
-                        nalks, nrlks, mode, update_mode, step):
+                        nalks, nrlks, mode, update_mode, step,
+                        selective_unzip=False, polarization='vv', virtual_safe=False, incremental=False,
+                        pipeline=False, cores=None, mem_budget=None, njobs=None):
     # Complete S1 InSAR preprocessing pipeline using ISCE2
     # <1>  data_dir    (str)    : Base data directory containing project folder with zip files
     # <2>  work_dir    (str)    : Base working directory 
@@ -90,6 +151,14 @@ def S1_auto_InSAR_stacking(data_dir, work_dir, project,
     # <10> mode        (str)    : use S1/S1_burst mode to process Sentinel1 datasets
     # <11> step        (str)    : dostep execute in the Timeseries InSAR processing
     # <12> update_mode (bool)   : whether cover exist files and overwrite thems  
+    # <13> selective_unzip (bool) : only extract the swaths intersecting the bbox
+    # <14> polarization (str)  : polarization kept by the selective unzip and processed by stackSentinel.py
+    # <15> virtual_safe (bool) : write VRTs reading the measurement tiffs from the zips in place
+    # <16> incremental (bool) : only process the new dates against the existing stack
+    # <17> pipeline (bool)    : run the steps 1-3 concurrently when all steps run
+    # <18> cores (int)        : number of concurrent run-file lines in step 5 (default : auto)
+    # <19> mem_budget (float) : memory (GB) for the run-file lines in step 5 (default : auto)
+    # <20> njobs (int)        : number of parallel extraction jobs in step 1 (default : auto)
     
     # init project directory
     workspace = S1WorkspaceManager(work_dir, project)
@@ -103,29 +172,48 @@ def S1_auto_InSAR_stacking(data_dir, work_dir, project,
     process_dir = workspace.process_dir
     print(f"go to project directory : {project_dir}")
     
+    # step 1-3 : pipelined unzip, orbit and dem downloads
+    if pipeline and step == '-':
+        prepare_inputs_pipelined(zip_source_dir, project_dir, slc_dir, orbit_dir, dem_dir,
+                                 lat_min, lat_max, lon_min, lon_max, mode, update_mode,
+                                 selective_unzip=selective_unzip, polarization=polarization,
+                                 virtual_safe=virtual_safe, njobs=njobs)
     # step 1: unzip SLC files
-    if step == 1 or step == '-':
+    if step == 1 or (step == '-' and not pipeline):
         if mode == "S1":
-            unzip_S1_SLC_list(zip_source_dir,slc_dir,update_mode=update_mode)
+            bbox = [lat_min, lat_max, lon_min, lon_max] if selective_unzip else None
+            unzip_S1_SLC_list(zip_source_dir,slc_dir,update_mode=update_mode,n_jobs=njobs,
+                              bbox=bbox, polarization=polarization, virtual=virtual_safe)
         elif mode == "S1_burst":
-            S1_burst2safe(datadir, workdir)
+            bbox = [lat_min, lat_max, lon_min, lon_max] if selective_unzip else None
+            S1_burst2safe(zip_source_dir, project_dir, update_mode, bbox=bbox, polarization=polarization)
     # step2 : download orbit files
-    if step == 2 or step == '-':
+    if step == 2 or (step == '-' and not pipeline):
         download_S1_SLC_orbit_list(slc_dir, orbit_dir, update_mode = update_mode)
     # step3 : download dem files
-    if step == 3 or step == '-':
+    if step == 3 or (step == '-' and not pipeline):
         download_S1_SLC_dem(lat_min, lat_max, lon_min, lon_max, str(dem_dir))
     # step 4: Generate stack processing runfiles
     if step == 4 or step == '-':
-        stack_sentinel(
-            lat_min, lat_max, lon_min, lon_max,
-            str(dem_dir), str(aux_dir), str(slc_dir), str(orbit_dir),
-            nalks, nrlks, str(process_dir)
-        )
-    # step 5 : batch run files ~
-    elif step == 5 or step == '-':
+        if incremental:
+            update_stack_sentinel(
+                lat_min, lat_max, lon_min, lon_max,
+                str(dem_dir), str(aux_dir), str(slc_dir), str(orbit_dir),
+                nalks, nrlks, str(process_dir), polarization=polarization
+            )
+        else:
+            stack_sentinel(
+                lat_min, lat_max, lon_min, lon_max,
+                str(dem_dir), str(aux_dir), str(slc_dir), str(orbit_dir),
+                nalks, nrlks, str(process_dir), polarization=polarization
+            )
+    # step 5 : batch run files ~ (an up-to-date stack keeps its run files, the journal skips the lines already done)
+    if step == 5 or step == '-':
         runfiles_dir = os.path.join(process_dir, "run_files")
-        auto_insar_stacking_ISCE2(str(runfiles_dir), nounwrap=False)
+        if os.path.isdir(runfiles_dir):
+            auto_insar_stacking_ISCE2(str(runfiles_dir), nounwrap=False, cores=cores, mem_budget=mem_budget)
+        else:
+            print(f"no run files in {process_dir}, nothing to run in step 5")
     
     print('normal S1stackApp.py workflow finished ~')
     os.chdir(project_dir)    
@@ -144,6 +232,7 @@ if __name__ == '__main__':
     nalks, nrlks = args.nalks, args.nrlks
     mode, step = args.mode, args.step
     logo, reset = args.logo, args.reset 
+    update_mode = args.update
 
     # logo 
     if logo: 
@@ -185,5 +274,9 @@ if __name__ == '__main__':
              
     S1_auto_InSAR_stacking(data_dir, work_dir, project, 
                         lat_min, lat_max, lon_min, lon_max, 
-                        nalks, nrlks, mode, update_mode, step)
+                        nalks, nrlks, mode, update_mode, step,
+                        selective_unzip=args.selective_unzip, polarization=args.polarization,
+                        virtual_safe=args.virtual_safe, incremental=args.incremental,
+                        pipeline=args.pipeline, cores=args.cores, mem_budget=args.mem_budget,
+                        njobs=args.njobs)
     
\ No newline at end of file
@@ -6,10 +6,19 @@
     
 from mintpy.utils.writefile import * 
 from osgeo import gdal  
-import os, sys
+import os, sys, re
+import fnmatch
+import fcntl
+import contextlib
+import time
+import shutil
+import sqlite3
+import hashlib
+import zipfile
 import numpy as np
 import math
 import geopandas as gpd
+from joblib import Parallel, delayed
 from shapely.geometry import Polygon
 
 software = """
@@ -28,6 +37,15 @@ software = """
 # configDict for some satellite, only support sentinel1 now
 S1_config = {
     "ORBIT_URL"  : "https://s1qc.asf.alaska.edu/aux_poeorb/",
+    ## shared caches (orbits, dem tiles) of all projects, overridden by $INTFLAB_CACHE_DIR
+    "CACHE_DIR"  : os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "intflab"),
+    "ORBIT_CACHE_MAX_GB"       : 5,
+    "ORBIT_CACHE_MAX_AGE_DAYS" : 730,
+    ## SRTMGL1 tile mirror (http(s):// or file://) and the EGM96 geoid grid for the wgs84 correction
+    "DEM_URL"    : "http://step.esa.int/auxdata/dem/SRTMGL1/",
+    "EGM96_URL"  : "https://cdn.proj.org/us_nga_egm96_15.tif",
+    "DEM_CACHE_MAX_GB"         : 20,
+    "DEM_CACHE_MAX_AGE_DAYS"   : 730,
     "wavelength" : 0.05546576, 
     "S1stackApp" : """
     Examples:
@@ -40,12 +58,168 @@ S1_config = {
     python S1stackApp.py --data-dir /path/to/data --work-dir /path/to/work \\
                         --project myproject --lat-min 30.0 --lat-max 31.0 \\
                         --lon-min 120.0 --lon-max 121.0 --nalks 4 --nrlks 16 --step 1
+    """,
+    "S1batchApp" : """
+    Examples:
+    # Run all the projects of a manifest on 32 cores
+    python S1batchApp.py --manifest projects.json --cores 32
+
+    # projects.json : "defaults" apply to every project, the keys are the S1stackApp options
+    {
+      "defaults" : {"data-dir": "/path/to/data", "work-dir": "/path/to/work", "nalks": 4, "nrlks": 16},
+      "projects" : [
+        {"project": "aoi_1", "lat-min": 30.0, "lat-max": 31.0, "lon-min": 120.0, "lon-max": 121.0,
+         "priority": 1},
+        {"project": "aoi_2", "lat-min": 35.0, "lat-max": 35.5, "lon-min": 110.0, "lon-max": 111.0,
+         "steps": [1, 2, 3, 4], "selective-unzip": true}
+      ]
+    }
     """
 }
 
 def logo():
     print(software)
+
+def get_cache_dir(name):
+    # get (create) a sub directory of the shared IntfLab cache, e.g. get_cache_dir("orbits")
+    cache_dir = os.path.join(os.environ.get("INTFLAB_CACHE_DIR", S1_config["CACHE_DIR"]), name)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+@contextlib.contextmanager
+def cache_lock(path):
+    # hold an exclusive fcntl lock on path + ".lock" while the block runs, so the processes
+    # of several projects sharing the cache do not write the same temporary file at once
+    with open(path + ".lock", "a") as lock_f:
+        fcntl.flock(lock_f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_f, fcntl.LOCK_UN)
     
+## how a dataset directory is staged into an analysis (Mintpy/Miaplpy) directory
+##  copy     : independent copy of the files
+##  hardlink : hardlinks to the files (copy across file systems), no extra disk
+##  symlink  : symbolic links to the files
+## the directories are always created, so the files written by the analysis stay in its directory
+STAGE_METHODS = ("copy", "hardlink", "symlink")
+## transfer threads and copy chunk of the staging
+STAGE_JOBS = 8
+STAGE_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def remove_path(path):
+    # remove a file, a symbolic link or a directory tree
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def copy_file_data(src, dst, chunk_size=STAGE_CHUNK_SIZE):
+    # copy the data of src to dst with copy_file_range (in kernel, reflinks on btrfs/xfs),
+    # falling back to shutil.copyfile (sendfile) where it is not supported
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), chunk_size) > 0:
+                    pass
+                return
+            except OSError:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, chunk_size)
+
+
+def is_file_staged(src, dst, method):
+    # whether dst is already an up-to-date staged copy / link of src
+    if method == "symlink":
+        return os.path.islink(dst) and os.readlink(dst) == os.path.abspath(src)
+    if os.path.islink(dst) or not os.path.isfile(dst):
+        return False
+    if method == "hardlink" and os.path.samefile(src, dst):
+        return True
+    src_stat, dst_stat = os.stat(src), os.stat(dst)
+    return src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+
+def stage_file(src, dst, method="copy"):
+    ############################################################
+    # stage one file with a STAGE_METHODS method, replacing an outdated dst
+    # a hardlink falls back to a copy across file systems, a copy is written to
+    # dst.part and renamed so an interrupted copy is never taken as up to date
+    # <return> number of bytes copied (0 for a link)
+    ############################################################
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if method == "symlink":
+        os.symlink(os.path.abspath(src), dst)
+        return 0
+    if method == "hardlink":
+        try:
+            os.link(src, dst)
+            return 0
+        except OSError:
+            pass
+    copy_file_data(src, dst + ".part")
+    shutil.copystat(src, dst + ".part")
+    os.replace(dst + ".part", dst)
+    return os.path.getsize(dst)
+
+
+def sync_trees(tree_pairs, method="copy", njobs=STAGE_JOBS, exclude=()):
+    ############################################################
+    # stage several directory trees, only the files missing or changed in dst (size / mtime,
+    # or the link target) are transferred, on a pool of njobs threads
+    # the files only present in dst (e.g. written by the analysis) are kept
+    # <1> tree_pairs (list) : [(src, dst)] directories
+    # <2> method (str)      : one of STAGE_METHODS (default : copy)
+    # <3> njobs (int)       : number of transfer threads (default : STAGE_JOBS)
+    # <4> exclude (tuple)   : file name patterns not staged (e.g. the files written in dst
+    #                         from the src ones), their dst files are kept as they are
+    # <return> (n_files, n_transferred, nbytes) : files of the trees, files transferred, bytes copied
+    ############################################################
+    if method not in STAGE_METHODS:
+        raise ValueError(f"unknown stage method {method}, expected one of {STAGE_METHODS}")
+    tasks, n_files = [], 0
+    for src, dst in tree_pairs:
+        if os.path.islink(dst) or os.path.isfile(dst):
+            os.remove(dst)
+        for root, dirs, files in os.walk(src):
+            target_root = os.path.join(dst, os.path.relpath(root, src))
+            os.makedirs(target_root, exist_ok=True)
+            for file in files:
+                if any(fnmatch.fnmatch(file, pattern) for pattern in exclude):
+                    continue
+                n_files += 1
+                src_file, dst_file = os.path.join(root, file), os.path.join(target_root, file)
+                if not is_file_staged(src_file, dst_file, method):
+                    tasks.append((src_file, dst_file))
+    start = time.time()
+    nbytes = sum(Parallel(n_jobs=max(min(njobs, len(tasks)), 1), prefer="threads")(
+        delayed(stage_file)(src_file, dst_file, method) for src_file, dst_file in tasks
+    ))
+    elapsed = time.time() - start
+    print(f"{method} {len(tasks)}/{n_files} files changed, {nbytes/1024**2:.1f} MB copied in {elapsed:.1f} s"
+          + (f" ({nbytes/1024**2/elapsed:.1f} MB/s)" if nbytes and elapsed > 0 else ""))
+    return n_files, len(tasks), nbytes
+
+
+def stage_tree(src, dst, method="copy", njobs=STAGE_JOBS, exclude=()):
+    ############################################################
+    # stage the directory tree src to dst, only the changed files are transferred
+    # <1> src (str)       : source directory
+    # <2> dst (str)       : destination directory
+    # <3> method (str)    : one of STAGE_METHODS (default : copy)
+    # <4> njobs (int)     : number of transfer threads (default : STAGE_JOBS)
+    # <5> exclude (tuple) : file name patterns not staged, see sync_trees
+    # <return> number of files of the tree
+    ############################################################
+    return sync_trees([(src, dst)], method, njobs, exclude)[0]
+
+
 ## transform the geobbox to SAR row/col numbers     
 def generate_shp(lat_min, lat_max, lon_min, lon_max, output_path="roi.shp"): 
     # generate a shapefile for a bounding box.
@@ -88,22 +262,274 @@ def bbox2SAR(lat_min, lat_max, lon_min, lon_max, lat_data, lon_data):
     region_rec = [10*math.floor(region_list[:,0].min()/10),10*math.ceil(region_list[:,0].max()/10),\
               10*math.floor(region_list[:,1].min()/10),10*math.ceil(region_list[:,1].max()/10)]
     return region_rec
+
+
+## lookuptable block index : lat/lon min/max of each block_size*block_size block
+LUT_BLOCK_SIZE = 256
+
+def _squeeze_lut(data):
+    # drop the trailing band axis of read_isce_file arrays (rows, cols, 1) -> (rows, cols)
+    if data.ndim == 3:
+        data = data[:, :, 0]
+    return data
+
+def build_lut_index(lat_data, lon_data, block_size=LUT_BLOCK_SIZE):
+    # build a coarse lat/lon min/max pyramid of the lookuptable, one row block at a time
+    # <1> lat_data (np.array) : the latitude lookuptable lat.rdr
+    # <2> lon_data (np.array) : the lontitude lookuptable lon.rdr
+    # <3> block_size (int)    : the block size in pixels, default LUT_BLOCK_SIZE
+    # <return> lut_index (np.array) : [lat_min, lat_max, lon_min, lon_max] x nblock_y x nblock_x
+    lat_data, lon_data = _squeeze_lut(lat_data), _squeeze_lut(lon_data)
+    rows, cols = lat_data.shape
+    nblock_y, nblock_x = math.ceil(rows / block_size), math.ceil(cols / block_size)
+    col_starts = np.arange(0, cols, block_size)
+    lut_index = np.empty([4, nblock_y, nblock_x], dtype=np.float64)
+    for by in range(nblock_y):
+        r0, r1 = by * block_size, min((by + 1) * block_size, rows)
+        for k, data in enumerate((lat_data, lon_data)):
+            block = np.asarray(data[r0:r1], dtype=np.float64)
+            ## fmin/fmax ignore the nan (no-data) pixels of the lookuptable
+            lut_index[2*k, by] = np.fmin.reduceat(np.fmin.reduce(block, axis=0), col_starts)
+            lut_index[2*k+1, by] = np.fmax.reduceat(np.fmax.reduce(block, axis=0), col_starts)
+    return lut_index
+
+def load_lut_index(lat_file, lon_file, lat_data=None, lon_data=None, block_size=LUT_BLOCK_SIZE):
+    # load the lookuptable block index cached beside lat_file, (re)build it if missing or outdated
+    # <1> lat_file (str)      : the latitude lookuptable file lat.rdr / lat.rdr.full
+    # <2> lon_file (str)      : the lontitude lookuptable file lon.rdr / lon.rdr.full
+    # <3> lat_data (np.array) : the loaded latitude lookuptable, read from lat_file if None
+    # <4> lon_data (np.array) : the loaded lontitude lookuptable, read from lon_file if None
+    # <5> block_size (int)    : the block size in pixels, default LUT_BLOCK_SIZE
+    # <return> lut_index (np.array) : the block index, see build_lut_index
+    cache_file = os.path.join(os.path.dirname(lat_file), f".{os.path.basename(lat_file)}.lutidx.npz")
+    mtimes = np.array([os.path.getmtime(lat_file), os.path.getmtime(lon_file)])
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cache:
+            if int(cache["block_size"]) == block_size and np.array_equal(cache["mtimes"], mtimes):
+                return cache["lut_index"]
+    print(f"building lookuptable block index of {os.path.basename(lat_file)} ...")
+    if lat_data is None:lat_data = read_raster(lat_file)
+    if lon_data is None:lon_data = read_raster(lon_file)
+    lut_index = build_lut_index(lat_data, lon_data, block_size)
+    try:
+        np.savez(cache_file, lut_index=lut_index, block_size=block_size, mtimes=mtimes)
+    except OSError as e:
+        print(f"WARNING: could not cache lookuptable index {cache_file}: {e}")
+    return lut_index
+
+def bbox2SAR_indexed(lat_min, lat_max, lon_min, lon_max, lat_data, lon_data, lut_index, block_size=LUT_BLOCK_SIZE):
+    # same as bbox2SAR, but only the blocks of lut_index intersecting the bbox are masked
+    # <1~4> lat_min, lat_max, lon_min, lon_max (float): bounding box coordinates
+    # <5> lat_data (np.array)  : the latitude lookuptable lat.rdr (np.array or np.memmap)
+    # <6> lon_data (np.array)  : the lontitude lookuptable lon.rdr (np.array or np.memmap)
+    # <7> lut_index (np.array) : the block index of the lookuptable, see load_lut_index
+    # <8> block_size (int)     : the block size of lut_index
+    # <return> region_rec: return the SAR row col list
+    S, N, W, E = lat_min, lat_max, lon_min, lon_max
+    lat_data, lon_data = _squeeze_lut(lat_data), _squeeze_lut(lon_data)
+    blk_lat_min, blk_lat_max, blk_lon_min, blk_lon_max = lut_index
+    candidate = (blk_lat_max >= S)*(blk_lat_min <= N)*(blk_lon_max >= W)*(blk_lon_min <= E)
+    y_min, y_max, x_min, x_max = None, None, None, None
+    for by, bx in np.argwhere(candidate):
+        r0, c0 = by * block_size, bx * block_size
+        lat_block = lat_data[r0:r0+block_size, c0:c0+block_size]
+        lon_block = lon_data[r0:r0+block_size, c0:c0+block_size]
+        data_map = (lon_block >= W)*(lon_block <= E)*(lat_block >= S)*(lat_block <= N)
+        region_list = np.argwhere(data_map)
+        if region_list.size == 0:
+            continue
+        rmin, cmin = region_list.min(axis=0) + [r0, c0]
+        rmax, cmax = region_list.max(axis=0) + [r0, c0]
+        y_min = rmin if y_min is None else min(y_min, rmin)
+        y_max = rmax if y_max is None else max(y_max, rmax)
+        x_min = cmin if x_min is None else min(x_min, cmin)
+        x_max = cmax if x_max is None else max(x_max, cmax)
+    if y_min is None:
+        raise ValueError(f"bbox [{S}, {N}] x [{W}, {E}] does not intersect the lookuptable")
+    region_rec = [10*math.floor(y_min/10),10*math.ceil(y_max/10),\
+              10*math.floor(x_min/10),10*math.ceil(x_max/10)]
+    return region_rec
+
+def geom_bbox2SAR(lat_min, lat_max, lon_min, lon_max, lat_file, lon_file):
+    # convert geographic bounding box to SAR ROI using the cached block index of geom_reference
+    # <1~4> lat_min, lat_max, lon_min, lon_max (float): bounding box coordinates
+    # <5> lat_file (str) : geom_reference lat.rdr / lat.rdr.full
+    # <6> lon_file (str) : geom_reference lon.rdr / lon.rdr.full
+    # <return> region_rec: return the SAR row col list [y0, y1, x0, x1]
+    lat_data = open_raster(lat_file)
+    lon_data = open_raster(lon_file)
+    lut_index = load_lut_index(lat_file, lon_file, lat_data, lon_data)
+    return bbox2SAR_indexed(lat_min, lat_max, lon_min, lon_max, lat_data, lon_data, lut_index)
     
+def get_roi_window(lat_file, lon_file, lat_min, lat_max, lon_min, lon_max):
+    # ROI window of geom_bbox2SAR clipped to the size of the lookup table
+    # <1> lat_file (str) : geom_reference lat.rdr (multilooked grid) / lat.rdr.full(.vrt) (full resolution grid)
+    # <2> lon_file (str) : geom_reference lon.rdr / lon.rdr.full(.vrt)
+    # <3~6> lat_min, lat_max, lon_min, lon_max (float): bounding box coordinates
+    # <return> window (list): [y0, y1, x0, x1]
+    length, width = open_raster(lat_file).shape
+    y0, y1, x0, x1 = geom_bbox2SAR(lat_min, lat_max, lon_min, lon_max, lat_file, lon_file)
+    return [max(int(y0), 0), min(int(y1), length), max(int(x0), 0), min(int(x1), width)]
+
+def write_roi_window(window, roi_file):
+    # save the [y0, y1, x0, x1] ROI window in the "key : value" format of roi.par
+    with open(roi_file, "w") as par:
+        for key, value in zip(("y0", "y1", "x0", "x1"), window):
+            par.write(f"{key} : {value}\n")
+    print(f"ROI window {window} saved in {roi_file}")
+
+## numpy dtypes of the ISCE2 xml / ENVI hdr / GDAL vrt raw binary data types
+ISCE_DTYPE = {"BYTE": "u1", "CHAR": "u1", "SHORT": "i2", "INT": "i4", "LONG": "i8",
+              "FLOAT": "f4", "DOUBLE": "f8", "CFLOAT": "c8", "CDOUBLE": "c16"}
+ENVI_DTYPE = {1: "u1", 2: "i2", 3: "i4", 4: "f4", 5: "f8", 6: "c8", 9: "c16",
+              12: "u2", 13: "u4", 14: "i8", 15: "u8"}
+VRT_DTYPE  = {"Byte": "u1", "Int16": "i2", "UInt16": "u2", "Int32": "i4", "UInt32": "u4",
+              "Int64": "i8", "UInt64": "u8", "Float32": "f4", "Float64": "f8",
+              "CFloat32": "c8", "CFloat64": "c16"}
+
+def _interleave_layout(data_file, dtype, rows, cols, bands, interleave, header_offset=0):
+    # raw band layouts (file, dtype, offset, pixel_stride, line_stride, rows, cols) of a BIL/BIP/BSQ binary
+    size = dtype.itemsize
+    interleave = interleave.upper()
+    layouts = []
+    for b in range(bands):
+        if interleave == "BIL":
+            layout = (b*cols*size, size, bands*cols*size)
+        elif interleave == "BIP":
+            layout = (b*size, bands*size, bands*cols*size)
+        elif interleave == "BSQ":
+            layout = (b*rows*cols*size, size, cols*size)
+        else:
+            raise ValueError(f"Unsupported interleave scheme: {interleave}")
+        offset, pixel_stride, line_stride = layout
+        layouts.append((data_file, dtype, header_offset + offset, pixel_stride, line_stride, rows, cols))
+    return layouts
+
+def _raw_layout_from_isce_xml(data_file, xml_file):
+    import xml.etree.ElementTree as ET
+    props = {}
+    for prop in ET.parse(xml_file).getroot().findall("property"):
+        value = prop.find("value")
+        if value is not None:
+            props[prop.get("name").lower()] = value.text.strip()
+    dtype = np.dtype(ISCE_DTYPE[props["data_type"].upper()])
+    dtype = dtype.newbyteorder(">" if props.get("byte_order", "l").lower().startswith("b") else "<")
+    return _interleave_layout(data_file, dtype, int(props["length"]), int(props["width"]),
+                              int(props.get("number_bands", 1)), props.get("scheme", "BIP"))
+
+def _raw_layout_from_envi_hdr(data_file, hdr_file):
+    props = {}
+    with open(hdr_file, "r") as hdr:
+        for line in hdr:
+            if "=" in line:
+                key, value = line.split("=", 1)
+                props[key.strip().lower()] = value.strip()
+    dtype = np.dtype(ENVI_DTYPE[int(props["data type"])])
+    dtype = dtype.newbyteorder(">" if props.get("byte order", "0") == "1" else "<")
+    return _interleave_layout(data_file, dtype, int(props["lines"]), int(props["samples"]),
+                              int(props.get("bands", 1)), props.get("interleave", "bsq"),
+                              int(props.get("header offset", 0)))
+
+def _raw_layout_from_vrt(vrt_file):
+    # only VRTRawRasterBand vrt files (as written by ISCE2) describe a raw binary, return None otherwise
+    import xml.etree.ElementTree as ET
+    root = ET.parse(vrt_file).getroot()
+    rows, cols = int(root.get("rasterYSize")), int(root.get("rasterXSize"))
+    layouts = []
+    for band in root.findall("VRTRasterBand"):
+        if band.get("subClass") != "VRTRawRasterBand":
+            return None
+        source = band.find("SourceFilename")
+        data_file = source.text.strip()
+        if source.get("relativeToVRT", "0") == "1":
+            data_file = os.path.join(os.path.dirname(vrt_file), data_file)
+        dtype = np.dtype(VRT_DTYPE[band.get("dataType")])
+        dtype = dtype.newbyteorder(">" if band.findtext("ByteOrder", "LSB").upper() == "MSB" else "<")
+        layouts.append((data_file, dtype, int(band.findtext("ImageOffset", "0")),
+                        int(band.findtext("PixelOffset", str(dtype.itemsize))),
+                        int(band.findtext("LineOffset", str(dtype.itemsize*cols))), rows, cols))
+    return layouts or None
+
+def get_raw_layout(file):
+    # find the raw binary band layouts of a file from its .xml/.hdr/.vrt metadata
+    # <1> file (str) : the path of the ISCE2/ENVI binary file (or its .vrt)
+    # <return> layouts (list) : (file, dtype, offset, pixel_stride, line_stride, rows, cols) per band, None if not raw
+    if file.endswith(".vrt"):
+        return _raw_layout_from_vrt(file)
+    if os.path.exists(file + ".xml"):
+        return _raw_layout_from_isce_xml(file, file + ".xml")
+    for hdr_file in (file + ".hdr", os.path.splitext(file)[0] + ".hdr"):
+        if os.path.exists(hdr_file):
+            return _raw_layout_from_envi_hdr(file, hdr_file)
+    if os.path.exists(file + ".vrt"):
+        return _raw_layout_from_vrt(file + ".vrt")
+    return None
+
+def _memmap_band(layout):
+    data_file, dtype, offset, pixel_stride, line_stride, rows, cols = layout
+    buffer = np.memmap(data_file, dtype=np.uint8, mode="r")
+    return np.ndarray((rows, cols), dtype=dtype, buffer=buffer, offset=offset,
+                      strides=(line_stride, pixel_stride))
+
+def read_raster(file, window=None, band=1):
+    # read (part of) a raster band, a zero-copy np.memmap view for raw ISCE2/ENVI binaries,
+    # a GDAL windowed ReadAsArray for other formats
+    # <1> file (str)            : a string-path of input file
+    # <2> window (list)         : [y0, y1, x0, x1] row/col window as returned by bbox2SAR, None for full size
+    # <3> band (int/list)       : 1-based band number, or list of band numbers
+    # <return> data (np.array)  : (rows, cols) for a single band, (rows, cols, bands) for a band list
+    bands = [band] if isinstance(band, int) else list(band)
+    layouts = get_raw_layout(file)
+    if layouts is not None:
+        y0, y1, x0, x1 = window if window is not None else (0, layouts[0][5], 0, layouts[0][6])
+        data = [_memmap_band(layouts[b-1])[y0:y1, x0:x1] for b in bands]
+    else:
+        ds = gdal.Open(file, gdal.GA_ReadOnly)
+        if ds is None:
+            raise RuntimeError(f"Could not open file: {file}")
+        y0, y1, x0, x1 = window if window is not None else (0, ds.RasterYSize, 0, ds.RasterXSize)
+        y1, x1 = min(y1, ds.RasterYSize), min(x1, ds.RasterXSize)
+        data = [ds.GetRasterBand(b).ReadAsArray(x0, y0, x1 - x0, y1 - y0) for b in bands]
+        ds = None
+    if isinstance(band, int):
+        return data[0]
+    return np.stack(data, axis=2)
+
+class _GdalBand:
+    # lazy (rows, cols) view of a GDAL raster band, a [rows, cols] slice reads only that window
+    def __init__(self, file, band=1):
+        ds = gdal.Open(file, gdal.GA_ReadOnly)
+        if ds is None:
+            raise RuntimeError(f"Could not open file: {file}")
+        self.file, self.band = file, band
+        self.shape, self.ndim = (ds.RasterYSize, ds.RasterXSize), 2
+        ds = None
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        y0, y1, _ = rows.indices(self.shape[0])
+        x0, x1, _ = cols.indices(self.shape[1])
+        return read_raster(self.file, [y0, y1, x0, x1], self.band)
+
+def open_raster(file, band=1):
+    # a raster band to be sliced block by block : the np.memmap view of a raw binary,
+    # a lazy windowed GDAL reader otherwise (e.g. the mosaic .vrt of the merged geometry)
+    # <1> file (str) : a string-path of input file
+    # <2> band (int) : 1-based band number
+    if get_raw_layout(file) is not None:
+        return read_raster(file, band=band)
+    return _GdalBand(file, band)
+
 ## convert ISCE2 formatted file to npArray
-def read_isce_file(file):
-    # convert a GDAL_realiable file (usually ISCE2 file) to a numpy array 
+def read_isce_file(file, window=None):
+    # convert a GDAL_realiable file (usually ISCE2 file) to a float32 numpy array (rows, cols, 1)
     # <1> file(str): a string-path of input file 
+    # <2> window (list): [y0, y1, x0, x1] row/col window, None for full size
     _, ext = os.path.splitext(file)
-    ds = gdal.Open(file,gdal.GA_ReadOnly)
-    print("input dataset BandsCount : ", ds.RasterCount)
     ## get the phase band for the unw data
-    if ext != ".unw":band = ds.GetRasterBand(1)
-    else:band = band = ds.GetRasterBand(2)
-    data = np.expand_dims(band.ReadAsArray(), 2)
-    W, L, N = data.shape
-    loader = np.zeros([W, L, N], dtype=np.float32)
-    loader[:,:,0] = data[:,:,0]
-    return loader
+    band = 2 if ext == ".unw" else 1
+    data = read_raster(file, window=window, band=band)
+    return np.asarray(data, dtype=np.float32)[:, :, np.newaxis]
 
 ## read roi.par file to the Python dictionary
 def read_roi_par(file):
@@ -135,44 +561,420 @@ def write_gdal_file(arr, output_filepath, data_type=gdal.GDT_Float32):
         data_to_write = arr
     elif len(arr.shape) == 3:
         rows, cols, bands = arr.shape
-        data_to_write = arr[:, :, 0] if bands == 1 else arr
+        data_to_write = arr
     else:
         raise ValueError("Array must be 2D or 3D")
     driver = gdal.GetDriverByName('ENVI')    
-    dataset = driver.Create(output_filepath, cols, rows, 1, data_type)
+    dataset = driver.Create(output_filepath, cols, rows, bands, data_type)
     if dataset is None:
         raise RuntimeError(f"Could not create file: {output_filepath}")
     if len(arr.shape) == 2:
         dataset.GetRasterBand(1).WriteArray(data_to_write)
     else:
-        dataset.GetRasterBand(1).WriteArray(data_to_write[:, :])
+        for b in range(bands):
+            dataset.GetRasterBand(b + 1).WriteArray(data_to_write[:, :, b])
     dataset.FlushCache()
     dataset = None
     print(f"GDAL write {output_filepath} finished")
 
 
-## write np.array to the ISCE2 file according to the input array
-def write_arr2file(arr, output_filepath):
-    ## write np.array to the ISCE2 file according to the input array
-    ## <1> arr(numpy.array) : the numpy array to convert
-    ## <2> out_path (str)   : the output path of the arr2ISCEfile
-    mirror_dic = {
-        ".unw": "MOD_isce_unw", 
-        ".cor": "isce_cor", 
-        ".rdr": "isce_cor", 
-        ".int": "isce_int",
-        ".full": "envi"
+## block-streamed writer of ISCE2 / ENVI raw binaries : (image_type, number_bands, dtype) per extension
+## the number_bands/dtype of .rdr (2-band los.rdr, f8 lat.rdr/lon.rdr) and .full outputs follow the first block
+STREAM_FILE_TYPE = {
+    ".unw" : ("unw", 2, "f4"),
+    ".cor" : ("cor", 1, "f4"),
+    ".rdr" : ("rdr", None, None),
+    ".int" : ("int", 1, "c8"),
+    ".full": ("full", None, None)
+}
+STREAM_BLOCK_ROWS = 256
+ISCE_DTYPE_NAME = {np.dtype(v).name: k for k, v in reversed(list(ISCE_DTYPE.items()))}
+VRT_DTYPE_NAME  = {np.dtype(v).name: k for k, v in VRT_DTYPE.items()}
+ENVI_DTYPE_CODE = {np.dtype(v).name: k for k, v in ENVI_DTYPE.items()}
+
+def get_isce_data_type(dtype):
+    # ISCE2 xml data_type of a np.dtype, the unsigned 16/32/64-bit types have none
+    dtype = np.dtype(dtype)
+    if dtype.name not in ISCE_DTYPE_NAME:
+        raise ValueError(f"{dtype.name} has no ISCE2 data type, expected one of {sorted(ISCE_DTYPE_NAME)}")
+    return ISCE_DTYPE_NAME[dtype.name]
+
+def iter_row_blocks(arr, block_rows=STREAM_BLOCK_ROWS):
+    # yield row blocks of an in-memory (or memory-mapped) array for stream_arr2file
+    for y0 in range(0, arr.shape[0], block_rows):
+        yield arr[y0:y0+block_rows]
+
+def write_raw_sidecars(output_filepath, image_type, width, length, bands, dtype, interleave="BIL",
+                       coords=None, props=None, vrt=True):
+    # write the ISCE2 .xml and the GDAL .vrt describing a BIL raw binary, and the ENVI .hdr for .full files
+    # <1~6> the output file, ISCE2 image_type, width, length, number of bands and np.dtype of the binary
+    # <7> interleave (str) : the band interleave, BIL
+    # <8> coords (list)    : [(lon_first, lon_delta), (lat_first, lat_delta)] pixel-center geo coordinates
+    #                        of the first col/row, None for radar coordinates
+    # <9> props (dict)     : extra ISCE2 xml properties, e.g. {"reference": "WGS84"}
+    # <10> vrt (bool)      : write the .vrt, False to keep an existing .vrt of another raster
+    size = dtype.itemsize
+    basename = os.path.basename(output_filepath)
+    xml_props = {
+        "access_mode": "read", "byte_order": "l", "data_type": get_isce_data_type(dtype),
+        "family": "image", "file_name": os.path.abspath(output_filepath), "image_type": image_type,
+        "length": length, "number_bands": bands, "scheme": interleave, "width": width,
+        "xmax": width, "xmin": 0
     }
+    xml_props.update(props or {})
+    axes = coords if coords is not None else [(0.0, 1.0), (0.0, 1.0)]
+    with open(output_filepath + ".xml", "w") as xml:
+        xml.write("<imageFile>\n")
+        for name, value in xml_props.items():
+            xml.write(f'    <property name="{name}">\n        <value>{value}</value>\n    </property>\n')
+        for name, size_value, (first, delta) in zip(("coordinate1", "coordinate2"), (width, length), axes):
+            xml.write(f'    <component name="{name}">\n')
+            xml.write(f'        <property name="delta">\n            <value>{delta}</value>\n        </property>\n')
+            xml.write(f'        <property name="endingvalue">\n            <value>{first + delta*size_value}</value>\n        </property>\n')
+            xml.write(f'        <property name="size">\n            <value>{size_value}</value>\n        </property>\n')
+            xml.write(f'        <property name="startingvalue">\n            <value>{first}</value>\n        </property>\n')
+            xml.write(f'    </component>\n')
+        xml.write("</imageFile>\n")
+    if vrt:
+        with open(output_filepath + ".vrt", "w") as vrt_file:
+            vrt_file.write(f'<VRTDataset rasterXSize="{width}" rasterYSize="{length}">\n')
+            if coords is not None:
+                (x_first, dx), (y_first, dy) = coords
+                vrt_file.write('    <SRS>EPSG:4326</SRS>\n')
+                vrt_file.write(f'    <GeoTransform>{x_first - dx/2}, {dx}, 0.0, {y_first - dy/2}, 0.0, {dy}</GeoTransform>\n')
+            for b in range(bands):
+                vrt_file.write(f'    <VRTRasterBand dataType="{VRT_DTYPE_NAME[dtype.name]}" band="{b+1}" subClass="VRTRawRasterBand">\n')
+                vrt_file.write(f'        <SourceFilename relativeToVRT="1">{basename}</SourceFilename>\n')
+                vrt_file.write(f'        <ByteOrder>LSB</ByteOrder>\n')
+                vrt_file.write(f'        <ImageOffset>{b*width*size}</ImageOffset>\n')
+                vrt_file.write(f'        <PixelOffset>{size}</PixelOffset>\n')
+                vrt_file.write(f'        <LineOffset>{bands*width*size}</LineOffset>\n')
+                vrt_file.write(f'    </VRTRasterBand>\n')
+            vrt_file.write('</VRTDataset>\n')
+    if image_type == "full":
+        with open(os.path.splitext(output_filepath)[0] + ".hdr", "w") as hdr:
+            hdr.write(f"ENVI\ndescription = {{{basename}}}\n")
+            hdr.write(f"samples = {width}\nlines = {length}\nbands = {bands}\nheader offset = 0\n")
+            hdr.write(f"file type = ENVI Standard\ndata type = {ENVI_DTYPE_CODE[dtype.name]}\n")
+            hdr.write(f"interleave = {interleave.lower()}\nbyte order = 0\n")
+
+def stream_arr2file(blocks, output_filepath, length=None, block_rows=STREAM_BLOCK_ROWS):
+    # write row blocks to an ISCE2 (.unw/.cor/.int/.rdr) or ENVI (.full) file incrementally (BIL layout)
+    # <1> blocks (iterable/callable) : iterable of row blocks (rows, cols) or (rows, cols, bands),
+    #                                  or a callable blocks(y0, y1) returning the rows y0:y1
+    # <2> output_filepath (str)      : the output path, the extension chooses the file type
+    # <3> length (int)               : total number of rows, needed when blocks is callable
+    # <4> block_rows (int)           : number of rows per block when blocks is callable
+    # a single band block written to .unw is taken as the phase, with an amplitude band of ones
     _, ext = os.path.splitext(output_filepath)
-    if ext == ".full":
-        write_gdal_file(arr, output_filepath)
-        return
-    if ext not in mirror_dic:
+    if ext not in STREAM_FILE_TYPE:
         raise ValueError(f"Unsupported file extension: {ext}")
-    file_type = mirror_dic[ext]
-    write_isce_file(
-        data = arr[:,:,0],
-        out_file = output_filepath ,
-        file_type = file_type
-    )
-    print(f"write {output_filepath} finished ")
\ No newline at end of file
+    image_type, bands, dtype = STREAM_FILE_TYPE[ext]
+    if callable(blocks):
+        if length is None:
+            raise ValueError("length is required when blocks is a callable")
+        block_func = blocks
+        blocks = (block_func(y0, min(y0 + block_rows, length)) for y0 in range(0, length, block_rows))
+    width, rows_written = None, 0
+    with open(output_filepath, "wb") as out:
+        for block in blocks:
+            block = np.asarray(block)
+            if block.ndim == 2:
+                block = block[:, :, np.newaxis]
+            if width is None:
+                width = block.shape[1]
+                bands = bands or block.shape[2]
+                dtype = np.dtype(dtype or block.dtype).newbyteorder("<")
+                get_isce_data_type(dtype)
+            if block.shape[1] != width:
+                raise ValueError(f"block width {block.shape[1]} differs from {width}")
+            if image_type == "unw" and block.shape[2] == 1:
+                block = np.concatenate([np.ones_like(block), block], axis=2)
+            if block.shape[2] != bands:
+                raise ValueError(f"block has {block.shape[2]} bands, {ext} expects {bands}")
+            ## (rows, cols, bands) -> BIL (rows, bands, cols)
+            out.write(np.ascontiguousarray(block.transpose(0, 2, 1), dtype=dtype).tobytes())
+            rows_written += block.shape[0]
+    if width is None:
+        raise ValueError(f"no blocks to write to {output_filepath}")
+    if length is not None and rows_written != length:
+        raise ValueError(f"wrote {rows_written} rows to {output_filepath}, expected {length}")
+    write_raw_sidecars(output_filepath, image_type, width, rows_written, bands, dtype)
+    print(f"stream write {output_filepath} finished ({rows_written} x {width} x {bands})")
+
+
+## write np.array to the ISCE2 file according to the input array
+def write_arr2file(arr, output_filepath, block_rows=STREAM_BLOCK_ROWS):
+    ## write np.array to the ISCE2 / ENVI file according to the extension of output_filepath,
+    ## streamed row block by row block through stream_arr2file (no full-size copy of arr is made)
+    ## <1> arr(numpy.array) : the (rows, cols) or (rows, cols, bands) array (or np.memmap) to convert
+    ## <2> out_path (str)   : the output path of the arr2ISCEfile (.unw/.cor/.rdr/.int/.full)
+    ## <3> block_rows (int) : number of rows per written block
+    stream_arr2file(iter_row_blocks(arr, block_rows), output_filepath)
+
+
+def replace_raw_sidecars(dst_file, width, length, bands, dtype, vrt=True):
+    # remove the old .xml/.vrt/.hdr of dst_file (maybe hardlinks of the source ones) and write the new ones,
+    # the extension of dst_file is the ISCE2 image_type; vrt=False keeps the .vrt (the source of dst_file)
+    image_type = os.path.splitext(dst_file)[1].lstrip(".")
+    sidecars = [dst_file + ".xml", dst_file + ".hdr", os.path.splitext(dst_file)[0] + ".hdr"]
+    for sidecar in sidecars + ([dst_file + ".vrt"] if vrt else []):
+        if os.path.lexists(sidecar):
+            os.remove(sidecar)
+    write_raw_sidecars(dst_file, image_type, width, length, bands, dtype, vrt=vrt)
+
+
+## translation engine : GDAL rasters (the ISCE2 vrt mosaics) to BIL raw binaries, one process per file
+TRANSLATE_JOBS = 4
+TRANSLATE_CACHE_MB = 512
+
+def is_translation_current(dst_file, sources, shape):
+    # dst_file is up to date : newer than all its sources, with the expected (rows, cols)
+    if not os.path.exists(dst_file):
+        return False
+    mtime = os.path.getmtime(dst_file)
+    real_dst = os.path.realpath(dst_file)
+    if any(os.path.getmtime(file) > mtime for file in sources if file != real_dst and os.path.exists(file)):
+        return False
+    layouts = get_raw_layout(dst_file)
+    return layouts is not None and (layouts[0][5], layouts[0][6]) == tuple(shape)
+
+def translate_raster(src_file, dst_file, window=None, cache_mb=TRANSLATE_CACHE_MB, threads=1):
+    ############################################################
+    # translate a raster to a BIL raw binary with its .xml/.vrt/.hdr through the GDAL python API,
+    # the output goes through a .part file so a source staged as a hardlink at dst_file is never truncated
+    # <1> src_file (str)  : the input raster, usually an ISCE2 .vrt
+    # <2> dst_file (str)  : the output, its extension is the ISCE2 image_type (full, rdr ...)
+    # <3> window (list)   : [y0, y1, x0, x1] row/col window, None for full size
+    # <4> cache_mb (int)  : GDAL block cache of the process (MB)
+    # <5> threads (int)   : GDAL_NUM_THREADS of the process
+    # <return> (dst_file, seconds, status) : status is translated / up to date / raw binary of the vrt
+    ############################################################
+    start = time.time()
+    gdal.SetCacheMax(cache_mb * 1024 * 1024)
+    gdal.SetConfigOption("GDAL_NUM_THREADS", str(threads))
+    ds = gdal.Open(src_file, gdal.GA_ReadOnly)
+    if ds is None:
+        raise RuntimeError(f"Could not open file: {src_file}")
+    y0, y1, x0, x1 = window if window is not None else (0, ds.RasterYSize, 0, ds.RasterXSize)
+    sources = [os.path.realpath(file) for file in (ds.GetFileList() or [src_file])]
+    ## an ISCE2 vrt of a raw binary at dst_file : nothing to translate at full size, and a window
+    ## cropped in place would leave the next runs (maybe of another window) without the full raster
+    if os.path.realpath(dst_file) in sources:
+        if window is not None:
+            raise ValueError(f"{dst_file} is a source of {src_file}, it can not be cropped in place")
+        return dst_file, time.time() - start, "raw binary of the vrt"
+    y1, x1 = min(y1, ds.RasterYSize), min(x1, ds.RasterXSize)
+    if is_translation_current(dst_file, sources, (y1 - y0, x1 - x0)):
+        return dst_file, time.time() - start, "up to date"
+    bands = ds.RasterCount
+    dtype = np.dtype(VRT_DTYPE[gdal.GetDataTypeName(ds.GetRasterBand(1).DataType)])
+    tmp_file = dst_file + ".part"
+    gdal.Translate(tmp_file, ds, format="ENVI", srcWin=[x0, y0, x1 - x0, y1 - y0],
+                   creationOptions=["INTERLEAVE=BIL"])
+    ds = None
+    for header in (tmp_file + ".hdr", os.path.splitext(tmp_file)[0] + ".hdr", tmp_file + ".aux.xml"):
+        if os.path.exists(header):
+            os.remove(header)
+    os.replace(tmp_file, dst_file)
+    ## the vrt of another raster (the burst mosaic of an SLC) stays the source of the next runs
+    own_vrt = os.path.realpath(dst_file + ".vrt") != os.path.realpath(src_file)
+    replace_raw_sidecars(dst_file, x1 - x0, y1 - y0, bands, dtype, vrt=own_vrt)
+    ## newer than its rewritten vrt, up to date for the next run
+    os.utime(dst_file)
+    return dst_file, time.time() - start, "translated"
+
+def translate_rasters(file_pairs, window=None, njobs=TRANSLATE_JOBS, cache_mb=TRANSLATE_CACHE_MB, threads=None):
+    ############################################################
+    # translate the (src_file, dst_file) pairs with translate_raster on a pool of njobs processes
+    # <1> file_pairs (list) : (src_file, dst_file) pairs
+    # <2> window (list)     : [y0, y1, x0, x1] row/col window of all the files, None for full size
+    # <3> njobs (int)       : number of processes
+    # <4> cache_mb (int)    : GDAL block cache per process (MB)
+    # <5> threads (int)     : GDAL_NUM_THREADS per process (default : the cores shared by the processes)
+    # <return> results (list) : (dst_file, seconds, status) of translate_raster
+    ############################################################
+    if not file_pairs:
+        return []
+    njobs = max(min(njobs, len(file_pairs)), 1)
+    threads = threads or max((os.cpu_count() or 1) // njobs, 1)
+    start = time.time()
+    results = Parallel(n_jobs=njobs)(
+        delayed(translate_raster)(src, dst, window, cache_mb, threads) for src, dst in file_pairs)
+    for dst_file, seconds, status in results:
+        print(f"  {seconds:8.1f} s  {status:<22}{dst_file}")
+    translated = sum(status == "translated" for _, _, status in results)
+    print(f"{translated}/{len(results)} files translated in {time.time() - start:.1f} s "
+          f"({njobs} processes, {threads} GDAL threads and {cache_mb} MB cache each)")
+    return results
+
+
+## scene index : one sqlite index of the SAFE directories / zips of a directory
+## S1A_IW_SLC__1SDV_20230101T101010_20230101T101037_046594_059596_8DF0 : mission, mode, product class,
+## sensing start/stop, absolute orbit
+SCENE_NAME_PATTERN = re.compile(r'^(S1[ABCD])_(\w\w)_SLC__(\w{4})_(\d{8}T\d{6})_(\d{8}T\d{6})_(\d{6})_')
+## first absolute orbit of relative orbit 1 of each mission, 175 orbits per repeat cycle
+RELATIVE_ORBIT_OFFSET = {"S1A": 73, "S1B": 27}
+
+
+def get_scene_index_file(directory):
+    # the scene index of a directory, kept in the shared cache (outside the directory, so
+    # writing the index does not change the directory mtime)
+    key = hashlib.sha1(os.path.realpath(directory).encode()).hexdigest()[:16]
+    return os.path.join(get_cache_dir("scene_index"), f"{key}.sqlite")
+
+
+def open_scene_index(index_file):
+    # open (create) the sqlite scene index
+    # table scenes : one row per SAFE/zip, name, path, kind, mission, sensing start/stop, date, orbits,
+    #                swaths, footprint box and coordinates, checksum, size/mtime of the last parse
+    # table meta   : mtime of the directory at the last refresh
+    conn = sqlite3.connect(index_file, timeout=60)
+    conn.execute("CREATE TABLE IF NOT EXISTS scenes (name TEXT PRIMARY KEY, path TEXT, kind TEXT, "
+                 "mission TEXT, product_class TEXT, start TEXT, stop TEXT, date TEXT, absolute_orbit INTEGER, "
+                 "relative_orbit INTEGER, swaths TEXT, lat_min REAL, lat_max REAL, lon_min REAL, lon_max REAL, "
+                 "footprint TEXT, checksum TEXT, size INTEGER, mtime REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS scenes_date ON scenes (date)")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+
+def read_scene_metadata(path):
+    ############################################################
+    # read the swaths, footprint and checksum of a SAFE directory or zip
+    # the footprint is the gml:coordinates of manifest.safe, the swaths come from the annotation
+    # file names. The checksum is the sha1 of manifest.safe for a SAFE (which lists the md5 of
+    # every data file), and the sha1 of the member CRC32s for a zip, so the data is never read
+    # <return> dict : swaths (str), footprint (str), lat/lon min/max (None if unknown), checksum
+    ############################################################
+    manifest, annotations = None, []
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path, "r") as zip_ref:
+            infos = zip_ref.infolist()
+            checksum = hashlib.sha1(b"".join(f"{info.filename}:{info.CRC}".encode() for info in infos)).hexdigest()
+            for info in infos:
+                if info.filename.endswith("/manifest.safe"):
+                    manifest = zip_ref.read(info.filename).decode(errors="ignore")
+                elif "/annotation/" in info.filename and "/calibration/" not in info.filename:
+                    annotations.append(os.path.basename(info.filename))
+    else:
+        manifest_file = os.path.join(path, "manifest.safe")
+        if os.path.exists(manifest_file):
+            with open(manifest_file, "r", errors="ignore") as f:
+                manifest = f.read()
+        checksum = hashlib.sha1(manifest.encode()).hexdigest() if manifest else None
+        annotation_dir = os.path.join(path, "annotation")
+        if os.path.isdir(annotation_dir):
+            annotations = os.listdir(annotation_dir)
+    swaths = sorted({int(match.group(1)) for match in
+                     (re.match(r'^s1[abcd]-iw(\d)-slc-', name) for name in annotations) if match})
+    metadata = {"swaths": ",".join(str(swath) for swath in swaths), "footprint": None, "checksum": checksum,
+                "lat_min": None, "lat_max": None, "lon_min": None, "lon_max": None}
+    match = re.search(r'<gml:coordinates>(.*?)</gml:coordinates>', manifest or "", re.S)
+    if match:
+        points = [tuple(float(value) for value in point.split(",")) for point in match.group(1).split()]
+        lats, lons = [point[0] for point in points], [point[1] for point in points]
+        metadata.update(footprint=match.group(1).strip(), lat_min=min(lats), lat_max=max(lats),
+                        lon_min=min(lons), lon_max=max(lons))
+    return metadata
+
+
+def update_scene_index(directory, index_file=None):
+    ############################################################
+    # refresh the scene index of the S1*.SAFE directories and S1*.zip files of a directory
+    # nothing is scanned when the directory mtime did not change since the last refresh,
+    # otherwise only the new scenes and the scenes whose size/mtime changed are parsed
+    # (the mtime of manifest.safe for a SAFE directory)
+    # <1> directory (str)  : the SLC directory or the zip data directory
+    # <2> index_file (str) : the sqlite index (default : get_scene_index_file(directory))
+    # <return> index_file (str)
+    ############################################################
+    index_file = index_file or get_scene_index_file(directory)
+    conn = open_scene_index(index_file)
+    dir_mtime = str(os.stat(directory).st_mtime_ns)
+    meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+    if meta.get("dir_mtime") == dir_mtime:
+        conn.close()
+        return index_file
+    known = {name: (size, mtime) for name, size, mtime in conn.execute("SELECT name, size, mtime FROM scenes")}
+    names = set()
+    ## a SAFE still being extracted (no manifest yet) is parsed again at the next refresh
+    complete = True
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".SAFE"):
+            name, kind = entry.name[:-len(".SAFE")], "SAFE"
+        elif entry.name.endswith(".zip"):
+            name, kind = entry.name[:-len(".zip")], "zip"
+        else:
+            continue
+        match = SCENE_NAME_PATTERN.match(name)
+        if match is None:
+            continue
+        names.add(name)
+        stat = entry.stat()
+        ## a SAFE directory changes when its files are (re)written, its manifest is the last one extracted
+        manifest_file = os.path.join(entry.path, "manifest.safe")
+        if kind == "SAFE":
+            if os.path.exists(manifest_file):
+                stat = os.stat(manifest_file)
+            else:
+                complete = False
+        if known.get(name) == (stat.st_size, stat.st_mtime):
+            continue
+        try:
+            metadata = read_scene_metadata(entry.path)
+        except (OSError, zipfile.BadZipFile, ValueError) as e:
+            print(f"WARNING: can not read the metadata of {entry.name}: {e}")
+            continue
+        mission, _, product_class, start, stop, absolute_orbit = match.groups()
+        relative_orbit = None
+        if mission in RELATIVE_ORBIT_OFFSET:
+            relative_orbit = (int(absolute_orbit) - RELATIVE_ORBIT_OFFSET[mission]) % 175 + 1
+        conn.execute("INSERT OR REPLACE INTO scenes VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                     (name, os.path.abspath(entry.path), kind, mission, product_class, start, stop, start[:8],
+                      int(absolute_orbit), relative_orbit, metadata["swaths"], metadata["lat_min"],
+                      metadata["lat_max"], metadata["lon_min"], metadata["lon_max"], metadata["footprint"],
+                      metadata["checksum"], stat.st_size, stat.st_mtime))
+    for name in set(known) - names:
+        conn.execute("DELETE FROM scenes WHERE name = ?", (name,))
+    if complete:
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('dir_mtime', ?)", (dir_mtime,))
+    conn.commit()
+    conn.close()
+    return index_file
+
+
+def query_scenes(directory, date1=None, date2=None, bbox=None, kind=None, mission=None):
+    ############################################################
+    # query the scenes of a directory from its (refreshed) scene index
+    # <1> directory (str)  : the SLC directory or the zip data directory
+    # <2> date1, date2     : keep the scenes acquired from date1 to date2 (YYYYMMDD, included)
+    # <3> bbox (list)      : keep the scenes whose footprint intersects [lat_min, lat_max, lon_min, lon_max],
+    #                        the scenes without footprint are kept
+    # <4> kind (str)       : "SAFE" or "zip" (default : both)
+    # <5> mission (str)    : e.g. "S1A" (default : all)
+    # <return> list of dicts (the scenes columns), sorted by sensing start
+    ############################################################
+    conn = open_scene_index(update_scene_index(directory))
+    conn.row_factory = sqlite3.Row
+    conditions, params = [], []
+    if date1 is not None:
+        conditions.append("date >= ?")
+        params.append(str(date1))
+    if date2 is not None:
+        conditions.append("date <= ?")
+        params.append(str(date2))
+    if kind is not None:
+        conditions.append("kind = ?")
+        params.append(kind)
+    if mission is not None:
+        conditions.append("mission = ?")
+        params.append(mission)
+    if bbox is not None:
+        lat_min, lat_max, lon_min, lon_max = bbox
+        conditions.append("(lat_min IS NULL OR (lat_min <= ? AND lat_max >= ? AND lon_min <= ? AND lon_max >= ?))")
+        params += [lat_max, lat_min, lon_max, lon_min]
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    scenes = [dict(row) for row in conn.execute(f"SELECT * FROM scenes{where} ORDER BY start, name", params)]
+    conn.close()
+    return scenes
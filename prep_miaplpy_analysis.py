@@ -5,8 +5,9 @@
 # <1> mkdir Miaplpy for Miaplpy Timeseries Analysis in the PROCESS directory
 # <2> Copy the baseline directory and metadata directory, geom_reference_datasets to the Miaplpy directory
 # <3> Copy the correspondent datasets based on the date range
-# <4> find the roi yx and save roi.txt 
-# <5> write miaplpy template for miaplpy analysis.
+# <4> find the roi yx and save roiSAR.txt, transform the RSLC / geom_reference vrt files of the PROCESS directory
+#     to full files (or with --crop, to the roi window only)
+# <5> write miaplpy template for miaplpy analysis, reading only the roi window.
 ######################################################
 
 # Junlian test lalo 27.96, 28.06, 104.57, 104.66
@@ -17,29 +18,28 @@ import numpy as np
 import argparse
 
 
-def copy_baselinesdataset2Miaplpy(process_dir, Miaplpy_dir):
+## the .full files (and their .xml/.vrt/.hdr) are translated from the vrt of the process directory,
+## not staged : a staged copy would overwrite the (cropped) translation of the previous run
+TRANSLATED_FILES = ("*.full", "*.full.*", "*.slc.hdr", "*.rdr.hdr")
+
+
+def copy_baselinesdataset2Miaplpy(process_dir, Miaplpy_dir, method="copy"):
     baselines_dir = os.path.join(process_dir, "baselines")
     dst = os.path.join(Miaplpy_dir, "baselines")
-    if os.path.exists(dst):
-        shutil.rmtree(dst)
-    shutil.copytree(baselines_dir, dst)
+    stage_tree(baselines_dir, dst, method)
 
 
-def copy_referenceMetadataset2Miaplpy(process_dir, Miaplpy_dir):
+def copy_referenceMetadataset2Miaplpy(process_dir, Miaplpy_dir, method="copy"):
     ref_dir = os.path.join(process_dir, "reference")
     dst = os.path.join(Miaplpy_dir, "reference")
-    if os.path.exists(dst):
-        shutil.rmtree(dst)
-    shutil.copytree(ref_dir, dst)
+    stage_tree(ref_dir, dst, method)
 
 
-def copy_geomreferencedataset2Miaplpy(process_dir, Miaplpy_dir):
+def copy_geomreferencedataset2Miaplpy(process_dir, Miaplpy_dir, method="copy"):
     geom_reference_dir =os.path.join(process_dir, "merged", "geom_reference")
     print("geom_reference_dir is :", geom_reference_dir)
     dst = os.path.join(Miaplpy_dir, "geom_reference")
-    if os.path.exists(dst):
-        shutil.rmtree(dst)
-    shutil.copytree(geom_reference_dir, dst)
+    stage_tree(geom_reference_dir, dst, method, exclude=TRANSLATED_FILES)
     
     
 def get_date_range(process_dir):
@@ -97,69 +97,79 @@ def get_final_date12(process_dir, date1=None, date2=None):
     return date_range
 
 
-def copy_ifgdataset2Miaplpy(process_dir, Miaplpy_dir, date1=None, date2=None):
+def copy_ifgdataset2Miaplpy(process_dir, Miaplpy_dir, date1=None, date2=None, method="copy"):
     rslc_dir = os.path.join(process_dir, "merged", "SLC")
     date_range = get_final_date12(process_dir, date1, date2)
     print(f"corresponding date range is {date_range[0]} to {date_range[-1]}, totally {len(date_range)} num_dates")
     Miaplpy_rslc_dir = os.path.join(Miaplpy_dir, "SLC")
     if not os.path.exists(Miaplpy_rslc_dir):os.mkdir(Miaplpy_rslc_dir)
     rslc_dst_list = [os.path.join(Miaplpy_rslc_dir, str(date)) for date in date_range]
+    tree_pairs = []
     for num, dst in enumerate(rslc_dst_list):
         date = os.path.basename(dst)
         ref_dir = os.path.join(rslc_dir, date)
-        if os.path.exists(dst):
-            shutil.rmtree(dst)
-        shutil.copytree(ref_dir, dst)    
+        tree_pairs.append((ref_dir, dst))
         src_str = f"${{PROJECT}}/{'/'.join(ref_dir.rstrip('/').split('/')[-3:])}"
         dst_str = f"${{PROJECT}}/{'/'.join(dst.rstrip('/').split('/')[-3:])}"
         print(f"No.{num+1} rslc: {src_str} --> {dst_str}")
+    ## only the changed files of all the dates, on one pool
+    sync_trees(tree_pairs, method, exclude=TRANSLATED_FILES)
 
 
-def prepare_SAR_yx(Miaplpy_dir, lat_min, lat_max, lon_min, lon_max):  
-    lat_full_file = os.path.join(Miaplpy_dir, "geom_reference", "lat.rdr.full")
-    lon_full_file = os.path.join(Miaplpy_dir, "geom_reference", "lon.rdr.full")
+def prepare_SAR_yx(process_dir, Miaplpy_dir, lat_min, lat_max, lon_min, lon_max):  
+    # roi window [y0, y1, x0, x1] in the full resolution grid of the RSLC, saved in roiSAR.txt
+    # read on the lookuptable vrt of the stack, the .full files are not translated yet
+    # (and may be cropped) in the Miaplpy directory
+    lat_full_file = os.path.join(process_dir, "merged", "geom_reference", "lat.rdr.full.vrt")
+    lon_full_file = os.path.join(process_dir, "merged", "geom_reference", "lon.rdr.full.vrt")
 
-    lat_data = read_isce_file(lat_full_file)
-    lon_data = read_isce_file(lon_full_file)
-
-    y0, y1, x0, x1 = bbox2SAR(lat_min, lat_max, lon_min, lon_max,lat_data, lon_data)
-    y0, y1, x0, x1 = int(y0), int(y1), int(x0), int(x1)
+    window = get_roi_window(lat_full_file, lon_full_file, lat_min, lat_max, lon_min, lon_max)
     roi_par = os.path.join(Miaplpy_dir, "roiSAR.txt")
     print(f"save infomation of region of interesting in the file {roi_par}")
-    write_roi_par(y0, y1, x0, x1, roi_par)
+    write_roi_window(window, roi_par)
+    return window
     
     
-def prepare_RSLC_full_files(Miaplpy_dir):
+def prepare_RSLC_full_files(process_dir, Miaplpy_dir, window=None, njobs=TRANSLATE_JOBS, cache_mb=TRANSLATE_CACHE_MB,
+                            threads=None):
+    # translate the RSLC vrt of the process directory to the .full files of the Miaplpy directory
+    # window (list) : [y0, y1, x0, x1] roi window, write only the window of the RSLC
+    # njobs, cache_mb, threads : processes, GDAL cache (MB) and GDAL threads per process of translate_rasters
+    process_rslc_dir = os.path.join(process_dir, "merged", "SLC")
     rslc_dir = os.path.join(Miaplpy_dir, "SLC")
     ## prepare rslc.full 
     print("prepare RSLC.full file")
-    for date in os.listdir(rslc_dir):
-        rslc_vrt = os.path.join(rslc_dir, date, f"{date}.slc.full.vrt")
+    file_pairs = []
+    for date in sorted(os.listdir(rslc_dir)):
+        rslc_vrt = os.path.join(process_rslc_dir, date, f"{date}.slc.full.vrt")
         rslc_full = os.path.join(rslc_dir,date, f"{date}.slc.full")
-        log = os.path.join(rslc_dir,date,f"gdal_translate_{date}.log")
-        cmd = f"gdal_translate -of ENVI {rslc_vrt} {rslc_full} > {log}"
-        print(cmd)
-        os.system(cmd)
+        file_pairs.append((rslc_vrt, rslc_full))
+    translate_rasters(file_pairs, window, njobs, cache_mb, threads)
         
-def prepare_geomref_full_files(Miaplpy_dir):   
+def prepare_geomref_full_files(process_dir, Miaplpy_dir, window=None, njobs=TRANSLATE_JOBS, cache_mb=TRANSLATE_CACHE_MB,
+                               threads=None):   
+    # translate the geometry vrt of the process directory to the .full files of the Miaplpy directory
+    # window (list) : [y0, y1, x0, x1] roi window, write only the window of the geometry files
+    # njobs, cache_mb, threads : processes, GDAL cache (MB) and GDAL threads per process of translate_rasters
+    process_geomref_dir = os.path.join(process_dir, "merged", "geom_reference")
     geomref_dir = os.path.join(Miaplpy_dir, "geom_reference")
     ## prepare lon.rdr.full. lat.rdr.full los.rdr.full incidenceAngle.rdr.full shadowMask.rdr.full
     print("prepare geom_reference files full file") 
-    geo_files_pattern = os.path.join(geomref_dir,"*.rdr.full.vrt")
+    geo_files_pattern = os.path.join(process_geomref_dir,"*.rdr.full.vrt")
     geom_vrt_files =  glob.glob(geo_files_pattern)
     print(geom_vrt_files)
+    file_pairs = []
     for geom_vrt_file in geom_vrt_files:
         basename = os.path.basename(geom_vrt_file)
         full_ext = ".".join(basename.split(".")[:-1])
         geom_full_file = os.path.join(geomref_dir, full_ext)
-        log = os.path.join(geomref_dir, f"gdal_translate_{basename.split('.')[0]}.log")
-        cmd = f"gdal_translate -of ENVI {geom_vrt_file} {geom_full_file} > {log}"
-        print(cmd)
-        os.system(cmd)
+        file_pairs.append((geom_vrt_file, geom_full_file))
+    translate_rasters(file_pairs, window, njobs, cache_mb, threads)
 
        
        
-def prepare_miaplpy_template(Miaplpy_dir):
+def prepare_miaplpy_template(Miaplpy_dir, window=None, cropped=False):
+    # window (list) : [y0, y1, x0, x1] roi window, the subset read by miaplpy unless the files are cropped to it
     output_file = os.path.join(Miaplpy_dir, "miaplpy.txt")
     with open(output_file, "w") as example:
         example.write("##------------------------ miaplpyApp.cfg ------------------------##\n")
@@ -185,7 +195,14 @@ def prepare_miaplpy_template(Miaplpy_dir):
         example.write(f"miaplpy.load.bperpFile      = auto  #[path2bperp_file], optional\n")
         example.write("##---------subset (optional):\n")
         example.write("## if both yx and lalo are specified, use lalo option unless a) no lookup file AND b) dataset is in radar coord\n")
-        example.write("miaplpy.subset.yx           = [1800.0:2700.0, 4990.0:8180.0]    #[y0:y1,x0:x1 / no], auto for no\n")
+        if window is not None and not cropped:
+            y0, y1, x0, x1 = window
+            example.write(f"miaplpy.subset.yx           = [{y0}:{y1}, {x0}:{x1}]    #[y0:y1,x0:x1 / no], auto for no\n")
+        else:
+            if window is not None:
+                y0, y1, x0, x1 = window
+                example.write(f"## the SLC and geometry files are cropped to the roi window [{y0}:{y1}, {x0}:{x1}] of the scene\n")
+            example.write("miaplpy.subset.yx           = auto    #[y0:y1,x0:x1 / no], auto for no\n")
         example.write("\n")
 
         example.write("########################## phase_linking ##########################################\n")
@@ -286,7 +303,10 @@ def prepare_miaplpy_template(Miaplpy_dir):
             
         
 def prep_miaplpy(process_dir, date1 = None, date2 = None, 
-                 lat_min=None, lat_max=None, lon_min=None, lon_max=None):
+                 lat_min=None, lat_max=None, lon_min=None, lon_max=None, crop=False,
+                 njobs=TRANSLATE_JOBS, cache_mb=TRANSLATE_CACHE_MB, gdal_threads=None):
+    # crop (bool) : write only the roi window of the RSLC and geometry full files
+    # njobs, cache_mb, gdal_threads : processes, GDAL cache (MB) and GDAL threads per process of the translation
     if not (lat_min and lat_max and lon_min and lon_max):
         print("lat and lon infomation is necessary. please check your lat/lon")
         sys.exit(1)
@@ -301,15 +321,17 @@ def prep_miaplpy(process_dir, date1 = None, date2 = None,
     print("copy geom_reference directory to Miaplpy directory...")
     copy_geomreferencedataset2Miaplpy(process_dir, Miaplpy_dir)
     print("copy correspond SLC files to Miaplpy directory...")
-    # copy_ifgdataset2Miaplpy(process_dir, Miaplpy_dir, date1, date2)
+    copy_ifgdataset2Miaplpy(process_dir, Miaplpy_dir, date1, date2)
+    ## the window is found on the full scene lookuptable of the stack
+    print("find the SAR yx based on the lookuptable and lat lon ...")
+    window = prepare_SAR_yx(process_dir, Miaplpy_dir, lat_min, lat_max, lon_min, lon_max)
+    crop_window = window if crop else None
     print("transform RSLC vrt files to full files...")
-    # prepare_RSLC_full_files(Miaplpy_dir)
+    prepare_RSLC_full_files(process_dir, Miaplpy_dir, crop_window, njobs, cache_mb, gdal_threads)
     print("transform geom_reference files to full files ...")
-    # prepare_geomref_full_files(Miaplpy_dir)
-    print("find the SAR yx based on the lookuptable and lat lon ...")
-    # prepare_SAR_yx(Miaplpy_dir, lat_min, lat_max, lon_min, lon_max)
+    prepare_geomref_full_files(process_dir, Miaplpy_dir, crop_window, njobs, cache_mb, gdal_threads)
     print("prepare miaplpy template text file...")
-    # prepare_miaplpy_template(Miaplpy_dir)
+    prepare_miaplpy_template(Miaplpy_dir, window, cropped=crop)
     
     
 def create_parser():
@@ -340,6 +362,18 @@ def create_parser():
     
     parser.add_argument('--lon-max', type = float, required=True,
                         help='maxmium longitude of the region of interest')
+    
+    parser.add_argument('--crop', action='store_true', default=False,
+                        help='write only the roi window of the RSLC and geometry full files '
+                             '(default: full scene files and subset in miaplpy)')
+    
+    # translation of the vrt files
+    parser.add_argument('--njobs', type=int, default=TRANSLATE_JOBS,
+                        help=f'number of processes translating the vrt files (default: {TRANSLATE_JOBS})')
+    parser.add_argument('--gdal-cache', type=int, default=TRANSLATE_CACHE_MB,
+                        help=f'GDAL cache of each process in MB (default: {TRANSLATE_CACHE_MB})')
+    parser.add_argument('--gdal-threads', type=int, default=None,
+                        help='GDAL_NUM_THREADS of each process (default: the cores shared by the processes)')
     return parser
 
 
@@ -358,6 +392,7 @@ if __name__ == '__main__':
     
     # run prep_miaplpy
     prep_miaplpy(process_dir, date1=date1, date2=date2, 
-                 lat_min=lat_min, lat_max = lat_max, lon_min=lon_min, lon_max=lon_max)
+                 lat_min=lat_min, lat_max = lat_max, lon_min=lon_min, lon_max=lon_max, crop=args.crop,
+                 njobs=args.njobs, cache_mb=args.gdal_cache, gdal_threads=args.gdal_threads)
     
     
\ No newline at end of file
@@ -3,67 +3,172 @@
 # prep_mintpy_analysis.py prepare directory for Mintpy
 # execute the following steps : 
 # <1> mkdir Mintpy_startDate_endDate for Mintpy Timeseries Analysis in the PROCESS directory
-# <2> Copy the baseline directory and metadata directory, geom_reference_datasets to the Mintpy directory
-# <3> Copy the correspondent datasets based on the date range
-# <4> find the roi yx and save roi.txt 
-# <5> write Mintpy template for Mintpy analysis.
+# <2> find the roi yx and save roi.txt 
+# <3> Copy the baseline directory and metadata directory, geom_reference_datasets to the Mintpy directory
+# <4> Copy the correspondent datasets based on the date range (or with --crop, only their roi window)
+# <5> write Mintpy template for Mintpy analysis, reading only the roi window.
+# or with --stage h5, stream the selected pairs of the ROI into inputs/ifgramStack.h5
+# and inputs/geometryRadar.h5, Mintpy starts from the network steps without load_data
 ######################################################
 
 from lab_utils import *
 import os, sys, shutil, glob
 import numpy as np 
 import argparse
+import h5py
+from joblib import Parallel, delayed
+from mintpy.utils import attribute, isce_utils
+from mintpy.utils import utils as ut
 
 
-def copy_baselinesdataset2Mintpy(process_dir, Mintpy_dir):
+## a chunk of ifgramStack.h5 holds all the pairs of a pixel tile : the time series of a pixel is one chunk read
+H5_CHUNK_BYTES = 4 * 1024**2
+H5_CHUNK_COLS = 64
+## rows of all the pairs read per block, a multiple of the chunk rows so each chunk is written once
+H5_BLOCK_BYTES = 512 * 1024**2
+H5_LOAD_JOBS = 8
+## dataset name : (file name, band, dtype) in the layout of Mintpy load_data
+IFGRAM_H5_DATASETS = {
+    "unwrapPhase":      ("filt_fine.unw", 2, np.float32),
+    "coherence":        ("filt_fine.cor", 1, np.float32),
+    "connectComponent": ("filt_fine.unw.conncomp", 1, np.int16),
+}
+IFGRAM_FILES = ("filt_fine.unw", "filt_fine.cor", "filt_fine.unw.conncomp")
+GEOMETRY_FILES = ("hgt.rdr", "lat.rdr", "lon.rdr", "los.rdr", "shadowMask.rdr")
+## datasets left out of ifgramStack.h5 (with a warning) when some pairs lack their file
+IFGRAM_H5_OPTIONAL = ("connectComponent",)
+GEOMETRY_H5_DATASETS = {
+    "height":         ("hgt.rdr", 1, np.float32),
+    "latitude":       ("lat.rdr", 1, np.float32),
+    "longitude":      ("lon.rdr", 1, np.float32),
+    "incidenceAngle": ("los.rdr", 1, np.float32),
+    "azimuthAngle":   ("los.rdr", 2, np.float32),
+    "shadowMask":     ("shadowMask.rdr", 1, np.bool_),
+}
+
+
+def copy_baselinesdataset2Mintpy(process_dir, Mintpy_dir, method="copy"):
     baselines_dir = os.path.join(process_dir, "baselines")
     dst = os.path.join(Mintpy_dir, "baselines")
-    if os.path.exists(dst):
-        shutil.rmtree(dst)
-    shutil.copytree(baselines_dir, dst)
+    stage_tree(baselines_dir, dst, method)
     
     
-def copy_referenceMetadataset2Mintpy(process_dir, Mintpy_dir):
+def copy_referenceMetadataset2Mintpy(process_dir, Mintpy_dir, method="copy"):
     ref_dir = os.path.join(process_dir, "reference")
     dst = os.path.join(Mintpy_dir, "reference")
-    if os.path.exists(dst):
-        shutil.rmtree(dst)
-    shutil.copytree(ref_dir, dst)
+    stage_tree(ref_dir, dst, method)
+
+def copy_geomreferencedataset2Mintpy(process_dir, Mintpy_dir, method="copy"):
+    ref_dir = os.path.join(process_dir, "merged", "geom_reference")
+    dst = os.path.join(Mintpy_dir, "geom_reference")
+    stage_tree(ref_dir, dst, method)
+
+def get_raster_source(file):
+    # the ISCE2 .vrt of a raw binary if there is one (the source GDAL reads the window of), else the file
+    return file + ".vrt" if os.path.exists(file + ".vrt") else file
 
-def copy_geomreferencedataset2Mintpy(process_dir, Mintpy_dir):
+def crop_geomreferencedataset2Mintpy(process_dir, Mintpy_dir, window, njobs=TRANSLATE_JOBS):
+    ############################################################
+    # translate the roi window of the geometry files read by the Mintpy template, with their .xml/.vrt,
+    # and write the <file>.full.xml of the full resolution size of the window, from which
+    # isce_utils.extract_multilook_number finds the looks of the cropped files
+    # <return> (alooks, rlooks) : looks of the geometry files, (1, 1) without a .full.xml
+    ############################################################
     ref_dir = os.path.join(process_dir, "merged", "geom_reference")
     dst = os.path.join(Mintpy_dir, "geom_reference")
-    if os.path.exists(dst):
-        shutil.rmtree(dst)
-    shutil.copytree(ref_dir, dst)
+    os.makedirs(dst, exist_ok=True)
+    files = [file for file in GEOMETRY_FILES if os.path.exists(os.path.join(ref_dir, file))]
+    translate_rasters([(get_raster_source(os.path.join(ref_dir, file)), os.path.join(dst, file)) for file in files],
+                      window, njobs)
+    looks = (1, 1)
+    for file in files:
+        if not os.path.exists(os.path.join(ref_dir, file + ".full.xml")):
+            continue
+        ## only the .full.xml is read, the full resolution binary is not needed
+        full_layouts = get_raw_layout(os.path.join(ref_dir, file + ".full"))
+        layouts, crop_layouts = get_raw_layout(os.path.join(ref_dir, file)), get_raw_layout(os.path.join(dst, file))
+        looks = (full_layouts[0][5] // layouts[0][5], full_layouts[0][6] // layouts[0][6])
+        ## a full resolution file staged by a previous run (maybe a hardlink) does not match the window
+        dst_full = os.path.join(dst, file + ".full")
+        for stale in (dst_full, dst_full + ".xml", dst_full + ".vrt", dst_full + ".hdr"):
+            if os.path.lexists(stale):
+                os.remove(stale)
+        write_raw_sidecars(dst_full, "rdr", crop_layouts[0][6] * looks[1], crop_layouts[0][5] * looks[0],
+                           len(full_layouts), full_layouts[0][1], vrt=False)
+    return looks
+
+def shift_reference_starting_range(process_dir, Mintpy_dir, x0, rlooks):
+    # move the startingrange of the staged reference IW*.xml to the first col x0 of the cropped window,
+    # the new files are written from the process ones and replace the staged copies / links
+    import xml.etree.ElementTree as ET
+    for ref_xml in sorted(glob.glob(os.path.join(process_dir, "reference", "IW*.xml"))):
+        tree = ET.parse(ref_xml)
+        shifted = 0
+        for parent in tree.getroot().iter():
+            props = {prop.get("name", "").lower(): prop for prop in parent.findall("property")}
+            if "startingrange" not in props or "rangepixelsize" not in props:
+                continue
+            starting_range = props["startingrange"].find("value")
+            pixel_size = float(props["rangepixelsize"].findtext("value"))
+            starting_range.text = str(float(starting_range.text) + x0 * rlooks * pixel_size)
+            shifted += 1
+        if not shifted:
+            print(f"WARNING: no startingrange in {ref_xml}, the slant range of the cropped stack starts at col 0")
+            continue
+        dst_xml = os.path.join(Mintpy_dir, "reference", os.path.basename(ref_xml))
+        tree.write(dst_xml + ".part")
+        os.replace(dst_xml + ".part", dst_xml)
     
-def copy_ifgramStackdatasets2Mintpy(process_dir, Mintpy_dir, date1, date2):
+def copy_ifgramStackdatasets2Mintpy(process_dir, Mintpy_dir, date1, date2, method="copy"):
+    selected_date_pair = get_selected_date12_paths(process_dir, date1, date2)
+    print(selected_date_pair)
+    intf_path = os.path.join(Mintpy_dir, "interferograms")
+    if not os.path.exists(intf_path):os.mkdir(intf_path)
+    ## the pairs staged by a previous run but out of the date range would be loaded by Mintpy
+    selected_names = {os.path.basename(path) for path in selected_date_pair}
+    for base_name in os.listdir(intf_path):
+        if base_name not in selected_names:
+            print(f"remove ifgram datesets out of the date range : {base_name}")
+            remove_path(os.path.join(intf_path, base_name))
+    tree_pairs = []
+    for path in selected_date_pair:
+        base_name = os.path.basename(path)
+        tree_pairs.append((path, os.path.join(intf_path, base_name)))
+        print(f"{method} ifgram datesets : {base_name}")
+    ## only the changed files of all the pairs, on one pool
+    sync_trees(tree_pairs, method)
+
+def crop_ifgramStackdatasets2Mintpy(process_dir, Mintpy_dir, date1, date2, window, njobs=TRANSLATE_JOBS):
+    # translate the roi window of the ifgram files of the selected pairs with their .xml/.vrt, on one pool
+    selected_date_pair = get_selected_date12_paths(process_dir, date1, date2)
+    intf_path = os.path.join(Mintpy_dir, "interferograms")
+    if not os.path.exists(intf_path):os.mkdir(intf_path)
+    selected_names = {os.path.basename(path) for path in selected_date_pair}
+    for base_name in os.listdir(intf_path):
+        if base_name not in selected_names:
+            print(f"remove ifgram datesets out of the date range : {base_name}")
+            remove_path(os.path.join(intf_path, base_name))
+    file_pairs = []
+    for path in selected_date_pair:
+        base_name = os.path.basename(path)
+        os.makedirs(os.path.join(intf_path, base_name), exist_ok=True)
+        for file in IFGRAM_FILES:
+            if os.path.exists(os.path.join(path, file)):
+                file_pairs.append((get_raster_source(os.path.join(path, file)),
+                                   os.path.join(intf_path, base_name, file)))
+    print(f"crop {len(file_pairs)} ifgram files of {len(selected_date_pair)} pairs to the window {window}")
+    translate_rasters(file_pairs, window, njobs)
+
+def get_selected_date12_paths(process_dir, date1, date2):
+    # the interferogram directories of merged/interferograms within date1 - date2
     intf_dir = os.path.join(process_dir, "merged", "interferograms")
     date_list, start_date, end_date = get_date_range(process_dir)
     inf_date12_list = os.listdir(intf_dir)
-    selected_path_list = list()
-    if date1 is None and date2 is None:
-        date1, date2 = start_date, end_date
-    elif date1 is None and date2 is not None:
+    if date1 is None:
         date1 = start_date
-    elif date1 is not None and date2 is None:
+    if date2 is None:
         date2 = end_date
-    elif date1 is not None and date2 is not None :
-        pass
-    
-    selected_date_pair = choose_correspond_date12_list(process_dir, date_list, inf_date12_list, date1, date2)    
-    print(selected_date_pair)
-    for path in selected_date_pair:
-        base_name = os.path.basename(path)
-        intf_path = os.path.join(Mintpy_dir, "interferograms")
-        if not os.path.exists(intf_path):os.mkdir(intf_path)
-        date_pair_path = os.path.join(intf_path, base_name)
-        if not os.path.exists(date_pair_path):os.mkdir(date_pair_path)
-        ref, dst = path, date_pair_path
-        if os.path.exists(dst):
-            shutil.rmtree(dst)
-        print(f"copy ifgram datesets : {base_name}")
-        shutil.copytree(ref, dst)
+    return choose_correspond_date12_list(process_dir, date_list, inf_date12_list, int(date1), int(date2))
         
 def choose_correspond_date12_list(process_dir, date_list, date12_list, date1, date2):
     """
@@ -112,23 +217,32 @@ def get_Mintpy_directory(process_dir,date1=None, date2=None):
             sys.exit(1)
     return Mintpy_dir
 
-def prepare_SAR_yx(Mintpy_dir, lat_min, lat_max, lon_min, lon_max):  
-    lat_file = os.path.join(Miaplpy_dir, "geom_reference", "lat.rdr")
-    lon_file = os.path.join(Miaplpy_dir, "geom_reference", "lon.rdr")
-
-    lat_data = read_isce_file(lat_file)
-    lon_data = read_isce_file(lon_file)
+def prepare_SAR_yx(process_dir, Mintpy_dir, lat_min, lat_max, lon_min, lon_max):  
+    # roi window [y0, y1, x0, x1] in the multilooked grid of the ifgrams, saved in roi.txt
+    lat_file = os.path.join(process_dir, "merged", "geom_reference", "lat.rdr")
+    lon_file = os.path.join(process_dir, "merged", "geom_reference", "lon.rdr")
 
-    y0, y1, x0, x1 = bbox2SAR(lat_min, lat_max, lon_min, lon_max,lat_data, lon_data)
-    y0, y1, x0, x1 = int(y0), int(y1), int(x0), int(x1)
-    roi_par = os.path.join(Mi, "roi.txt")
+    window = get_roi_window(lat_file, lon_file, lat_min, lat_max, lon_min, lon_max)
+    roi_par = os.path.join(Mintpy_dir, "roi.txt")
     print(f"save infomation of region of interesting in the file {roi_par}")
-    write_roi_par(y0, y1, x0, x1, roi_par)
+    write_roi_window(window, roi_par)
+    return window
     
 
-def write_mintpy_config(process_dir, Mintpy_dir):
+def write_mintpy_config(process_dir, Mintpy_dir, in_place=False, date1=None, date2=None, window=None, cropped=False):
+    # write the Mintpy template of the staged datasets in Mintpy_dir,
+    # or with in_place, of the original datasets of process_dir limited to date1 - date2 by the network
+    # window (list) : [y0, y1, x0, x1] roi window, the subset read by Mintpy unless the datasets are cropped to it
     project_name = os.path.basename(process_dir.rstrip('/'))
     mintpy_config = os.path.join(Mintpy_dir, f"{project_name}.txt")
+    if in_place:
+        ref_dir, baselines_dir = os.path.join(process_dir, 'reference'), os.path.join(process_dir, 'baselines')
+        intf_dir = os.path.join(process_dir, 'merged', 'interferograms')
+        geom_dir = os.path.join(process_dir, 'merged', 'geom_reference')
+    else:
+        ref_dir, baselines_dir = os.path.join(Mintpy_dir, 'reference'), os.path.join(Mintpy_dir, 'baselines')
+        intf_dir = os.path.join(Mintpy_dir, 'interferograms')
+        geom_dir = os.path.join(Mintpy_dir, 'geom_reference')
     
     print(f"Writing Mintpy config to {mintpy_config}")
     
@@ -136,21 +250,34 @@ def write_mintpy_config(process_dir, Mintpy_dir):
         example.write("mintpy.load.processor        = isce \n")
         example.write("mintpy.load.updateMode       = yes \n")
         example.write("##---------for ISCE only: \n")
-        example.write(f"mintpy.load.metaFile        = {os.path.join(Mintpy_dir, 'reference')}  #[path of common metadata file for the stack]\n")
-        example.write(f"mintpy.load.baselineDir     = {os.path.join(Mintpy_dir, 'baselines', 'IW*.xml')}\n")
+        example.write(f"mintpy.load.metaFile        = {ref_dir}  #[path of common metadata file for the stack]\n")
+        example.write(f"mintpy.load.baselineDir     = {os.path.join(baselines_dir, 'IW*.xml')}\n")
         example.write("##---------interferogram stack: \n")
-        example.write(f"mintpy.load.unwFile         = {os.path.join(Mintpy_dir, 'interferograms', '*', 'filt_fine.unw')}\n")
-        example.write(f"mintpy.load.corFile         = {os.path.join(Mintpy_dir, 'interferograms', '*', 'filt_fine.cor')}\n")
-        example.write(f"mintpy.load.connCompFile    = {os.path.join(Mintpy_dir, 'interferograms', '*', 'filt_fine.unw.conncomp')}\n")
+        example.write(f"mintpy.load.unwFile         = {os.path.join(intf_dir, '*', 'filt_fine.unw')}\n")
+        example.write(f"mintpy.load.corFile         = {os.path.join(intf_dir, '*', 'filt_fine.cor')}\n")
+        example.write(f"mintpy.load.connCompFile    = {os.path.join(intf_dir, '*', 'filt_fine.unw.conncomp')}\n")
         example.write("##---------geometry:\n")
-        example.write(f"mintpy.load.demFile         = {os.path.join(Mintpy_dir, 'geom_reference', 'hgt.rdr')}\n")
-        example.write(f"mintpy.load.lookupYFile     = {os.path.join(Mintpy_dir, 'geom_reference', 'lon.rdr')}\n")
-        example.write(f"mintpy.load.lookupXFile     = {os.path.join(Mintpy_dir, 'geom_reference', 'lat.rdr')}\n")
-        example.write(f"mintpy.load.incAngleFile    = {os.path.join(Mintpy_dir, 'geom_reference', 'los.rdr')}\n")
-        example.write(f"mintpy.load.azAngleFile     = {os.path.join(Mintpy_dir, 'geom_reference', 'los.rdr')}\n")
-        example.write(f"mintpy.load.shadowMaskFile  = {os.path.join(Mintpy_dir, 'geom_reference', 'shadowMask.rdr')}\n")
+        example.write(f"mintpy.load.demFile         = {os.path.join(geom_dir, 'hgt.rdr')}\n")
+        example.write(f"mintpy.load.lookupYFile     = {os.path.join(geom_dir, 'lon.rdr')}\n")
+        example.write(f"mintpy.load.lookupXFile     = {os.path.join(geom_dir, 'lat.rdr')}\n")
+        example.write(f"mintpy.load.incAngleFile    = {os.path.join(geom_dir, 'los.rdr')}\n")
+        example.write(f"mintpy.load.azAngleFile     = {os.path.join(geom_dir, 'los.rdr')}\n")
+        example.write(f"mintpy.load.shadowMaskFile  = {os.path.join(geom_dir, 'shadowMask.rdr')}\n")
+        if in_place:
+            example.write("##---------date range of the analysis window:\n")
+            if date1 is not None:
+                example.write(f"mintpy.network.startDate    = {date1}\n")
+            if date2 is not None:
+                example.write(f"mintpy.network.endDate      = {date2}\n")
         example.write("##---------subset (optional): \n")
-        example.write("mintpy.subset.yx            = auto\n")
+        if window is not None and not cropped:
+            y0, y1, x0, x1 = window
+            example.write(f"mintpy.subset.yx            = {y0}:{y1},{x0}:{x1}\n")
+        else:
+            if window is not None:
+                y0, y1, x0, x1 = window
+                example.write(f"## the datasets are cropped to the roi window {y0}:{y1},{x0}:{x1} of the scene\n")
+            example.write("mintpy.subset.yx            = auto\n")
         example.write("mintpy.subset.lalo          = auto\n")
         example.write("mintpy.network.coherenceBased = yes\n")
         example.write("mintpy.network.minCoherence = 0.4\n")
@@ -164,25 +291,185 @@ def write_mintpy_config(process_dir, Mintpy_dir):
 
 
 
-def prep_mintpy(process_dir, date1, date2, lat_min, lat_max, lon_min, lon_max):
+def get_stack_h5_metadata(process_dir, box):
+    # Mintpy attributes of the stack from the ISCE2 reference metadata, updated to the ROI box
+    meta_file = sorted(glob.glob(os.path.join(process_dir, "reference", "IW*.xml")))[0]
+    geom_dir = os.path.join(process_dir, "merged", "geom_reference")
+    meta = isce_utils.extract_isce_metadata(meta_file, geom_dir=geom_dir, update_mode=False)[0]
+    y0, y1, x0, x1 = box
+    return attribute.update_attribute4subset(meta, (x0, y0, x1, y1), print_msg=False)
+
+
+def get_pair_bperp(process_dir, date12_list):
+    # perpendicular baseline of each date1_date2 pair, mean of the top and bottom baselines as Mintpy
+    baseline_dict = isce_utils.read_baseline_timeseries(os.path.join(process_dir, "baselines"), processor="tops")
+    bperp = []
+    for date12 in date12_list:
+        date1, date2 = date12.split("_")
+        bperp.append(np.mean(baseline_dict[date2]) - np.mean(baseline_dict[date1]))
+    return np.array(bperp, dtype=np.float32)
+
+
+def get_h5_chunks(num_pair, length, width, itemsize):
+    # chunk (num_pair, rows, cols) holding the whole time series of a pixel tile in about H5_CHUNK_BYTES
+    cols = min(width, H5_CHUNK_COLS)
+    rows = max(1, min(length, H5_CHUNK_BYTES // (num_pair * cols * itemsize)))
+    return (num_pair, rows, cols)
+
+
+def read_raster_into(block, index, file, window, band):
+    # read a window in the worker thread, the memmap pages are read there and not in the writer
+    block[index] = read_raster(file, window=window, band=band)
+
+
+def select_ifgram_datasets(date12_paths):
+    ############################################################
+    # the IFGRAM_H5_DATASETS whose file is found in every pair
+    # a dataset found in no pair is skipped, an IFGRAM_H5_OPTIONAL one missing in some pairs
+    # is skipped with a warning, a required one missing in some pairs raises FileNotFoundError
+    # <1> date12_paths (list) : merged/interferograms/date1_date2 directories
+    # <return> {name: (file_name, band, dtype)}
+    ############################################################
+    datasets = {}
+    for name, spec in IFGRAM_H5_DATASETS.items():
+        missing = [path for path in date12_paths if not os.path.exists(os.path.join(path, spec[0]))]
+        if len(missing) == len(date12_paths):
+            print(f"no {spec[0]} in the pairs, skip {name}")
+        elif missing and name in IFGRAM_H5_OPTIONAL:
+            print(f"WARNING: {len(missing)}/{len(date12_paths)} pairs have no {spec[0]} "
+                  f"(e.g. {os.path.basename(missing[0])}), skip {name}")
+        elif missing:
+            raise FileNotFoundError(f"{len(missing)}/{len(date12_paths)} pairs have no {spec[0]}: "
+                                    f"{[os.path.basename(path) for path in missing]}")
+        else:
+            datasets[name] = spec
+    return datasets
+
+
+def write_ifgram_stack_h5(date12_paths, h5_file, box, meta, bperp, njobs=H5_LOAD_JOBS):
+    ############################################################
+    # stream the ROI window of the pairs into an ifgramStack.h5 of Mintpy
+    # the rows are read in blocks, the pairs of a block by parallel readers
+    # <1> date12_paths (list) : sorted merged/interferograms/date1_date2 directories
+    # <2> h5_file (str)       : the output ifgramStack.h5
+    # <3> box (list)          : [y0, y1, x0, x1] ROI window
+    # <4> meta (dict)         : Mintpy attributes of the ROI
+    # <5> bperp (np.array)    : perpendicular baseline of the pairs
+    # <6> njobs (int)         : number of reader threads
+    ############################################################
+    y0, y1, x0, x1 = box
+    length, width, num_pair = y1 - y0, x1 - x0, len(date12_paths)
+    date12 = [os.path.basename(path).split("_") for path in date12_paths]
+    datasets = select_ifgram_datasets(date12_paths)
+    with h5py.File(h5_file, "w") as f, Parallel(n_jobs=njobs, prefer="threads") as parallel:
+        f.attrs.update({key: str(value) for key, value in meta.items()})
+        f.attrs["FILE_TYPE"] = "ifgramStack"
+        f.attrs["LENGTH"], f.attrs["WIDTH"] = str(length), str(width)
+        f.create_dataset("date", data=np.array(date12, dtype=np.bytes_))
+        f.create_dataset("bperp", data=bperp)
+        f.create_dataset("dropIfgram", data=np.ones(num_pair, dtype=np.bool_))
+        for name, (file_name, band, dtype) in datasets.items():
+            itemsize = np.dtype(dtype).itemsize
+            chunks = get_h5_chunks(num_pair, length, width, itemsize)
+            ds = f.create_dataset(name, shape=(num_pair, length, width), dtype=dtype, chunks=chunks)
+            block_rows = max(H5_BLOCK_BYTES // (num_pair * width * itemsize) // chunks[1], 1) * chunks[1]
+            print(f"write {name} of {num_pair} pairs ({length} x {width}, chunks {chunks})")
+            for r0 in range(y0, y1, block_rows):
+                r1 = min(r0 + block_rows, y1)
+                block = np.empty((num_pair, r1 - r0, width), dtype=dtype)
+                parallel(delayed(read_raster_into)(block, i, os.path.join(path, file_name), [r0, r1, x0, x1], band)
+                         for i, path in enumerate(date12_paths))
+                ds[:, r0-y0:r1-y0, :] = block
+                print(f"  {name} rows {r1 - y0}/{length}")
+    print(f"ifgramStack saved in {h5_file}")
+
+
+def write_geometry_h5(geom_dir, h5_file, box, meta, njobs=H5_LOAD_JOBS):
+    # write the ROI window of geom_reference into a geometryRadar.h5 of Mintpy
+    y0, y1, x0, x1 = box
+    datasets = {name: spec for name, spec in GEOMETRY_H5_DATASETS.items()
+                if os.path.exists(os.path.join(geom_dir, spec[0]))}
+    data = Parallel(n_jobs=njobs, prefer="threads")(
+        delayed(read_raster)(os.path.join(geom_dir, file_name), box, band)
+        for file_name, band, dtype in datasets.values())
+    with h5py.File(h5_file, "w") as f:
+        f.attrs.update({key: str(value) for key, value in meta.items()})
+        f.attrs["FILE_TYPE"] = "geometry"
+        f.attrs["LENGTH"], f.attrs["WIDTH"] = str(y1 - y0), str(x1 - x0)
+        for (name, (file_name, band, dtype)), values in zip(datasets.items(), data):
+            f.create_dataset(name, data=np.asarray(values, dtype=dtype), chunks=True)
+        f.create_dataset("slantRangeDistance", data=np.asarray(ut.range_distance(meta, dimension=2), dtype=np.float32),
+                         chunks=True)
+    print(f"geometry saved in {h5_file}")
+
+
+def load_mintpy_h5(process_dir, Mintpy_dir, date1, date2, box, njobs=H5_LOAD_JOBS):
+    ############################################################
+    # load the selected pairs of the ROI into Mintpy_dir/inputs without the per-pair files of load_data
+    # <1> process_dir (str)   : the ISCE2 process directory
+    # <2> Mintpy_dir (str)    : the Mintpy directory
+    # <3~4> date1, date2      : date range of the pairs
+    # <5> box (list)          : [y0, y1, x0, x1] roi window of prepare_SAR_yx
+    # <6> njobs (int)         : number of reader threads
+    ############################################################
+    date12_paths = sorted(get_selected_date12_paths(process_dir, date1, date2))
+    if not date12_paths:
+        print(f"no interferogram within {date1} - {date2}")
+        sys.exit(1)
+    geom_dir = os.path.join(process_dir, "merged", "geom_reference")
+    meta = get_stack_h5_metadata(process_dir, box)
+    bperp = get_pair_bperp(process_dir, [os.path.basename(path) for path in date12_paths])
+    inputs_dir = os.path.join(Mintpy_dir, "inputs")
+    os.makedirs(inputs_dir, exist_ok=True)
+    write_ifgram_stack_h5(date12_paths, os.path.join(inputs_dir, "ifgramStack.h5"), box, meta, bperp, njobs)
+    write_geometry_h5(geom_dir, os.path.join(inputs_dir, "geometryRadar.h5"), box, meta, njobs)
+
+
+def prep_mintpy(process_dir, date1, date2, lat_min, lat_max, lon_min, lon_max, stage="copy", njobs=H5_LOAD_JOBS,
+                crop=False):
+    # stage (str) : copy / hardlink / symlink the datasets into the Mintpy directory,
+    #               template : only write a template reading the datasets in place,
+    #               or h5 : load the ROI of the datasets into the inputs h5 files of Mintpy
+    # crop (bool) : with copy / hardlink / symlink, write only the roi window of the ifgram and geometry files
     print("prepare mintpy datasets beginning...")
     ## step1 : make Mintpy Analysis directory based on the date1/date2
     Mintpy_dir = get_Mintpy_directory(process_dir, date1, date2)
     print(f"create the mintpy directory named {os.path.basename(Mintpy_dir)}")
     if not os.path.exists(Mintpy_dir):os.mkdir(Mintpy_dir)
-    ## step2 : copy some relevant datasets like baselines and Metadata to Mintpy directory
-    print("copy baselines directory to Mintpy directory...")
-    copy_baselinesdataset2Mintpy(process_dir, Mintpy_dir)
-    print("copy reference directory to Mintpy directory...")
-    copy_referenceMetadataset2Mintpy(process_dir, Mintpy_dir)
-    print("copy geomReference directory to Mintpy directory...")
-    copy_geomreferencedataset2Mintpy(process_dir, Mintpy_dir)
-    ## step3 : copy ifgrams according to the given date1 and date2. 
-    print("copy relevant ifgrams according to the given date1 and date2")
-    copy_ifgramStackdatasets2Mintpy(process_dir, Mintpy_dir, date1=date1, date2=date2)
-    ## step4 : write mintpy config 
+    ## step2 : the roi window, Mintpy only reads it
+    print("find the SAR yx based on the lookuptable and lat lon ...")
+    window = prepare_SAR_yx(process_dir, Mintpy_dir, lat_min, lat_max, lon_min, lon_max)
+    if stage in ("template", "h5"):
+        print("write mintpy config reading the datasets in place ... ")
+        write_mintpy_config(process_dir, Mintpy_dir, in_place=True, date1=date1, date2=date2, window=window)
+    if stage == "h5":
+        print("load the ifgram stack and geometry of the ROI into h5 files ... ")
+        load_mintpy_h5(process_dir, Mintpy_dir, date1, date2, window, njobs)
+        project_name = os.path.basename(process_dir.rstrip('/'))
+        print(f"start Mintpy after load_data : smallbaselineApp.py {project_name}.txt --start modify_network")
+    if stage in ("template", "h5"):
+        print("normal processing of prep_mintpy_analysis.py finish !")
+        return
+    ## step3 : copy some relevant datasets like baselines and Metadata to Mintpy directory
+    print(f"{stage} baselines directory to Mintpy directory...")
+    copy_baselinesdataset2Mintpy(process_dir, Mintpy_dir, stage)
+    print(f"{stage} reference directory to Mintpy directory...")
+    copy_referenceMetadataset2Mintpy(process_dir, Mintpy_dir, stage)
+    ## step4 : copy ifgrams according to the given date1 and date2, or their roi window
+    if crop:
+        print("crop geomReference files to the roi window ...")
+        _, rlooks = crop_geomreferencedataset2Mintpy(process_dir, Mintpy_dir, window)
+        shift_reference_starting_range(process_dir, Mintpy_dir, window[2], rlooks)
+        print("crop relevant ifgrams according to the given date1 and date2 to the roi window")
+        crop_ifgramStackdatasets2Mintpy(process_dir, Mintpy_dir, date1, date2, window)
+    else:
+        print(f"{stage} geomReference directory to Mintpy directory...")
+        copy_geomreferencedataset2Mintpy(process_dir, Mintpy_dir, stage)
+        print(f"{stage} relevant ifgrams according to the given date1 and date2")
+        copy_ifgramStackdatasets2Mintpy(process_dir, Mintpy_dir, date1=date1, date2=date2, method=stage)
+    ## step5 : write mintpy config 
     print("write mintpy config ... ")
-    write_mintpy_config(process_dir, Mintpy_dir)
+    write_mintpy_config(process_dir, Mintpy_dir, window=window, cropped=crop)
     print("normal processing of prep_mintpy_analysis.py finish !")
 
 def create_parser():
@@ -213,6 +500,17 @@ def create_parser():
     
     parser.add_argument('--lon-max', type = float, required=True,
                         help='maxmium longitude of the region of interest')
+    
+    # staging of the datasets
+    parser.add_argument('--stage', type=str, default='copy', choices=list(STAGE_METHODS) + ['template', 'h5'],
+                        help='copy / hardlink / symlink the datasets into the Mintpy directory, template: '
+                             'only write a template reading them in place, or h5: load the ROI into the '
+                             'inputs/ifgramStack.h5 and inputs/geometryRadar.h5 of Mintpy (default: copy)')
+    parser.add_argument('--njobs', type=int, default=H5_LOAD_JOBS,
+                        help=f'number of reader threads of --stage h5 (default: {H5_LOAD_JOBS})')
+    parser.add_argument('--crop', action='store_true', default=False,
+                        help='with --stage copy/hardlink/symlink, write only the roi window of the ifgram '
+                             'and geometry files (default: stage them at full size and subset in Mintpy)')
     return parser
 
     
@@ -231,5 +529,5 @@ if __name__ == '__main__':
     
     # run prep_miaplpy
     prep_mintpy(process_dir, date1=date1, date2=date2, 
-                 lat_min=lat_min, lat_max = lat_max, lon_min=lon_min, lon_max=lon_max)
+                 lat_min=lat_min, lat_max = lat_max, lon_min=lon_min, lon_max=lon_max, stage=args.stage, njobs=args.njobs, crop=args.crop)
     
\ No newline at end of file
@@ -0,0 +1,115 @@
+import os
+import sys
+import types
+import threading
+import importlib.abc
+import importlib.machinery
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+## the processing environment (ISCE2 / GDAL / MintPy ...) and the IntfLab packages next to the scripts,
+## the tests only exercise the pure python logic of the scripts, so these import as placeholders when missing
+PLACEHOLDER_PACKAGES = ("osgeo", "mintpy", "geopandas", "shapely", "h5py", "reset", "cores")
+
+
+class PlaceholderModule(types.ModuleType):
+    # a missing module, any attribute is another placeholder (classes, functions, constants ...)
+    __path__ = []
+    __all__ = []
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        value = PlaceholderModule(f"{self.__name__}.{name}")
+        setattr(self, name, value)
+        return value
+
+    def __call__(self, *args, **kwargs):
+        return PlaceholderModule(f"{self.__name__}()")
+
+
+class PlaceholderFinder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    # appended after the real finders : only the packages that are not installed become placeholders
+    def find_spec(self, fullname, path, target=None):
+        if fullname.split(".")[0] in PLACEHOLDER_PACKAGES:
+            return importlib.machinery.ModuleSpec(fullname, self, is_package=True)
+        return None
+
+    def create_module(self, spec):
+        return PlaceholderModule(spec.name)
+
+    def exec_module(self, module):
+        pass
+
+
+sys.meta_path.append(PlaceholderFinder())
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    # serve the files of server.root with "Range: bytes=N-" support,
+    # server.mode : "range" (206 / 416), "full" (ignore Range, always 200) or "truncate" (half of the body)
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        path = os.path.join(self.server.root, self.path.lstrip("/"))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        range_header = self.headers.get("Range")
+        if range_header and self.server.mode == "range":
+            offset = int(range_header.split("=")[1].rstrip("-"))
+            if offset >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {offset}-{len(data) - 1}/{len(data)}")
+            data = data[offset:]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.server.mode == "truncate":
+            data = data[:len(data) // 2]
+            self.close_connection = True
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FileServer(ThreadingHTTPServer):
+    def serve(self, name, data):
+        # publish data as the file name, return its url
+        with open(os.path.join(self.root, name), "wb") as f:
+            f.write(data)
+        return f"{self.url}/{name}"
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    # a local http server on tmp_path/www, server.url is its base url
+    root = tmp_path / "www"
+    root.mkdir()
+    server = FileServer(("127.0.0.1", 0), RangeRequestHandler)
+    server.root, server.mode, server.requests = str(root), "range", []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def intflab_cache(tmp_path_factory, monkeypatch):
+    # keep the shared IntfLab cache (scene index, catalogs) of each test out of the user's cache
+    cache_dir = tmp_path_factory.mktemp("intflab_cache")
+    monkeypatch.setenv("INTFLAB_CACHE_DIR", str(cache_dir))
+    return cache_dir
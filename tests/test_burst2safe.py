@@ -0,0 +1,57 @@
+import os
+
+import S1_burst2safe
+
+BURST_XML = """<product><adsHeader><missionId>S1A</missionId><absoluteOrbitNumber>46711</absoluteOrbitNumber></adsHeader>
+<swathTiming><linesPerBurst>10</linesPerBurst><burstList><burst><burstId>{burst_id}</burstId></burst></burstList></swathTiming>
+<geolocationGrid><geolocationGridPointList>{points}</geolocationGridPointList></geolocationGrid></product>"""
+POINT_XML = "<geolocationGridPoint><line>{line}</line><latitude>{lat}</latitude><longitude>{lon}</longitude></geolocationGridPoint>"
+
+
+def make_burst(datadir, burst_id, lat, polarization="VV", date="20230101", xml=True):
+    # a burst tiff (empty) and its metadata xml, the footprint spans [lat, lat + 1] x [10, 11]
+    name = f"S1_{burst_id}_IW2_{date}T015045_{polarization}_ABCD-BURST"
+    open(os.path.join(datadir, name + ".tiff"), "w").close()
+    if xml:
+        points = "".join(POINT_XML.format(line=line, lat=lat + line / 10, lon=lon)
+                         for line in (0, 10) for lon in (10, 11))
+        with open(os.path.join(datadir, name + ".xml"), "w") as f:
+            f.write(BURST_XML.format(burst_id=burst_id, points=points))
+    return name
+
+
+def make_catalog(tmp_path):
+    names = [make_burst(str(tmp_path), 100 + i, i) for i in range(4)]
+    names.append(make_burst(str(tmp_path), 101, 1, polarization="VH"))
+    catalog_file = S1_burst2safe.get_burst_catalog_file(str(tmp_path))
+    assert S1_burst2safe.update_burst_catalog(str(tmp_path), catalog_file) == 5
+    return names, catalog_file
+
+
+def test_burst_catalog_in_the_cache(tmp_path, intflab_cache):
+    _, catalog_file = make_catalog(tmp_path)
+    assert catalog_file.startswith(str(intflab_cache))
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".sqlite")]
+    ## unchanged bursts are not parsed again
+    assert S1_burst2safe.update_burst_catalog(str(tmp_path), catalog_file) == 0
+
+
+def test_select_bursts(tmp_path):
+    names, catalog_file = make_catalog(tmp_path)
+    assert S1_burst2safe.select_bursts(catalog_file, [0.2, 1.5, 10.2, 10.8], "vv") == set(names[:2])
+    assert S1_burst2safe.select_bursts(catalog_file, [1.2, 1.5, 10.2, 10.8]) == set(names[:3] + names[4:])
+    assert S1_burst2safe.select_bursts(catalog_file, [20, 21, 10.2, 10.8], "vv") == set()
+
+
+def test_select_bursts_keeps_neighbours(tmp_path):
+    names, catalog_file = make_catalog(tmp_path)
+    ## a single burst intersecting the bbox keeps the bursts before and after it
+    assert S1_burst2safe.select_bursts(catalog_file, [1.2, 1.8, 10.2, 10.8], "VV") == set(names[:3])
+    assert S1_burst2safe.select_bursts(catalog_file, [3.2, 3.8, 10.2, 10.8], "VV") == set(names[2:4])
+
+
+def test_select_bursts_keeps_bursts_without_footprint(tmp_path):
+    names, catalog_file = make_catalog(tmp_path)
+    unknown = make_burst(str(tmp_path), 200, 0, xml=False)
+    S1_burst2safe.update_burst_catalog(str(tmp_path), catalog_file)
+    assert S1_burst2safe.select_bursts(catalog_file, [20, 21, 10.2, 10.8], "VV") == {unknown}
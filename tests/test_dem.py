@@ -0,0 +1,80 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+S1_dem = pytest.importorskip("S1_dem")
+
+
+def test_fetch_url(http_server, tmp_path):
+    url = http_server.serve("egm96.tif", b"geoid")
+    save_path = str(tmp_path / "egm96.tif")
+    assert S1_dem.fetch_url(url, save_path)
+    assert open(save_path, "rb").read() == b"geoid"
+    assert not os.path.exists(save_path + ".part")
+    assert not S1_dem.fetch_url(f"{http_server.url}/missing.tif", str(tmp_path / "missing.tif"))
+    assert not os.path.exists(tmp_path / "missing.tif")
+
+
+def test_fetch_url_file_scheme(tmp_path):
+    src = tmp_path / "src.tif"
+    src.write_bytes(b"geoid")
+    save_path = str(tmp_path / "dst.tif")
+    assert S1_dem.fetch_url(src.as_uri(), save_path)
+    assert open(save_path, "rb").read() == b"geoid"
+    assert not S1_dem.fetch_url((tmp_path / "missing.tif").as_uri(), str(tmp_path / "missing.tif"))
+
+
+def test_fetch_srtm_tile(http_server, tmp_path):
+    hgt = bytes((S1_dem.SRTM_SAMPLES + 1)**2 * 2)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("N35W122.hgt", hgt)
+    http_server.serve("N35W122.SRTMGL1.hgt.zip", buffer.getvalue())
+    cache_dir = str(tmp_path / "cache")
+    os.makedirs(cache_dir)
+    hgt_path = S1_dem.fetch_srtm_tile("N35W122", cache_dir, http_server.url)
+    assert hgt_path == os.path.join(cache_dir, "N35W122.hgt")
+    assert os.path.getsize(hgt_path) == len(hgt)
+    assert sorted(os.listdir(cache_dir)) == ["N35W122.hgt"]
+    ## the cached tile is not fetched again
+    assert S1_dem.fetch_srtm_tile("N35W122", cache_dir, http_server.url) == hgt_path
+    assert len(http_server.requests) == 1
+
+
+def test_fetch_srtm_tile_missing_marker(http_server, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    os.makedirs(cache_dir)
+    assert S1_dem.fetch_srtm_tile("N00W150", cache_dir, http_server.url) is None
+    assert sorted(os.listdir(cache_dir)) == ["N00W150.missing"]
+    ## an ocean tile is only looked up once
+    assert S1_dem.fetch_srtm_tile("N00W150", cache_dir, http_server.url) is None
+    assert http_server.requests == [("/N00W150.SRTMGL1.hgt.zip", None)]
+
+
+def test_fetch_srtm_tile_missing_marker_other_mirror(http_server, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    os.makedirs(cache_dir)
+    assert S1_dem.fetch_srtm_tile("N00W150", cache_dir, http_server.url) is None
+    assert open(os.path.join(cache_dir, "N00W150.missing")).read().strip() == http_server.url
+    ## a marker of another mirror does not hide the tile of this one
+    hgt = bytes((S1_dem.SRTM_SAMPLES + 1)**2 * 2)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        zip_file.writestr("N00W150.hgt", hgt)
+    mirror = tmp_path / "mirror"
+    mirror.mkdir()
+    (mirror / "N00W150.SRTMGL1.hgt.zip").write_bytes(buffer.getvalue())
+    hgt_path = S1_dem.fetch_srtm_tile("N00W150", cache_dir, mirror.as_uri())
+    assert hgt_path == os.path.join(cache_dir, "N00W150.hgt")
+    assert sorted(os.listdir(cache_dir)) == ["N00W150.hgt", "N00W150.missing"]
+
+
+def test_evict_dem_cache_expires_missing_markers(tmp_path):
+    old_marker, new_marker = tmp_path / "N00W150.missing", tmp_path / "N01W150.missing"
+    old_marker.write_text("http://mirror\n")
+    new_marker.write_text("http://mirror\n")
+    os.utime(old_marker, (0, 0))
+    S1_dem.evict_dem_cache(str(tmp_path), max_gb=1, max_age_days=30)
+    assert sorted(os.listdir(tmp_path)) == ["N01W150.missing"]
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+S1_orbit = pytest.importorskip("S1_orbit")
+
+ORBIT_NAME = "S1A_OPER_AUX_POEORB_OPOD_20230121T080702_V20230101T225942_20230103T005942.EOF"
+ORBIT_DATA = b"<Earth_Explorer_File>" + bytes(range(256)) * 64 + b"</Earth_Explorer_File>"
+
+
+def test_download_file(http_server, tmp_path):
+    url = http_server.serve(ORBIT_NAME, ORBIT_DATA)
+    save_path = str(tmp_path / ORBIT_NAME)
+    ok, nbytes = S1_orbit.download_file(S1_orbit.create_session(), (url, save_path))
+    assert ok and nbytes == len(ORBIT_DATA)
+    assert open(save_path, "rb").read() == ORBIT_DATA
+    assert not os.path.exists(save_path + ".part")
+    assert http_server.requests == [(f"/{ORBIT_NAME}", None)]
+
+
+def test_download_file_resumes_part(http_server, tmp_path):
+    url = http_server.serve(ORBIT_NAME, ORBIT_DATA)
+    save_path = str(tmp_path / ORBIT_NAME)
+    with open(save_path + ".part", "wb") as f:
+        f.write(ORBIT_DATA[:1000])
+    ok, nbytes = S1_orbit.download_file(S1_orbit.create_session(), (url, save_path))
+    assert ok and nbytes == len(ORBIT_DATA) - 1000
+    assert http_server.requests == [(f"/{ORBIT_NAME}", "bytes=1000-")]
+    assert open(save_path, "rb").read() == ORBIT_DATA
+    assert not os.path.exists(save_path + ".part")
+
+
+def test_download_file_restarts_without_range_support(http_server, tmp_path):
+    http_server.mode = "full"
+    url = http_server.serve(ORBIT_NAME, ORBIT_DATA)
+    save_path = str(tmp_path / ORBIT_NAME)
+    with open(save_path + ".part", "wb") as f:
+        f.write(b"stale partial download")
+    ok, nbytes = S1_orbit.download_file(S1_orbit.create_session(), (url, save_path))
+    assert ok and nbytes == len(ORBIT_DATA)
+    assert open(save_path, "rb").read() == ORBIT_DATA
+
+
+def test_download_file_complete_part_416(http_server, tmp_path):
+    url = http_server.serve(ORBIT_NAME, ORBIT_DATA)
+    save_path = str(tmp_path / ORBIT_NAME)
+    with open(save_path + ".part", "wb") as f:
+        f.write(ORBIT_DATA)
+    ok, nbytes = S1_orbit.download_file(S1_orbit.create_session(), (url, save_path))
+    assert ok and nbytes == 0
+    assert http_server.requests == [(f"/{ORBIT_NAME}", f"bytes={len(ORBIT_DATA)}-")]
+    assert open(save_path, "rb").read() == ORBIT_DATA
+
+
+def test_download_file_interrupted_keeps_part(http_server, tmp_path):
+    http_server.mode = "truncate"
+    url = http_server.serve(ORBIT_NAME, ORBIT_DATA)
+    save_path = str(tmp_path / ORBIT_NAME)
+    ok, _ = S1_orbit.download_file(S1_orbit.create_session(), (url, save_path), chunk_size=1024)
+    ## an interrupted download is never taken for the orbit file
+    assert not ok and not os.path.exists(save_path)
+    part_size = os.path.getsize(save_path + ".part")
+    assert 0 < part_size < len(ORBIT_DATA)
+    http_server.mode = "range"
+    ok, nbytes = S1_orbit.download_file(S1_orbit.create_session(), (url, save_path))
+    assert ok and nbytes == len(ORBIT_DATA) - part_size
+    assert open(save_path, "rb").read() == ORBIT_DATA
+
+
+def test_download_file_not_found(http_server, tmp_path):
+    save_path = str(tmp_path / ORBIT_NAME)
+    ok, nbytes = S1_orbit.download_file(S1_orbit.create_session(), (f"{http_server.url}/{ORBIT_NAME}", save_path))
+    assert not ok and nbytes == 0
+    assert not os.path.exists(save_path)
+
+
+def test_download_file_concurrent_same_target(http_server, tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    url = http_server.serve(ORBIT_NAME, ORBIT_DATA)
+    save_path = str(tmp_path / ORBIT_NAME)
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda _: S1_orbit.download_file(S1_orbit.create_session(), (url, save_path)),
+                                range(4)))
+    assert all(ok for ok, _ in results)
+    assert sum(nbytes for _, nbytes in results) == len(ORBIT_DATA)
+    assert open(save_path, "rb").read() == ORBIT_DATA
+    assert len(http_server.requests) == 1
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+import prep_mintpy_analysis
+
+
+def make_pairs(tmp_path, files):
+    paths = []
+    for pair, names in files.items():
+        path = tmp_path / pair
+        path.mkdir()
+        for name in names:
+            (path / name).write_bytes(b"")
+        paths.append(str(path))
+    return paths
+
+
+def test_select_ifgram_datasets(tmp_path):
+    all_files = ["filt_fine.unw", "filt_fine.cor", "filt_fine.unw.conncomp"]
+    paths = make_pairs(tmp_path, {"20230101_20230113": all_files, "20230113_20230125": all_files})
+    assert list(prep_mintpy_analysis.select_ifgram_datasets(paths)) == \
+        ["unwrapPhase", "coherence", "connectComponent"]
+
+
+def test_select_ifgram_datasets_conncomp_of_some_pairs(tmp_path):
+    paths = make_pairs(tmp_path, {
+        "20230101_20230113": ["filt_fine.unw", "filt_fine.cor", "filt_fine.unw.conncomp"],
+        "20230113_20230125": ["filt_fine.unw", "filt_fine.cor"]})
+    assert list(prep_mintpy_analysis.select_ifgram_datasets(paths)) == ["unwrapPhase", "coherence"]
+    assert list(prep_mintpy_analysis.select_ifgram_datasets(paths[::-1])) == ["unwrapPhase", "coherence"]
+
+
+def test_select_ifgram_datasets_required_missing(tmp_path):
+    paths = make_pairs(tmp_path, {
+        "20230101_20230113": ["filt_fine.unw", "filt_fine.cor"],
+        "20230113_20230125": ["filt_fine.cor"]})
+    with pytest.raises(FileNotFoundError):
+        prep_mintpy_analysis.select_ifgram_datasets(paths)
+
+
+def test_shift_reference_starting_range(tmp_path):
+    process_dir, Mintpy_dir = tmp_path / "process", tmp_path / "Mintpy"
+    (process_dir / "reference").mkdir(parents=True)
+    (Mintpy_dir / "reference").mkdir(parents=True)
+    burst = ('<component name="burst{}"><property name="startingrange"><value>800000.0</value></property>'
+             '<property name="rangepixelsize"><value>2.5</value></property></component>')
+    ref_xml = process_dir / "reference" / "IW1.xml"
+    ref_xml.write_text(f'<productmanager_name><component name="bursts">{burst.format(1)}{burst.format(2)}'
+                       '</component></productmanager_name>')
+    ## the staged file is a link of the process one, it is replaced and not edited
+    os.link(ref_xml, Mintpy_dir / "reference" / "IW1.xml")
+    prep_mintpy_analysis.shift_reference_starting_range(str(process_dir), str(Mintpy_dir), 10, 4)
+    staged = (Mintpy_dir / "reference" / "IW1.xml").read_text()
+    assert staged.count("<value>800100.0</value>") == 2
+    assert "800000.0" in ref_xml.read_text() and "800100.0" not in ref_xml.read_text()
@@ -0,0 +1,130 @@
+import os
+
+import S1_runISCE2
+
+
+def write_run_file(run_files_dir, name, lines):
+    path = os.path.join(run_files_dir, name)
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+
+def test_parse_run_file(tmp_path):
+    script = write_run_file(str(tmp_path), "run_02_unpack_secondary_slc", [
+        "#!/bin/bash", "",
+        "SentinelWrapper.py -c configs/config_secondary_20230101 &",
+        "SentinelWrapper.py -c configs/config_secondary_20230113 &",
+        "wait",
+        "wait",
+        "SentinelWrapper.py -c configs/config_secondary_20230125",
+    ])
+    assert S1_runISCE2.parse_run_file(script) == [
+        ["SentinelWrapper.py -c configs/config_secondary_20230101",
+         "SentinelWrapper.py -c configs/config_secondary_20230113"],
+        ["SentinelWrapper.py -c configs/config_secondary_20230125"],
+    ]
+
+
+def test_get_line_key():
+    assert S1_runISCE2.get_line_key("SentinelWrapper.py -c configs/config_igram_20230101_20230113") \
+        == "20230101_20230113"
+    assert S1_runISCE2.get_line_key("SentinelWrapper.py -c configs/config_reference") is None
+    assert S1_runISCE2.get_line_key("") is None
+
+
+def make_stack_run_files(run_files_dir):
+    dates, pairs = ["20230113", "20230125"], ["20230101_20230113", "20230113_20230125"]
+    return [
+        write_run_file(run_files_dir, "run_01_unpack_topo_reference",
+                       ["SentinelWrapper.py -c configs/config_reference"]),
+        write_run_file(run_files_dir, "run_02_unpack_secondary_slc",
+                       [f"SentinelWrapper.py -c configs/config_secondary_{d}" for d in dates]),
+        write_run_file(run_files_dir, "run_03_average_baseline",
+                       [f"SentinelWrapper.py -c configs/config_baseline_{d}" for d in dates]),
+        write_run_file(run_files_dir, "run_04_fullBurst_resample",
+                       [f"SentinelWrapper.py -c configs/config_resamp_{d}" for d in dates]),
+        write_run_file(run_files_dir, "run_05_merge_burst_igram",
+                       [f"SentinelWrapper.py -c configs/config_merge_igram_{p}" for p in pairs]),
+        write_run_file(run_files_dir, "run_06_filter_coherence",
+                       [f"SentinelWrapper.py -c configs/config_igram_filt_coh_{p}" for p in pairs]),
+    ]
+
+
+def test_build_task_graph(tmp_path):
+    units, tasks = S1_runISCE2.build_task_graph(make_stack_run_files(str(tmp_path)))
+    assert [unit["name"] for unit in units] == [
+        "unpack_topo_reference", "unpack_secondary_slc", "average_baseline",
+        "fullBurst_resample", "merge_burst_igram", "filter_coherence"]
+    assert [unit["remaining"] for unit in units] == [1, 2, 2, 2, 2, 2]
+    assert [task["line"] for task in tasks] == [1, 1, 2, 1, 2, 1, 2, 1, 2, 1, 2]
+    by_name = {unit["name"]: [tasks[t] for t in unit["tasks"]] for unit in units}
+    ## the secondaries are unpacked without waiting for the reference
+    assert all(not task["wait_units"] and not task["wait_tasks"] for task in by_name["unpack_secondary_slc"])
+    ## a step missing in STEP_DEPENDENCIES waits for all the previous run files
+    assert all(task["wait_units"] == {0, 1} for task in by_name["average_baseline"])
+    ## a keyed step waits for the line of the previous step with the same date (pair)
+    for resample, baseline in zip(by_name["fullBurst_resample"], by_name["average_baseline"]):
+        assert resample["key"] == baseline["key"]
+        assert resample["wait_tasks"] == {baseline["id"]} and not resample["wait_units"]
+    ## the first pairs step has no line with the same key : it waits for the whole previous run file
+    assert all(task["wait_units"] == {3} and not task["wait_tasks"] for task in by_name["merge_burst_igram"])
+    for filt, merge in zip(by_name["filter_coherence"], by_name["merge_burst_igram"]):
+        assert filt["wait_tasks"] == {merge["id"]}
+    assert all(task["status"] == "pending" for task in tasks)
+
+
+def test_build_task_graph_wait_groups(tmp_path):
+    script = write_run_file(str(tmp_path), "run_04_fullBurst_resample", [
+        "SentinelWrapper.py -c configs/config_resamp_20230113 &", "wait",
+        "SentinelWrapper.py -c configs/config_resamp_20230125 &", "wait",
+    ])
+    units, tasks = S1_runISCE2.build_task_graph([script])
+    assert [unit["name"] for unit in units] == ["fullBurst_resample", "fullBurst_resample.1"]
+    ## the group after a "wait" line waits for the groups before it
+    assert tasks[1]["wait_units"] == {0}
+    assert [task["line"] for task in tasks] == [1, 2]
+
+
+def run_pairs_stack(process_dir):
+    run_files_dir = os.path.join(process_dir, "run_files")
+    os.makedirs(os.path.join(run_files_dir, "logs"), exist_ok=True)
+    pairs = ["20230101_20230113", "20230113_20230125"]
+    ## each line writes filt.int into its pair directory, the last token names the config of the pair
+    script = write_run_file(run_files_dir, "run_01_filter_coherence", [
+        f"mkdir -p ../merged/interferograms/{p} && echo {p} > ../merged/interferograms/{p}/filt.int; "
+        f"true configs/config_igram_filt_coh_{p}" for p in pairs])
+    units, tasks = S1_runISCE2.build_task_graph([script])
+    journal_file = os.path.join(run_files_dir, "logs", S1_runISCE2.JOURNAL_NAME)
+    n_done = S1_runISCE2.resume_task_graph(units, tasks, run_files_dir, journal_file)
+    assert S1_runISCE2.run_task_graph(units, tasks, run_files_dir, os.path.join(run_files_dir, "logs"), 2,
+                                      journal_file)
+    return n_done, journal_file
+
+
+def test_journal_records_outputs(tmp_path):
+    n_done, journal_file = run_pairs_stack(str(tmp_path))
+    assert n_done == 0
+    records = S1_runISCE2.load_journal(journal_file)
+    outputs = records[("run_01_filter_coherence", 1)]["outputs"]
+    assert [output[:2] for output in outputs] == [["merged/interferograms/20230101_20230113/filt.int", 18]]
+    ## both lines are skipped on resume
+    assert run_pairs_stack(str(tmp_path))[0] == 2
+
+
+def test_journal_reruns_lines_with_changed_outputs(tmp_path):
+    run_pairs_stack(str(tmp_path))
+    os.remove(tmp_path / "merged" / "interferograms" / "20230101_20230113" / "filt.int")
+    filt = tmp_path / "merged" / "interferograms" / "20230113_20230125" / "filt.int"
+    stat = filt.stat()
+    os.utime(filt, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert run_pairs_stack(str(tmp_path))[0] == 0
+    assert (tmp_path / "merged" / "interferograms" / "20230101_20230113" / "filt.int").exists()
+
+
+def test_journal_done_needs_same_fingerprint(tmp_path):
+    record = {"status": "done", "fingerprint": "a", "outputs": []}
+    assert S1_runISCE2.is_journal_done(record, "a", str(tmp_path))
+    assert not S1_runISCE2.is_journal_done(record, "b", str(tmp_path))
+    assert not S1_runISCE2.is_journal_done(dict(record, status="failed"), "a", str(tmp_path))
+    assert not S1_runISCE2.is_journal_done(None, "a", str(tmp_path))
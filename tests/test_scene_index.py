@@ -0,0 +1,68 @@
+import os
+import zipfile
+
+import lab_utils
+
+MANIFEST = "<manifest><gml:coordinates>{lat0},{lon0} {lat0},{lon1} {lat1},{lon1} {lat1},{lon0}</gml:coordinates></manifest>"
+
+
+def scene_name(date, mission="S1A"):
+    return f"{mission}_IW_SLC__1SDV_{date}T015045_{date}T015112_046711_059A3C_ABCD"
+
+
+def make_safe(directory, date, mission="S1A", lat=35, swaths=(1, 2)):
+    safe = os.path.join(directory, scene_name(date, mission) + ".SAFE")
+    os.makedirs(os.path.join(safe, "annotation"))
+    for swath in swaths:
+        open(os.path.join(safe, "annotation", f"s1a-iw{swath}-slc-vv-{date}t015045-001.xml"), "w").close()
+    with open(os.path.join(safe, "manifest.safe"), "w") as f:
+        f.write(MANIFEST.format(lat0=lat, lat1=lat + 1, lon0=-122, lon1=-121))
+    return safe
+
+
+def make_zip(directory, date, mission="S1A"):
+    name = scene_name(date, mission)
+    path = os.path.join(directory, name + ".zip")
+    with zipfile.ZipFile(path, "w") as zip_ref:
+        zip_ref.writestr(f"{name}.SAFE/annotation/s1a-iw3-slc-vv-{date}t015045-003.xml", "")
+    return path
+
+
+def names(scenes):
+    return [scene["name"][17:25] + scene["kind"] for scene in scenes]
+
+
+def test_query_scenes(tmp_path):
+    make_safe(str(tmp_path), "20230113")
+    make_safe(str(tmp_path), "20230101", lat=40)
+    make_safe(str(tmp_path), "20230125", mission="S1B")
+    make_zip(str(tmp_path), "20230206")
+    os.makedirs(tmp_path / "not_a_scene.SAFE")
+    scenes = lab_utils.query_scenes(str(tmp_path))
+    assert names(scenes) == ["20230101SAFE", "20230113SAFE", "20230125SAFE", "20230206zip"]
+    assert scenes[1]["swaths"] == "1,2" and scenes[1]["relative_orbit"] == 89
+    assert (scenes[1]["lat_min"], scenes[1]["lat_max"]) == (35, 36)
+    assert scenes[3]["swaths"] == "3" and scenes[3]["lat_min"] is None
+
+
+def test_query_scenes_filters(tmp_path):
+    make_safe(str(tmp_path), "20230113")
+    make_safe(str(tmp_path), "20230101", lat=40)
+    make_safe(str(tmp_path), "20230125", mission="S1B")
+    make_zip(str(tmp_path), "20230206")
+    query = lambda **kwargs: names(lab_utils.query_scenes(str(tmp_path), **kwargs))
+    assert query(date1="20230113", date2=20230125) == ["20230113SAFE", "20230125SAFE"]
+    assert query(kind="zip") == ["20230206zip"]
+    assert query(mission="S1B") == ["20230125SAFE"]
+    ## the scenes without footprint (the zip without manifest) are kept by a bbox
+    assert query(bbox=[35.5, 35.8, -121.8, -121.5]) == ["20230113SAFE", "20230125SAFE", "20230206zip"]
+    assert query(bbox=[35.5, 35.8, -121.8, -121.5], kind="SAFE", mission="S1A") == ["20230113SAFE"]
+
+
+def test_query_scenes_refresh(tmp_path):
+    safe = make_safe(str(tmp_path), "20230113")
+    assert names(lab_utils.query_scenes(str(tmp_path))) == ["20230113SAFE"]
+    ## a new scene is indexed, a removed one is dropped
+    make_safe(str(tmp_path), "20230101")
+    os.rename(safe, str(tmp_path / "removed"))
+    assert names(lab_utils.query_scenes(str(tmp_path))) == ["20230101SAFE"]
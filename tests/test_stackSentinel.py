@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+import S1_stackSentinel
+
+
+def make_safe(slc_dir, date, mission="S1A"):
+    name = f"{mission}_IW_SLC__1SDV_{date}T015045_{date}T015112_046711_059A3C_ABCD.SAFE"
+    os.makedirs(os.path.join(slc_dir, name))
+    with open(os.path.join(slc_dir, name, "manifest.safe"), "w") as f:
+        f.write("<manifest/>")
+
+
+def make_stack(process_dir, merged, coreg):
+    for date in merged:
+        os.makedirs(os.path.join(process_dir, "merged", "SLC", date))
+    for date in coreg:
+        os.makedirs(os.path.join(process_dir, "coreg_secondarys", date))
+
+
+def test_get_stack_dates(tmp_path):
+    assert S1_stackSentinel.get_stack_dates(str(tmp_path)) == (None, [])
+    make_stack(str(tmp_path), ["20230101", "20230113"], ["20230113", "20230125"])
+    os.makedirs(tmp_path / "coreg_secondarys" / "overlap")
+    assert S1_stackSentinel.get_stack_dates(str(tmp_path)) == ("20230101", ["20230101", "20230113", "20230125"])
+
+
+@pytest.mark.parametrize("merged, coreg", [
+    (["20230101", "20230113"], []),
+    (["20230113"], ["20230113", "20230125"]),
+])
+def test_get_stack_dates_unknown_reference(tmp_path, merged, coreg):
+    make_stack(str(tmp_path), merged, coreg)
+    with pytest.raises(ValueError):
+        S1_stackSentinel.get_stack_dates(str(tmp_path))
+
+
+@pytest.fixture
+def stack_calls(monkeypatch):
+    # record the stackSentinel.py runs instead of running them
+    calls = []
+    monkeypatch.setattr(S1_stackSentinel, "stack_sentinel", lambda *args, **kwargs: calls.append(kwargs))
+    return calls
+
+
+def update_stack(tmp_path):
+    process_dir, slc_dir = str(tmp_path / "process"), str(tmp_path / "SLC")
+    return S1_stackSentinel.update_stack_sentinel(0, 1, 0, 1, "dem", "aux", slc_dir, "orbits", 1, 5, process_dir)
+
+
+def test_update_stack_sentinel_new_dates(tmp_path, stack_calls):
+    for date in ["20230101", "20230113", "20230125", "20230206"]:
+        make_safe(str(tmp_path / "SLC"), date)
+    make_stack(str(tmp_path / "process"), ["20230101", "20230113"], ["20230113"])
+    os.makedirs(tmp_path / "process" / "run_files")
+    assert update_stack(tmp_path) == ["20230125", "20230206"]
+    assert stack_calls[0]["reference_date"] == "20230101"
+    ## the run files of the previous run are archived
+    assert not os.path.exists(tmp_path / "process" / "run_files")
+    assert [name for name in os.listdir(tmp_path / "process") if name.startswith("run_files_")]
+
+
+def test_update_stack_sentinel_up_to_date(tmp_path, stack_calls):
+    for date in ["20230101", "20230113"]:
+        make_safe(str(tmp_path / "SLC"), date)
+    make_stack(str(tmp_path / "process"), ["20230101", "20230113"], ["20230113"])
+    os.makedirs(tmp_path / "process" / "run_files")
+    assert update_stack(tmp_path) == []
+    assert stack_calls == []
+    ## the run files are kept, so step 5 resumes them
+    assert os.path.isdir(tmp_path / "process" / "run_files")
+
+
+def test_update_stack_sentinel_without_stack(tmp_path, stack_calls):
+    for date in ["20230101", "20230113"]:
+        make_safe(str(tmp_path / "SLC"), date)
+    os.makedirs(tmp_path / "process")
+    assert update_stack(tmp_path) == ["20230101", "20230113"]
+    assert "reference_date" not in stack_calls[0]
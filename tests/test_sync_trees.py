@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+import lab_utils
+
+
+def make_tree(root, files):
+    for path, data in files.items():
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(data)
+
+
+@pytest.fixture
+def trees(tmp_path):
+    src, dst = str(tmp_path / "src"), str(tmp_path / "dst")
+    make_tree(src, {"a/filt.unw": "unw", "a/filt.unw.xml": "xml", "b/filt.cor": "cor", "geom/hgt.rdr": "hgt"})
+    return src, dst
+
+
+@pytest.mark.parametrize("method", lab_utils.STAGE_METHODS)
+def test_sync_trees_only_changed(trees, method):
+    src, dst = trees
+    assert lab_utils.sync_trees([(src, dst)], method) == (4, 4, 12 if method == "copy" else 0)
+    assert open(os.path.join(dst, "a", "filt.unw")).read() == "unw"
+    ## nothing changed : nothing transferred
+    assert lab_utils.sync_trees([(src, dst)], method)[:2] == (4, 0)
+    ## a new source file is transferred, a rewritten one too unless dst links to it
+    make_tree(src, {"b/filt.cor": "cor2", "c/filt.unw": "new"})
+    assert lab_utils.sync_trees([(src, dst)], method)[:2] == (5, 2 if method == "copy" else 1)
+    assert open(os.path.join(dst, "b", "filt.cor")).read() == "cor2"
+
+
+def test_sync_trees_detects_size_and_mtime(trees):
+    src, dst = trees
+    lab_utils.sync_trees([(src, dst)], "copy")
+    ## same size, other mtime
+    os.utime(os.path.join(src, "a", "filt.unw"), (0, 0))
+    ## a dst file changed by hand
+    make_tree(dst, {"b/filt.cor": "changed"})
+    assert lab_utils.sync_trees([(src, dst)], "copy")[:2] == (4, 2)
+    assert open(os.path.join(dst, "b", "filt.cor")).read() == "cor"
+    assert not [name for _, _, files in os.walk(dst) for name in files if name.endswith(".part")]
+
+
+def test_sync_trees_keeps_dst_files_and_excluded(trees):
+    src, dst = trees
+    make_tree(dst, {"mintpy/timeseries.h5": "ts", "a/filt.unw.xml": "translated"})
+    assert lab_utils.sync_trees([(src, dst)], "hardlink", exclude=("*.xml",))[:2] == (3, 3)
+    assert open(os.path.join(dst, "mintpy", "timeseries.h5")).read() == "ts"
+    assert open(os.path.join(dst, "a", "filt.unw.xml")).read() == "translated"
+
+
+def test_sync_trees_several_trees(tmp_path, trees):
+    src, dst = trees
+    make_tree(str(tmp_path / "src2"), {"x.rdr": "x"})
+    result = lab_utils.sync_trees([(src, dst), (str(tmp_path / "src2"), str(tmp_path / "dst2"))], "symlink")
+    assert result == (5, 5, 0)
+    assert os.readlink(tmp_path / "dst2" / "x.rdr") == str(tmp_path / "src2" / "x.rdr")
+    with pytest.raises(ValueError):
+        lab_utils.sync_trees([(src, dst)], "move")